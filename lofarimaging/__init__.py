@@ -2,6 +2,12 @@ from .lofarimaging import *
 from .maputil import *
 from .singlestationutil import *
 from .hdf5util import *
+from .fastplot import *
+from .plottemplate import *
+from .trackstore import *
+from .resultcache import *
+from .constellation import *
+from .association import *
 from .rfi_tools import *
 
 from .version import __version__
@@ -0,0 +1,189 @@
+"""Association of sky image detections with predicted satellite tracks
+
+Detections (peaks in sky images, with a time and l, m) are matched to satellite
+positions from propagate_constellation. Per detection time, the tracks are
+interpolated to that time and put in a KD-tree in l, m. Detections of that time
+are matched to satellites within a maximum separation. The confidence of a match
+is the relative likelihood of that satellite among all candidates and a clutter
+hypothesis (the detection is not caused by any satellite).
+"""
+
+from typing import Dict, NamedTuple, Union
+import datetime
+
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.ndimage import maximum_filter
+from astropy.time import Time
+
+from .constellation import ConstellationPositions
+
+__all__ = ["Detections", "Associations", "find_sky_peaks", "associate_detections"]
+
+__version__ = "1.5.0"
+
+
+class Detections(NamedTuple):
+    """Detected sources, all arrays have shape [n_detection]"""
+    times: np.ndarray
+    l: np.ndarray
+    m: np.ndarray
+    power: np.ndarray
+
+    @classmethod
+    def concatenate(cls, detections_list) -> "Detections":
+        """Combine detections, e.g. of all frames of an observation"""
+        return cls(*(np.concatenate(field) for field in zip(*detections_list)))
+
+
+class Associations(NamedTuple):
+    """Matches between detections and satellites, all arrays have shape [n_match]"""
+    detection_index: np.ndarray
+    sat_index: np.ndarray
+    names: np.ndarray
+    separation: np.ndarray
+    confidence: np.ndarray
+
+    def best_per_detection(self) -> "Associations":
+        """Only the match with the highest confidence for every detection"""
+        order = np.lexsort((-self.confidence, self.detection_index))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = self.detection_index[order][1:] != self.detection_index[order][:-1]
+        selection = order[first]
+        return Associations(*(field[selection] for field in self))
+
+    def counts_per_satellite(self, min_confidence: float = 0.5) -> Dict[str, int]:
+        """
+        Number of detections matched to every satellite
+
+        Args:
+            min_confidence: only count matches with at least this confidence. Defaults to 0.5
+
+        Returns:
+            Dict[str, int]: satellite name -> number of matched detections
+        """
+        names, counts = np.unique(self.names[self.confidence >= min_confidence], return_counts=True)
+        return dict(zip(names.tolist(), counts.tolist()))
+
+
+def find_sky_peaks(image: np.ndarray, obstime: Union[datetime.datetime, np.datetime64], threshold: float = 5.,
+                   min_distance: int = 3, horizon: float = 0.9) -> Detections:
+    """
+    Find local maxima in a sky image (as made by sky_imager) that are above threshold times the noise
+
+    Args:
+        image: sky image, shape [npix_m, npix_l]
+        obstime: observation time of the image
+        threshold: detection threshold in units of the robust standard deviation (from the median absolute
+                   deviation) above the median. Defaults to 5
+        min_distance: minimum distance between peaks in pixels. Defaults to 3
+        horizon: only search within this radius in l, m. Defaults to 0.9
+
+    Returns:
+        Detections: times, l, m and power of the peaks
+    """
+    npix_m, npix_l = image.shape
+    # Pixel centres as in sky_imager
+    l_axis = 1 - np.arange(npix_l) * 2 / npix_l
+    m_axis = -1 + np.arange(npix_m) * 2 / npix_m
+    inside = (l_axis[np.newaxis, :] ** 2 + m_axis[:, np.newaxis] ** 2) < horizon ** 2
+
+    median = np.median(image[inside])
+    noise = 1.4826 * np.median(np.abs(image[inside] - median))
+    is_peak = (image == maximum_filter(image, size=2 * min_distance + 1, mode="nearest")) & inside & \
+        (image > median + threshold * noise)
+    m_ix, l_ix = np.nonzero(is_peak)
+
+    return Detections(np.full(len(m_ix), np.datetime64(obstime, "us")), l_axis[l_ix], m_axis[m_ix],
+                      image[m_ix, l_ix])
+
+
+def _seconds_since(times, reference: Time) -> np.ndarray:
+    """Times as seconds since a reference time"""
+    if isinstance(times, Time):
+        return np.atleast_1d((times - reference).sec)
+    times = np.asarray(times, dtype="datetime64[us]")
+    return (times - np.datetime64(reference.utc.datetime, "us")) / np.timedelta64(1, "s")
+
+
+def associate_detections(detections: Detections, tracks: ConstellationPositions, max_separation: float = 0.05,
+                         sigma: float = 0.015, max_candidates: int = 5,
+                         clutter_weight: float = None) -> Associations:
+    """
+    Match detections to predicted satellite positions
+
+    For every distinct detection time, the satellite positions are linearly interpolated between the
+    samples of the tracks and indexed in a KD-tree in l, m. All satellites within max_separation of a
+    detection are candidates. The confidence of a candidate is its Gaussian likelihood
+    exp(-separation^2 / (2 sigma^2)), divided by the sum of the likelihoods of all candidates plus the
+    clutter weight.
+
+    Args:
+        detections: detected sources, e.g. from find_sky_peaks
+        tracks: satellite positions on a time grid that covers the detection times, from
+                propagate_constellation
+        max_separation: maximum separation in l, m. Defaults to 0.05
+        sigma: position uncertainty of detections and predictions in l, m, e.g. a fraction of the
+               beam width. Defaults to 0.015
+        max_candidates: maximum number of candidate satellites per detection. Defaults to 5
+        clutter_weight: weight of the hypothesis that the detection is not a satellite. Defaults to the
+                        likelihood at max_separation
+
+    Returns:
+        Associations: matches, detections without candidates are not included
+    """
+    if clutter_weight is None:
+        clutter_weight = np.exp(-0.5 * (max_separation / sigma) ** 2)
+
+    track_seconds = _seconds_since(tracks.times, tracks.times[0])
+    detection_seconds = _seconds_since(detections.times, tracks.times[0])
+    track_lm = tracks.lmn[:, :, :2]
+
+    detection_index, sat_index, separation, confidence = [], [], [], []
+
+    # Time buckets: all detections with the same time share one KD-tree
+    bucket_times, bucket_of_detection = np.unique(detection_seconds, return_inverse=True)
+    bucket_order = np.argsort(bucket_of_detection, kind="stable")
+    bucket_bounds = np.searchsorted(bucket_of_detection[bucket_order], np.arange(len(bucket_times) + 1))
+
+    for bucket, seconds in enumerate(bucket_times):
+        if len(track_seconds) == 0 or seconds < track_seconds[0] or seconds > track_seconds[-1]:
+            continue
+        # Interpolate all satellites to this time
+        i1 = min(max(np.searchsorted(track_seconds, seconds, side="right"), 1), len(track_seconds) - 1)
+        i0 = i1 - 1
+        if len(track_seconds) == 1:
+            i0 = i1 = 0
+            frac = 0.
+        else:
+            frac = (seconds - track_seconds[i0]) / (track_seconds[i1] - track_seconds[i0])
+        lm = (1 - frac) * track_lm[:, i0] + frac * track_lm[:, i1]
+        above_horizon = np.nonzero(np.isfinite(lm).all(axis=1) &
+                                   ((tracks.alt[:, i0] > 0) | (tracks.alt[:, i1] > 0)))[0]
+        if len(above_horizon) == 0:
+            continue
+
+        tree = cKDTree(lm[above_horizon])
+        in_bucket = bucket_order[bucket_bounds[bucket]:bucket_bounds[bucket + 1]]
+        points = np.stack([detections.l[in_bucket], detections.m[in_bucket]], axis=-1)
+        k = min(max_candidates, len(above_horizon))
+        dist, tree_ix = tree.query(points, k=k, distance_upper_bound=max_separation)
+        dist, tree_ix = dist.reshape(len(points), k), tree_ix.reshape(len(points), k)
+
+        found = np.isfinite(dist)
+        likelihood = np.where(found, np.exp(-0.5 * (dist / sigma) ** 2), 0.)
+        posterior = likelihood / (likelihood.sum(axis=1, keepdims=True) + clutter_weight)
+
+        det_ix, cand_ix = np.nonzero(found)
+        detection_index.append(in_bucket[det_ix])
+        sat_index.append(above_horizon[tree_ix[det_ix, cand_ix]])
+        separation.append(dist[det_ix, cand_ix])
+        confidence.append(posterior[det_ix, cand_ix])
+
+    if len(detection_index) == 0:
+        empty_int = np.zeros(0, dtype=np.int64)
+        return Associations(empty_int, empty_int, tracks.names[:0], np.zeros(0), np.zeros(0))
+
+    sat_index = np.concatenate(sat_index)
+    return Associations(np.concatenate(detection_index), sat_index, tracks.names[sat_index],
+                        np.concatenate(separation), np.concatenate(confidence))
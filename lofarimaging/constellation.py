@@ -0,0 +1,394 @@
+"""Vectorized propagation of satellite constellations as seen from a station
+
+All satellites are propagated over a time grid in one call to the SGP4 array API.
+The TEME positions are rotated to ITRS with the Greenwich mean sidereal time (like
+Skyfield does), converted to topocentric alt/az/range for the station and to l,m,n
+relative to a phase centre (by default the station zenith).
+
+For repeated queries, a VisibilityIndex records per satellite the time intervals in
+which it can be above an elevation limit, so that only those satellites need to be
+propagated.
+"""
+
+from typing import Dict, List, NamedTuple, Sequence, Union
+import os
+import datetime
+import hashlib
+
+import numpy as np
+import erfa
+from sgp4.api import Satrec, SatrecArray
+from astropy.time import Time
+from astropy.coordinates import SkyCoord, GCRS
+
+from .lofarimaging import itrs_to_gcrs_matrices, enu_rotation_matrix, lmn_rotation_matrix, station_zenith
+
+__all__ = ["ConstellationPositions", "propagate_constellation", "select_satellites", "VisibilityIndex"]
+
+__version__ = "1.5.0"
+
+EARTH_ROTATION_RATE = 7.292115e-5  # rad/s
+
+# Visibility indices are stored next to the TLE cache of spacetrack
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "starlink_data", "tle_cache")
+
+TimesLike = Union[Time, datetime.datetime, Sequence[datetime.datetime]]
+
+
+class ConstellationPositions(NamedTuple):
+    """Positions of satellites as seen from a station, arrays have shape [n_sat, n_time]"""
+    names: np.ndarray
+    satnums: np.ndarray
+    times: Time
+    alt: np.ndarray
+    az: np.ndarray
+    distance: np.ndarray
+    lmn: np.ndarray
+
+    def marked_lmn(self, time_index: int = 0, min_elevation: float = 0.) -> Dict[str, tuple]:
+        """
+        Satellites above min_elevation at one time, in the format of marked_bodies_lmn for make_sky_plot
+
+        Args:
+            time_index: index in the time grid. Defaults to 0
+            min_elevation: minimum elevation in degrees. Defaults to 0
+
+        Returns:
+            Dict[str, tuple]: name -> (l, m, n)
+        """
+        visible = np.nonzero(self.alt[:, time_index] > min_elevation)[0]
+        return {self.names[i]: tuple(self.lmn[i, time_index]) for i in visible}
+
+    def trajectories_lmn(self) -> Dict[str, tuple]:
+        """
+        Trajectories of all satellites over the time grid
+
+        Returns:
+            Dict[str, tuple]: name -> (l array, m array, n array)
+        """
+        return {name: tuple(self.lmn[i].T) for i, name in enumerate(self.names)}
+
+
+def _gmst(times: Time) -> np.ndarray:
+    """Greenwich mean sidereal time (IAU 1982, as used for TEME) in radians"""
+    ut1 = times.ut1
+    return erfa.gmst82(ut1.jd1, ut1.jd2)
+
+
+def _positions_itrs(satrec_array: SatrecArray, jd: np.ndarray, fr: np.ndarray,
+                    gmst: np.ndarray) -> (np.ndarray, np.ndarray):
+    """
+    Propagate with SGP4 and rotate TEME to ITRS (polar motion ignored)
+
+    Returns:
+        positions in metres with shape [n_sat, n_time, 3] (NaN where SGP4 failed) and an upper bound on
+        the speed w.r.t. ITRS in m/s with shape [n_sat, n_time]
+    """
+    # SGP4 expects UTC, TEME to ITRS uses GMST on UT1
+    error, r_teme, v_teme = satrec_array.sgp4(jd, fr)
+    r_teme = np.where(error[:, :, np.newaxis] == 0, r_teme * 1000., np.nan)
+
+    cos_gmst, sin_gmst = np.cos(gmst), np.sin(gmst)
+    r_itrs = np.empty_like(r_teme)
+    r_itrs[..., 0] = cos_gmst * r_teme[..., 0] + sin_gmst * r_teme[..., 1]
+    r_itrs[..., 1] = -sin_gmst * r_teme[..., 0] + cos_gmst * r_teme[..., 1]
+    r_itrs[..., 2] = r_teme[..., 2]
+
+    # The velocity in ITRS is the TEME velocity minus the rotation of the earth
+    speed = np.linalg.norm(v_teme, axis=-1) * 1000. + \
+        EARTH_ROTATION_RATE * np.hypot(r_teme[..., 0], r_teme[..., 1])
+    return r_itrs, speed
+
+
+def _satrecs(satellites) -> (List[Satrec], np.ndarray):
+    """Satrec objects and names from a list of Skyfield EarthSatellites or from get_starlink_tles output"""
+    if isinstance(satellites, dict):
+        satrecs = [Satrec.twoline2rv(l1, l2) for l1, l2 in zip(satellites["line1"].tolist(),
+                                                                 satellites["line2"].tolist())]
+        names = np.asarray(satellites["name"], dtype=str)
+    else:
+        satrecs = [sat.model for sat in satellites]
+        names = np.array([sat.name for sat in satellites], dtype=str)
+    return satrecs, names
+
+
+def propagate_constellation(satellites, times: TimesLike, station_xyz: np.ndarray, min_elevation: float = None,
+                            cull_index: int = None, phasecentre: SkyCoord = None) -> ConstellationPositions:
+    """
+    Propagate all satellites over a time grid and compute their positions as seen from a station
+
+    Args:
+        satellites: list of Skyfield EarthSatellites (as from get_starlink_data) or parsed TLEs
+                    (as from get_starlink_tles)
+        times: observation times (UTC), astropy Time or datetime(s)
+        station_xyz: ITRF position of the station in metres, e.g. db.phase_centres[station_name]
+        min_elevation: only keep satellites above this elevation (degrees). Defaults to None (keep all)
+        cull_index: index in the time grid at which min_elevation is checked. Defaults to None (any time)
+        phasecentre: phase centre for l,m,n. Defaults to the station zenith at the first time
+
+    Returns:
+        ConstellationPositions: alt, az (degrees), distance (m) with shape [n_sat, n_time] and lmn with
+                                shape [n_sat, n_time, 3]. Positions where SGP4 failed are NaN.
+
+    Example:
+        >>> tles = {"name": np.array(["0 STARLINK-1007"]),
+        ...         "line1": np.array(["1 44713U 19074A   23010.50000000  .00001103  00000-0  92581-4 0  9991"]),
+        ...         "line2": np.array(["2 44713  53.0543 189.3296 0001346  85.2148 274.9007 15.06393191173437"])}
+        >>> station_xyz = np.array([3183318.032, 1276777.654, 5359435.077])
+        >>> pos = propagate_constellation(tles, datetime.datetime(2023, 1, 11, 7, 20, 42), station_xyz)
+        >>> pos.alt.shape, pos.lmn.shape
+        ((1, 1), (1, 1, 3))
+    """
+    times = Time(times).reshape(-1)
+    station_xyz = np.asarray(station_xyz, dtype=np.float64)
+
+    satrecs, names = _satrecs(satellites)
+    satnums = np.array([satrec.satnum for satrec in satrecs], dtype=np.int64)
+    if len(satrecs) == 0:
+        empty = np.zeros((0, len(times)))
+        return ConstellationPositions(names, satnums, times, empty, empty, empty, np.zeros((0, len(times), 3)))
+
+    r_itrs, _ = _positions_itrs(SatrecArray(satrecs), times.utc.jd1, times.utc.jd2, _gmst(times))
+
+    # Topocentric east, north, up
+    topo_itrs = r_itrs - station_xyz
+    enu = topo_itrs @ enu_rotation_matrix(station_xyz).T
+    distance = np.linalg.norm(enu, axis=-1)
+    with np.errstate(invalid="ignore"):
+        alt = np.rad2deg(np.arcsin(enu[..., 2] / distance))
+    az = np.rad2deg(np.arctan2(enu[..., 0], enu[..., 1])) % 360.
+
+    if min_elevation is not None:
+        with np.errstate(invalid="ignore"):
+            above = alt > min_elevation if cull_index is None else alt[:, [cull_index]] > min_elevation
+        keep = np.nonzero(np.any(above, axis=1))[0]
+        names, satnums = names[keep], satnums[keep]
+        alt, az, distance, topo_itrs = alt[keep], az[keep], distance[keep], topo_itrs[keep]
+
+    # Directions in GCRS, then l,m,n w.r.t. the phase centre
+    if phasecentre is None:
+        phasecentre = station_zenith(station_xyz, times[0])
+    elif not isinstance(getattr(phasecentre, "frame", phasecentre), GCRS):
+        phasecentre = phasecentre.transform_to(GCRS(obstime=times[0]))
+    directions = np.einsum("tij,stj->sti", itrs_to_gcrs_matrices(times), topo_itrs) / distance[..., np.newaxis]
+    lmn = directions @ lmn_rotation_matrix(phasecentre).T
+    lmn[..., 2] -= 1
+
+    return ConstellationPositions(names, satnums, times, alt, az, distance, lmn)
+
+
+def select_satellites(satellites, indices: np.ndarray):
+    """
+    Subset of satellites, for a list of EarthSatellites or parsed TLEs
+
+    Args:
+        satellites: list of Skyfield EarthSatellites or parsed TLEs (as from get_starlink_tles)
+        indices: indices of the satellites to keep
+
+    Returns:
+        Same type as satellites, with only the selected satellites
+    """
+    if isinstance(satellites, dict):
+        return {key: np.asarray(value)[indices] for key, value in satellites.items()}
+    return [satellites[i] for i in indices]
+
+
+def _tle_fingerprint(satellites) -> str:
+    """Hash of the TLE lines of all satellites"""
+    if isinstance(satellites, dict):
+        lines1, lines2 = satellites["line1"].tolist(), satellites["line2"].tolist()
+    else:
+        lines1 = [f"{sat.model.satnum} {sat.model.jdsatepoch + sat.model.jdsatepochF!r}" for sat in satellites]
+        lines2 = [f"{sat.model.inclo!r} {sat.model.nodeo!r} {sat.model.mo!r} {sat.model.no_kozai!r}"
+                  for sat in satellites]
+    sha = hashlib.sha1()
+    for l1, l2 in zip(lines1, lines2):
+        sha.update(l1.encode())
+        sha.update(l2.encode())
+    return sha.hexdigest()
+
+
+class VisibilityIndex:
+    """
+    Time intervals in which each satellite can be above an elevation limit for a station
+
+    The index is built by propagating all satellites on a coarse time grid. Around every grid point, a
+    satellite is marked as a candidate if its distance to the cone of directions above the elevation
+    limit is less than it can travel in half a step. This makes the intervals conservative: a satellite
+    outside its intervals is certainly below the elevation limit.
+
+    Example:
+        >>> index = VisibilityIndex.build(satellites, db.phase_centres["LV614LBA"], obstime - timedelta(hours=1),
+        ...                               obstime + timedelta(hours=1), min_elevation=30)  # doctest: +SKIP
+        >>> candidates = index.candidates(obstime, obstime + timedelta(minutes=5))  # doctest: +SKIP
+        >>> positions = propagate_constellation(select_satellites(satellites, candidates), times,
+        ...                                     db.phase_centres["LV614LBA"], min_elevation=30)  # doctest: +SKIP
+    """
+    def __init__(self, sat_index: np.ndarray, interval_start: np.ndarray, interval_end: np.ndarray,
+                 start: np.datetime64, end: np.datetime64, n_satellites: int, station_xyz: np.ndarray,
+                 min_elevation: float, step: float, fingerprint: str):
+        """
+        Create an index from an interval table, use build or load to get one
+
+        Args:
+            sat_index: satellite index for every interval
+            interval_start: start of every interval, sorted, as datetime64[ms]
+            interval_end: end of every interval, as datetime64[ms]
+            start: start of the time range covered by the index
+            end: end of the time range covered by the index
+            n_satellites: number of satellites in the TLE set
+            station_xyz: ITRF position of the station in metres
+            min_elevation: elevation limit in degrees
+            step: step of the time grid in seconds
+            fingerprint: hash of the TLE set
+        """
+        self.sat_index = sat_index
+        self.interval_start = interval_start
+        self.interval_end = interval_end
+        self.start = start
+        self.end = end
+        self.n_satellites = n_satellites
+        self.station_xyz = station_xyz
+        self.min_elevation = min_elevation
+        self.step = step
+        self.fingerprint = fingerprint
+        durations = interval_end - interval_start
+        self._max_duration = durations.max() if len(durations) > 0 else np.timedelta64(0, "ms")
+
+    def __repr__(self) -> str:
+        return (f"VisibilityIndex({self.n_satellites} satellites, {len(self.sat_index)} intervals above "
+                f"{self.min_elevation} deg, {self.start} to {self.end})")
+
+    @classmethod
+    def build(cls, satellites, station_xyz: np.ndarray, start: TimesLike, end: TimesLike,
+              min_elevation: float = 30., step: float = 30., chunk_size: int = 240) -> "VisibilityIndex":
+        """
+        Build the index by propagating all satellites on a coarse time grid
+
+        Args:
+            satellites: list of Skyfield EarthSatellites or parsed TLEs (as from get_starlink_tles)
+            station_xyz: ITRF position of the station in metres, e.g. db.phase_centres[station_name]
+            start: start of the time range (UTC)
+            end: end of the time range (UTC)
+            min_elevation: elevation limit in degrees. Defaults to 30
+            step: step of the time grid in seconds. Defaults to 30
+            chunk_size: number of grid points propagated at once. Defaults to 240
+
+        Returns:
+            VisibilityIndex
+        """
+        station_xyz = np.asarray(station_xyz, dtype=np.float64)
+        start = np.datetime64(Time(start).utc.datetime, "ms")
+        end = np.datetime64(Time(end).utc.datetime, "ms")
+        step_ms = np.timedelta64(int(round(step * 1000)), "ms")
+        grid = np.arange(start, end + step_ms, step_ms)
+        times = Time(grid.astype("datetime64[us]").astype(datetime.datetime), scale="utc")
+        utc = times.utc
+        gmst = _gmst(times)
+
+        satrecs, _ = _satrecs(satellites)
+        satrec_array = SatrecArray(satrecs)
+        up = enu_rotation_matrix(station_xyz)[2]
+        cone_half_angle = np.deg2rad(90. - min_elevation)
+
+        candidate = np.zeros((len(satrecs), len(grid)), dtype=bool)
+        for chunk_start in range(0, len(grid), chunk_size):
+            chunk = slice(chunk_start, chunk_start + chunk_size)
+            r_itrs, speed = _positions_itrs(satrec_array, utc.jd1[chunk], utc.jd2[chunk], gmst[chunk])
+            topo = r_itrs - station_xyz
+            distance = np.linalg.norm(topo, axis=-1)
+            with np.errstate(invalid="ignore"):
+                zenith_angle = np.arccos(np.clip(topo @ up / distance, -1., 1.))
+                # Distance to the cone of directions above min_elevation
+                beyond = zenith_angle - cone_half_angle
+                cone_distance = np.where(beyond <= 0, 0., np.where(beyond >= np.pi / 2, distance,
+                                                                   distance * np.sin(beyond)))
+                # 10% margin on the speed for the change of speed within a step
+                candidate[:, chunk] = cone_distance <= 1.1 * speed * step / 2
+
+        # Runs of candidate grid points become intervals, extended by half a step on both sides
+        padded = np.zeros((len(satrecs), len(grid) + 2), dtype=np.int8)
+        padded[:, 1:-1] = candidate
+        edges = np.diff(padded, axis=1)
+        sat_index, first = np.nonzero(edges == 1)
+        _, last = np.nonzero(edges == -1)
+        half_step = step_ms // 2
+        interval_start = grid[first] - half_step
+        interval_end = grid[last - 1] + half_step
+
+        order = np.argsort(interval_start, kind="stable")
+        return cls(sat_index[order].astype(np.int32), interval_start[order], interval_end[order],
+                   start - half_step, end + half_step, len(satrecs), station_xyz, float(min_elevation),
+                   float(step), _tle_fingerprint(satellites))
+
+    def candidates(self, start: TimesLike, end: TimesLike = None) -> np.ndarray:
+        """
+        Satellites that can be above the elevation limit at some time between start and end
+
+        Args:
+            start: start of the time range (UTC)
+            end: end of the time range (UTC). Defaults to start
+
+        Returns:
+            np.ndarray: sorted indices of the satellites in the TLE set
+        """
+        start = np.datetime64(Time(start).utc.datetime, "ms")
+        end = start if end is None else np.datetime64(Time(end).utc.datetime, "ms")
+        if start < self.start or end > self.end:
+            print(f"Warning: {start} to {end} is outside the visibility index ({self.start} to {self.end}), "
+                  "returning all satellites")
+            return np.arange(self.n_satellites)
+
+        # Intervals that overlap [start, end] start before end and at most max_duration before start
+        lo = np.searchsorted(self.interval_start, start - self._max_duration, side="left")
+        hi = np.searchsorted(self.interval_start, end, side="right")
+        overlapping = self.interval_end[lo:hi] >= start
+        return np.unique(self.sat_index[lo:hi][overlapping])
+
+    def save(self, filename: str):
+        """Save the index to an npz file"""
+        np.savez(filename, sat_index=self.sat_index, interval_start=self.interval_start,
+                 interval_end=self.interval_end, start=self.start, end=self.end, n_satellites=self.n_satellites,
+                 station_xyz=self.station_xyz, min_elevation=self.min_elevation, step=self.step,
+                 fingerprint=self.fingerprint)
+
+    @classmethod
+    def load(cls, filename: str) -> "VisibilityIndex":
+        """Load an index saved with save"""
+        with np.load(filename) as npz:
+            return cls(npz["sat_index"], npz["interval_start"], npz["interval_end"], npz["start"][()],
+                       npz["end"][()], int(npz["n_satellites"]), npz["station_xyz"], float(npz["min_elevation"]),
+                       float(npz["step"]), str(npz["fingerprint"]))
+
+    @classmethod
+    def load_or_build(cls, satellites, station_xyz: np.ndarray, start: TimesLike, end: TimesLike,
+                      min_elevation: float = 30., step: float = 30., cache_dir: str = None) -> "VisibilityIndex":
+        """
+        Load the index for this TLE set, station and time range from the cache, or build and save it
+
+        Args:
+            satellites: list of Skyfield EarthSatellites or parsed TLEs (as from get_starlink_tles)
+            station_xyz: ITRF position of the station in metres
+            start: start of the time range (UTC)
+            end: end of the time range (UTC)
+            min_elevation: elevation limit in degrees. Defaults to 30
+            step: step of the time grid in seconds. Defaults to 30
+            cache_dir: directory for the index. Defaults to the TLE cache directory of spacetrack
+
+        Returns:
+            VisibilityIndex
+        """
+        if cache_dir is None:
+            cache_dir = DEFAULT_CACHE_DIR
+        start_ms = np.datetime64(Time(start).utc.datetime, "ms")
+        end_ms = np.datetime64(Time(end).utc.datetime, "ms")
+        key = hashlib.sha1(f"{_tle_fingerprint(satellites)} {np.round(station_xyz, 1).tolist()} {start_ms} "
+                           f"{end_ms} {min_elevation} {step}".encode()).hexdigest()[:16]
+        filename = os.path.join(cache_dir, f"visibility_{key}.npz")
+        if os.path.exists(filename):
+            return cls.load(filename)
+
+        index = cls.build(satellites, station_xyz, start, end, min_elevation=min_elevation, step=step)
+        os.makedirs(cache_dir, exist_ok=True)
+        index.save(filename)
+        return index
@@ -0,0 +1,435 @@
+"""Fast rendering of sky and ground images directly to RGB arrays and PNG files
+
+The static parts of a plot (axes, labels, title, colorbar, compass, grid) are
+rendered once per configuration with matplotlib and cached. Every new image is
+then only mapped through a colormap lookup table, composited into the cached
+layers and saved with PIL, which is much cheaper than building a full figure.
+"""
+
+import threading
+import collections
+from typing import Dict, List, Tuple
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from matplotlib import cm, font_manager
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import Normalize
+from matplotlib.patches import Circle
+from matplotlib.ticker import FormatStrFormatter
+import matplotlib.axes as maxes
+from mpl_toolkits.axes_grid1 import make_axes_locatable
+
+__all__ = ["colormap_lut", "ground_overlay", "render_sky_image", "render_ground_image", "write_png",
+           "make_sky_png", "make_ground_png"]
+
+__version__ = "1.5.0"
+
+# Number of colorbar labels that are drawn for every image
+NUM_CBAR_TICKS = 5
+
+# Maximum number of cached layouts, each layout holds a few full-size RGB(A) layers
+MAX_CACHED_LAYOUTS = 8
+
+_layout_cache = collections.OrderedDict()
+_layout_lock = threading.Lock()
+
+
+def colormap_lut(cmap=cm.Spectral_r, alpha_ramp: bool = False) -> np.ndarray:
+    """
+    Make a lookup table for a colormap
+
+    Args:
+        cmap: matplotlib colormap. Defaults to Spectral_r
+        alpha_ramp: make colors semi-transparent in the lower 3/4 of the scale, like in make_ground_plot
+
+    Returns:
+        np.ndarray: RGBA values as uint8, shape [cmap.N, 4]
+
+    Example:
+        >>> colormap_lut().shape
+        (256, 4)
+    """
+    lut = cmap(np.arange(cmap.N))
+    if alpha_ramp:
+        lut[:, -1] = np.clip(np.linspace(0, 1.5, cmap.N), 0., 1.)
+    return np.round(lut * 255).astype(np.uint8)
+
+
+def _lut_indices(image: np.ndarray, vmin: float, vmax: float, num_colors: int) -> np.ndarray:
+    """Map image values to lookup table indices, in the same way as matplotlib.colors.Colormap"""
+    if vmax == vmin:
+        scaled = np.zeros_like(image)
+    else:
+        scaled = (image - vmin) / (vmax - vmin)
+    return np.clip((np.nan_to_num(scaled, nan=0.) * num_colors).astype(np.intp), 0, num_colors - 1)
+
+
+def _clim(image: np.ndarray, vmin: float, vmax: float) -> Tuple[float, float]:
+    """Fill in missing color limits from the image, like imshow does"""
+    if vmin is None:
+        vmin = float(np.nanmin(image))
+    if vmax is None:
+        vmax = float(np.nanmax(image))
+    return vmin, vmax
+
+
+def ground_overlay(image: np.ndarray, vmin: float = None, vmax: float = None) -> np.ndarray:
+    """
+    Colored overlay for a leaflet map, equal to the array returned by make_ground_plot
+
+    Args:
+        image: ground image
+        vmin: minimum value of the color scale. Defaults to the image minimum
+        vmax: maximum value of the color scale. Defaults to the image maximum
+
+    Returns:
+        np.ndarray: RGBA values between 0 and 1, flipped to have north up
+
+    Example:
+        >>> ground_overlay(np.random.rand(150, 150)).shape
+        (150, 150, 4)
+    """
+    vmin, vmax = _clim(image, vmin, vmax)
+    lut = colormap_lut(alpha_ramp=True)
+    return lut[_lut_indices(image, vmin, vmax, len(lut))][::-1, :] / 255.
+
+
+def _font(size_pt: float, dpi: float):
+    """PIL font matching matplotlib's default font"""
+    font_path = font_manager.findfont(font_manager.FontProperties())
+    return ImageFont.truetype(font_path, size=max(1, int(round(size_pt * dpi / 72))))
+
+
+class _RasterLayout:
+    """
+    Pixel geometry and pre-rendered static layers for one plot configuration
+
+    The base layer contains everything that is drawn below the image (labels, title,
+    colorbar), the overlay layer everything that is drawn on top of it (compass
+    directions, grid, spines). Labels that change per image are drawn with PIL.
+    """
+    def __init__(self, kind: str, shape: Tuple[int, int], extent: List[float], title: str, dpi: float,
+                 background_map: np.ndarray = None, db_format: bool = False):
+        self.kind = kind
+        self.shape = shape
+        self.extent = list(extent)
+        self.dpi = dpi
+        self.cbar_format = "%g" if db_format else "%.2e"
+
+        fig, ax, cax, title_text, overlay_artists = self._make_figure(title)
+        canvas = fig.canvas
+
+        # Reserve room for the labels that are drawn per image before computing the crop box
+        probe_label = ax.text(0.5, 1.02, "8" * 60, fontsize=12, ha='center', va='bottom', transform=ax.transAxes)
+        cax.set_yticks(np.linspace(0, 1, NUM_CBAR_TICKS))
+        cax.set_yticklabels(["-8.88e+88"] * NUM_CBAR_TICKS)
+        canvas.draw()
+        renderer = canvas.get_renderer()
+        tight_bbox = fig.get_tightbbox(renderer).padded(0.1)
+        probe_label.remove()
+        cax.set_yticklabels([""] * NUM_CBAR_TICKS)
+
+        width, height = canvas.get_width_height()
+        self.crop = (max(0, int(np.floor(tight_bbox.x0 * dpi))), max(0, int(np.floor(height - tight_bbox.y1 * dpi))),
+                     min(width, int(np.ceil(tight_bbox.x1 * dpi))), min(height, int(np.ceil(height - tight_bbox.y0 * dpi))))
+
+        ax_bbox = ax.get_window_extent(renderer)
+        self.x0, self.x1 = int(round(ax_bbox.x0)), int(round(ax_bbox.x1))
+        self.y0, self.y1 = int(round(height - ax_bbox.y1)), int(round(height - ax_bbox.y0))
+        box_w, box_h = self.x1 - self.x0, self.y1 - self.y0
+
+        cax_bbox = cax.get_window_extent(renderer)
+        major_tick = cax.yaxis.get_major_ticks()[0]
+        tick_pad = (major_tick.get_pad() + major_tick.get_tick_padding()) * dpi / 72
+        self.cbar_label_x = cax_bbox.x1 + tick_pad
+        self.cbar_label_y = height - (cax_bbox.y0 + np.linspace(0, 1, NUM_CBAR_TICKS) * cax_bbox.height)
+        self.subtitle_xy = ((ax_bbox.x0 + ax_bbox.x1) / 2, height - (ax_bbox.y1 + 0.02 * ax_bbox.height))
+
+        # Base layer: everything except the overlay artists
+        for artist in overlay_artists:
+            artist.set_visible(False)
+        canvas.draw()
+        self.base = np.asarray(canvas.buffer_rgba())[:, :, :3].copy()
+
+        # Overlay layer: only the overlay artists and the grid, on a transparent background
+        fig.patch.set_alpha(0.)
+        ax.patch.set_visible(False)
+        cax.set_visible(False)
+        title_text.set_visible(False)
+        ax.xaxis.label.set_visible(False)
+        ax.yaxis.label.set_visible(False)
+        ax.tick_params(axis='both', which='both', length=0, labelbottom=False, labelleft=False)
+        if kind == "ground":
+            ax.grid(True, alpha=0.3)
+        for artist in overlay_artists:
+            artist.set_visible(True)
+        canvas.draw()
+        overlay = np.asarray(canvas.buffer_rgba())
+        self.overlay_rows, self.overlay_cols = np.nonzero(overlay[:, :, 3])
+        self.overlay_rgb = overlay[self.overlay_rows, self.overlay_cols, :3].astype(np.float32)
+        self.overlay_alpha = overlay[self.overlay_rows, self.overlay_cols, 3:].astype(np.float32) / 255.
+
+        # Nearest neighbour resampling from image pixels to screen pixels (image has origin lower)
+        self.img_rows = (shape[0] - 1 - ((np.arange(box_h) + 0.5) / box_h * shape[0]).astype(np.intp))
+        self.img_cols = ((np.arange(box_w) + 0.5) / box_w * shape[1]).astype(np.intp)
+
+        if kind == "sky":
+            u = 2 * (np.arange(box_w) + 0.5) / box_w - 1
+            v = 1 - 2 * (np.arange(box_h) + 0.5) / box_h
+            self.inside = (u[np.newaxis, :] ** 2 + v[:, np.newaxis] ** 2) <= 1.
+            self.background = None
+        else:
+            # Background map has origin upper and spans the full extent
+            map_rows = ((np.arange(box_h) + 0.5) / box_h * background_map.shape[0]).astype(np.intp)
+            map_cols = ((np.arange(box_w) + 0.5) / box_w * background_map.shape[1]).astype(np.intp)
+            self.background = background_map[map_rows][:, map_cols, :3].astype(np.float32)
+            self.inside = None
+
+        self.subtitle_font = _font(12, dpi)
+        self.label_font = _font(10, dpi)
+
+        fig.clf()
+
+    def _make_figure(self, title):
+        """Build the matplotlib figure with all static artists, mirrors make_sky_plot and make_ground_plot"""
+        fig = Figure(figsize=(10, 10), dpi=self.dpi)
+        FigureCanvasAgg(fig)
+        overlay_artists = []
+
+        if self.kind == "sky":
+            ax = fig.add_subplot(1, 1, 1)
+            circle1 = Circle((0, 0), 1.0, edgecolor='k', fill=False, facecolor='none', alpha=0.3)
+            ax.add_artist(circle1)
+            overlay_artists.append(circle1)
+            dummy_img = ax.imshow(np.zeros(self.shape), origin='lower', extent=(1, -1, -1, 1))
+            ax.set_xlim(1, -1)
+            ax.set_xticks(np.arange(-1, 1.1, 0.5))
+            ax.xaxis.set_major_formatter(FormatStrFormatter('%.1f'))
+            ax.set_yticks(np.arange(-1, 1.1, 0.5))
+            ax.yaxis.set_major_formatter(FormatStrFormatter('%.1f'))
+            ax.set_xlabel('$ℓ$', fontsize=14)
+            ax.set_ylabel('$m$', fontsize=14)
+            for text, x, y in (('E', 0.9, 0), ('W', -0.9, 0), ('N', 0, 0.9), ('S', 0, -0.9)):
+                overlay_artists.append(ax.text(x, y, text, horizontalalignment='center',
+                                               verticalalignment='center', color='w', fontsize=17))
+        else:
+            ax = fig.add_subplot(111, ymargin=-0.4)
+            dummy_img = ax.imshow(np.zeros(self.shape), origin='lower', extent=self.extent)
+            ax.set_xlabel('$W-E$ (metres)', fontsize=14)
+            ax.set_ylabel('$S-N$ (metres)', fontsize=14)
+            ax.set_xlim(self.extent[0], self.extent[1])
+            ax.set_ylim(self.extent[2], self.extent[3])
+            ax.tick_params(axis='both', which='both', length=0)
+            for text, x, y in (('E', 0.95, 0.5), ('W', 0.05, 0.5), ('N', 0.5, 0.95), ('S', 0.5, 0.05)):
+                overlay_artists.append(ax.text(x, y, text, color='w', fontsize=18, transform=ax.transAxes,
+                                               ha='center', va='center'))
+
+        dummy_img.set_visible(False)
+        overlay_artists.extend(ax.spines.values())
+
+        divider = make_axes_locatable(ax)
+        cax = divider.append_axes("right", size="5%", pad=0.2, axes_class=maxes.Axes)
+        scalar_mappable = cm.ScalarMappable(norm=Normalize(vmin=0., vmax=1.), cmap=cm.Spectral_r)
+        fig.colorbar(scalar_mappable, cax=cax, orientation="vertical")
+
+        title_text = ax.text(0.5, 1.05, title, fontsize=17, ha='center', va='bottom', transform=ax.transAxes)
+
+        return fig, ax, cax, title_text, overlay_artists
+
+    def render(self, image: np.ndarray, subtitle: str, vmin: float, vmax: float, opacity: float = 1.):
+        """Composite an image into the static layers, returns cropped RGB array"""
+        canvas = self.base.copy()
+        box = canvas[self.y0:self.y1, self.x0:self.x1]
+
+        if self.kind == "sky":
+            lut = colormap_lut()
+            colors = lut[_lut_indices(image, vmin, vmax, len(lut))][self.img_rows][:, self.img_cols]
+            inside = self.inside & np.isfinite(image)[self.img_rows][:, self.img_cols]
+            box[inside] = colors[inside, :3]
+        else:
+            lut = colormap_lut(alpha_ramp=True)
+            colors = lut[_lut_indices(image, vmin, vmax, len(lut))][self.img_rows][:, self.img_cols]
+            alpha = colors[:, :, 3:].astype(np.float32) * (opacity / 255.)
+            box[:] = (self.background * (1. - alpha) + colors[:, :, :3] * alpha).astype(np.uint8)
+
+        over = canvas[self.overlay_rows, self.overlay_cols].astype(np.float32)
+        canvas[self.overlay_rows, self.overlay_cols] = (over * (1. - self.overlay_alpha) +
+                                                        self.overlay_rgb * self.overlay_alpha).astype(np.uint8)
+
+        pil_image = Image.fromarray(canvas)
+        draw = ImageDraw.Draw(pil_image)
+        draw.text(self.subtitle_xy, subtitle, fill='black', font=self.subtitle_font, anchor='md')
+        for tick_value, tick_y in zip(np.linspace(vmin, vmax, NUM_CBAR_TICKS), self.cbar_label_y):
+            draw.text((self.cbar_label_x, tick_y), self.cbar_format % tick_value, fill='black',
+                      font=self.label_font, anchor='lm')
+
+        return pil_image
+
+    def data_to_pixel(self, x: float, y: float) -> Tuple[float, float]:
+        """Convert data coordinates (l, m for sky plots, metres for ground plots) to pixel coordinates"""
+        if self.kind == "sky":
+            x_frac, y_frac = (1 - x) / 2, (1 - y) / 2
+        else:
+            x_frac = (x - self.extent[0]) / (self.extent[1] - self.extent[0])
+            y_frac = (self.extent[3] - y) / (self.extent[3] - self.extent[2])
+        return self.x0 + x_frac * (self.x1 - self.x0), self.y0 + y_frac * (self.y1 - self.y0)
+
+
+def _get_layout(kind: str, shape: Tuple[int, int], extent: List[float], title: str, dpi: float,
+                background_map: np.ndarray = None, background_key=None, db_format: bool = False) -> _RasterLayout:
+    """Get a layout from the cache, or make a new one"""
+    if background_map is not None and background_key is None:
+        background_key = (background_map.shape, hash(background_map.tobytes()))
+    key = (kind, tuple(shape), tuple(extent), title, dpi, background_key, db_format)
+
+    with _layout_lock:
+        if key in _layout_cache:
+            _layout_cache.move_to_end(key)
+            return _layout_cache[key]
+        layout = _RasterLayout(kind, shape, extent, title, dpi, background_map=background_map, db_format=db_format)
+        _layout_cache[key] = layout
+        while len(_layout_cache) > MAX_CACHED_LAYOUTS:
+            _layout_cache.popitem(last=False)
+        return layout
+
+
+def _crop(pil_image: Image.Image, layout: _RasterLayout) -> np.ndarray:
+    return np.asarray(pil_image.crop(layout.crop))
+
+
+def render_sky_image(image: np.ndarray, marked_bodies_lmn: Dict[str, Tuple[float, float, float]],
+                     title: str = "Sky plot", subtitle: str = "", vmin: float = None, vmax: float = None,
+                     dpi: float = 100) -> np.ndarray:
+    """
+    Render a sky image to an RGB array, looks like make_sky_plot
+
+    Args:
+        image: numpy array (two dimensions with data)
+        marked_bodies_lmn: dict with objects to annotate (values should be lmn coordinates)
+        title: Title for the plot
+        subtitle: Subtitle for the plot
+        vmin: minimum value of the color scale. Defaults to the image minimum
+        vmax: maximum value of the color scale. Defaults to the image maximum
+        dpi: resolution of the output. Defaults to 100
+
+    Returns:
+        np.ndarray: RGB image as uint8, shape [height, width, 3]
+
+    Example:
+        >>> rgb = render_sky_image(np.random.rand(131, 131), {'Cas A': (0.3, 0.5, 0.2)})
+        >>> rgb.dtype
+        dtype('uint8')
+    """
+    vmin, vmax = _clim(image, vmin, vmax)
+    layout = _get_layout("sky", image.shape, [1, -1, -1, 1], title, dpi)
+    pil_image = layout.render(image, subtitle, vmin, vmax)
+
+    draw = ImageDraw.Draw(pil_image)
+    marker_size = 3 * dpi / 72
+    for body_name, lmn in marked_bodies_lmn.items():
+        x, y = layout.data_to_pixel(lmn[0], lmn[1])
+        draw.line([(x - marker_size, y - marker_size), (x + marker_size, y + marker_size)], fill='black')
+        draw.line([(x - marker_size, y + marker_size), (x + marker_size, y - marker_size)], fill='black')
+        draw.text((x, y), body_name, fill='black', font=layout.label_font, anchor='ls')
+
+    return _crop(pil_image, layout)
+
+
+def render_ground_image(image: np.ndarray, background_map: np.ndarray, extent: List[float],
+                        title: str = "Ground plot", subtitle: str = "", opacity: float = 0.6,
+                        vmin: float = None, vmax: float = None, mark_max_power: bool = False,
+                        db_format: bool = False, dpi: float = 100, background_key=None) -> np.ndarray:
+    """
+    Render a ground image on top of a map to an RGB array, looks like make_ground_plot without contours
+
+    Args:
+        image: numpy array (two dimensions with data)
+        background_map: background map
+        extent: extent in metres
+        title: Title for the plot
+        subtitle: Subtitle for the plot
+        opacity: maximum opacity of the plot
+        vmin: minimum value of the color scale. Defaults to the image minimum
+        vmax: maximum value of the color scale. Defaults to the image maximum
+        mark_max_power: mark the maximum power. Defaults to False
+        db_format: format colorbar labels for values in dB. Defaults to False
+        dpi: resolution of the output. Defaults to 100
+        background_key: hashable identifying the background map, e.g. its lon/lat extent and zoom.
+                        Defaults to a hash of the map contents.
+
+    Returns:
+        np.ndarray: RGB image as uint8, shape [height, width, 3]
+
+    Example:
+        >>> dummy_map = np.zeros((100, 100, 3), dtype=np.uint8)
+        >>> rgb = render_ground_image(np.random.rand(150, 150), dummy_map, [-300, 300, -100, 100])
+        >>> rgb.shape[2]
+        3
+    """
+    vmin, vmax = _clim(image, vmin, vmax)
+    layout = _get_layout("ground", image.shape, extent, title, dpi, background_map=background_map,
+                         background_key=background_key, db_format=db_format)
+    pil_image = layout.render(image, subtitle, vmin, vmax, opacity=opacity)
+
+    if mark_max_power:
+        max_idx = np.unravel_index(np.nanargmax(image), image.shape)
+        maxpixel_x = np.interp(max_idx[1], [0, image.shape[1]], [extent[0], extent[1]])
+        maxpixel_y = np.interp(max_idx[0], [0, image.shape[0]], [extent[2], extent[3]])
+        x, y = layout.data_to_pixel(maxpixel_x, maxpixel_y)
+        radius = 8 / (extent[1] - extent[0]) * (layout.x1 - layout.x0)
+        ImageDraw.Draw(pil_image).ellipse([x - radius, y - radius, x + radius, y + radius], outline='red',
+                                          width=max(1, int(round(2 * dpi / 72))))
+
+    return _crop(pil_image, layout)
+
+
+def write_png(filename: str, rgb: np.ndarray, compress_level: int = 1):
+    """
+    Write an RGB array to a PNG file
+
+    Args:
+        filename: output filename
+        rgb: RGB image as uint8, shape [height, width, 3]
+        compress_level: zlib compression level, low values are faster. Defaults to 1
+    """
+    Image.fromarray(rgb).save(filename, compress_level=compress_level)
+
+
+def make_sky_png(filename: str, image: np.ndarray, marked_bodies_lmn: Dict[str, Tuple[float, float, float]],
+                 **kwargs) -> str:
+    """
+    Render a sky image directly to a PNG file
+
+    Args:
+        filename: output filename
+        image: numpy array (two dimensions with data)
+        marked_bodies_lmn: dict with objects to annotate (values should be lmn coordinates)
+        **kwargs: other options to be passed to render_sky_image (e.g. vmin)
+
+    Returns:
+        str: filename
+    """
+    write_png(filename, render_sky_image(image, marked_bodies_lmn, **kwargs))
+    return filename
+
+
+def make_ground_png(filename: str, image: np.ndarray, background_map: np.ndarray, extent: List[float],
+                    **kwargs) -> str:
+    """
+    Render a ground image directly to a PNG file
+
+    Args:
+        filename: output filename
+        image: numpy array (two dimensions with data)
+        background_map: background map
+        extent: extent in metres
+        **kwargs: other options to be passed to render_ground_image (e.g. vmin)
+
+    Returns:
+        str: filename
+    """
+    write_png(filename, render_ground_image(image, background_map, extent, **kwargs))
+    return filename
@@ -9,8 +9,10 @@ obs000001          A group per observation (numbering is arbitrary)
   calibrated_data  Calibrated data as a full matrix of complex numbers
                    Same ordering as xst_data
   sky_img          Sky image data as matrix of real numbers
+  sky_img_Q        Sky images of further Stokes parameters (Q, U, V), if imaged
   ground_imgs      Group for ground images
     ground_img000  Ground image as matrix of real numbers
+    ground_img001  Ground images of further Stokes parameters, if imaged
 
 Per observation, the following attributes are used:
  * frequency       Frequency in Hz
@@ -26,13 +28,15 @@ Per observation, the following attributes are used:
                    [lon_min, lon_max, lat_min, lat_max]
  * height          Height (w.r.t. station phase centre) of the image plane in metres
  * subtracted      List of sources subtracted from visibilities
+ * stokes          Stokes parameter of the image, "I" if missing
 
  For sky images, the following attributes are used:
  * subtracted      List of sources subtracted from visibilities
+ * stokes          Stokes parameter of the image, "I" if missing
 """
 
 import datetime
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, Union
 import numpy as np
 import h5py
 
@@ -62,11 +66,12 @@ def get_new_obsname(h5file: h5py.File):
     return f"obs{new_obsnum:06d}"
 
 
-def write_hdf5(filename: str, xst_data: np.ndarray, visibilities: np.ndarray, sky_img: np.ndarray,
-               ground_img: np.ndarray, station_name: str, subband: int, rcu_mode: int, frequency: float,
+def write_hdf5(filename: str, xst_data: np.ndarray, visibilities: np.ndarray,
+               sky_img: Union[np.ndarray, Dict[str, np.ndarray]], ground_img: Union[np.ndarray, Dict[str, np.ndarray]],
+               station_name: str, subband: int, rcu_mode: int, frequency: float,
                obstime: datetime.datetime, extent: List[float], extent_lonlat: List[float],
                height: float, bodies_lmn: Dict[str, Tuple[float]], calibration_info: Dict[str, str],
-               subtracted: List[str]):
+               subtracted: List[str], stokes: str = "I"):
     """
     Write an HDF5 file with all data
 
@@ -74,8 +79,8 @@ def write_hdf5(filename: str, xst_data: np.ndarray, visibilities: np.ndarray, sk
         filename (str): Output filename. Will be appended to if a file already exists.
         xst_data (np.ndarray): Raw uncalibrated data (shape [n_ant, n_ant])
         visibilities (np.ndarray): Calibrated data (shape [n_ant, n_ant])
-        sky_img (np.ndarray): Sky image as array
-        ground_img (np.ndarray): Ground image as array
+        sky_img (np.ndarray): Sky image as array, or dict Stokes parameter -> sky image
+        ground_img (np.ndarray): Ground image as array, or dict Stokes parameter -> ground image
         station_name (str): Station name
         subband (int): Subband number
         rcu_mode (int): RCU mode
@@ -87,6 +92,7 @@ def write_hdf5(filename: str, xst_data: np.ndarray, visibilities: np.ndarray, sk
         bodies_lmn (Dict[str, Tuple[float]]): lmn coordinates of some objects on the sky
         calibration_info (Dict[str, str]): Calibration metadata
         subtracted (List[str]): List of sources subtracted
+        stokes (str): Stokes parameter of the sky and ground images if they are arrays. Defaults to "I"
 
     Returns:
         None
@@ -103,6 +109,10 @@ def write_hdf5(filename: str, xst_data: np.ndarray, visibilities: np.ndarray, sk
 
     if subtracted is None:
         subtracted = []
+    if not isinstance(sky_img, dict):
+        sky_img = {stokes: sky_img}
+    if not isinstance(ground_img, dict):
+        ground_img = {stokes: ground_img}
 
     with h5py.File(filename, 'a') as h5file:
         new_obsname = get_new_obsname(h5file)
@@ -119,15 +129,21 @@ def write_hdf5(filename: str, xst_data: np.ndarray, visibilities: np.ndarray, sk
         obs_group.create_dataset("calibrated_data", data=visibilities, compression="gzip")
         for key, value in calibration_info.items():
             obs_group["calibrated_data"].attrs[key] = value
-        dataset_sky_img = obs_group.create_dataset("sky_img", data=sky_img, compression="gzip")
-        dataset_sky_img.attrs["subtracted"] = subtracted
+        # The first Stokes parameter is stored as sky_img and ground_img000, the others next to them
+        for num, (parameter, img) in enumerate(sky_img.items()):
+            name = "sky_img" if num == 0 else f"sky_img_{parameter}"
+            dataset_sky_img = obs_group.create_dataset(name, data=img, compression="gzip")
+            dataset_sky_img.attrs["subtracted"] = subtracted if parameter == "I" else []
+            dataset_sky_img.attrs["stokes"] = parameter
 
         ground_img_group = obs_group.create_group("ground_images")
-        dataset_ground_img = ground_img_group.create_dataset("ground_img000", data=ground_img, compression="gzip")
-        dataset_ground_img.attrs["extent"] = extent
-        dataset_ground_img.attrs["extent_lonlat"] = extent_lonlat
-        dataset_ground_img.attrs["height"] = height
-        dataset_ground_img.attrs["subtracted"] = str(subtracted)
+        for num, (parameter, img) in enumerate(ground_img.items()):
+            dataset_ground_img = ground_img_group.create_dataset(f"ground_img{num:03d}", data=img, compression="gzip")
+            dataset_ground_img.attrs["extent"] = extent
+            dataset_ground_img.attrs["extent_lonlat"] = extent_lonlat
+            dataset_ground_img.attrs["height"] = height
+            dataset_ground_img.attrs["subtracted"] = str(subtracted if parameter == "I" else [])
+            dataset_ground_img.attrs["stokes"] = parameter
 
 
 def merge_hdf5(src_filename: str, dest_filename: str, obslist: List[str] = None):
@@ -1,14 +1,24 @@
 """Functions for working with LOFAR single station data"""
 
-from typing import Dict
+from typing import Dict, NamedTuple
 import numpy as np
 from numpy.linalg import norm, lstsq
 import numexpr as ne
+from scipy.ndimage import maximum_filter, map_coordinates
+from matplotlib.path import Path
 import numba
-from astropy.coordinates import SkyCoord, SkyOffsetFrame, CartesianRepresentation
+import erfa
+from astropy.coordinates import SkyCoord, SkyOffsetFrame, CartesianRepresentation, GCRS
+from astropy.time import Time
+import astropy.units as u
 
-__all__ = ["nearfield_imager", "sky_imager", "ground_imager", "skycoord_to_lmn", "calibrate", "simulate_sky_source",
-           "subtract_sources"]
+__all__ = ["nearfield_imager", "nearfield_imager_stokes", "nearfield_imager_batch", "sky_imager_stokes",
+           "sky_imager_batch", "stokes_visibilities",
+           "nearfield_imager_points", "nearfield_imager_roi", "polygon_mask",
+           "nearfield_imager_fresnel", "fresnel_phase_error_bound", "FresnelInfo",
+           "nearfield_steering_vectors", "nearfield_peak", "NearfieldPeak", "sky_imager", "ground_imager", "skycoord_to_lmn", "radec_to_lmn", "altaz_to_lmn",
+           "lmn_rotation_matrix", "itrs_to_gcrs_matrices", "enu_rotation_matrix", "station_zenith", "calibrate",
+           "simulate_sky_source", "subtract_sources"]
 
 __version__ = "1.5.0"
 SPEED_OF_LIGHT = 299792458.0
@@ -39,6 +49,154 @@ def skycoord_to_lmn(pos: SkyCoord, phasecentre: SkyCoord):
     return dc.y.value, dc.z.value, dc.x.value - 1
 
 
+def lmn_rotation_matrix(phasecentre: SkyCoord) -> np.ndarray:
+    """
+    Rotation matrix from direction cosines to l, m, n+1 relative to a phase centre.
+
+    The rows are the l, m and n axes expressed in the frame of the phase centre, so
+    `directions @ lmn_rotation_matrix(phasecentre).T` gives l, m, n+1 like skycoord_to_lmn.
+
+    Args:
+        phasecentre: phase centre, e.g. the station zenith in GCRS
+
+    Returns:
+        np.ndarray: rotation matrix, shape [3, 3]
+    """
+    ra0 = phasecentre.spherical.lon.rad
+    dec0 = phasecentre.spherical.lat.rad
+    return np.array([[-np.sin(ra0), np.cos(ra0), 0.],
+                     [-np.sin(dec0) * np.cos(ra0), -np.sin(dec0) * np.sin(ra0), np.cos(dec0)],
+                     [np.cos(dec0) * np.cos(ra0), np.cos(dec0) * np.sin(ra0), np.sin(dec0)]])
+
+
+def itrs_to_gcrs_matrices(times: Time) -> np.ndarray:
+    """
+    Rotation matrices from ITRS to GCRS (IAU 2006/2000A, polar motion ignored)
+
+    Args:
+        times: astropy Time, scalar or array
+
+    Returns:
+        np.ndarray: rotation matrices, shape [n_time, 3, 3]
+    """
+    times = Time(times).reshape(-1)
+    tt, ut1 = times.tt, times.ut1
+    # erfa gives celestial-to-terrestrial, its transpose is the inverse rotation
+    c2t = erfa.c2t06a(tt.jd1, tt.jd2, ut1.jd1, ut1.jd2, 0., 0.)
+    return np.swapaxes(c2t, -1, -2)
+
+
+def enu_rotation_matrix(station_xyz: np.ndarray) -> np.ndarray:
+    """
+    Rotation matrix from ITRS to local east, north, up at a station (WGS84 geodetic)
+
+    Args:
+        station_xyz: ITRF position of the station in metres
+
+    Returns:
+        np.ndarray: rotation matrix, shape [3, 3], rows are east, north and up in ITRS
+    """
+    lon, lat, _ = erfa.gc2gd(1, np.asarray(station_xyz, dtype=np.float64))
+    return np.array([[-np.sin(lon), np.cos(lon), 0.],
+                     [-np.sin(lat) * np.cos(lon), -np.sin(lat) * np.sin(lon), np.cos(lat)],
+                     [np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)]])
+
+
+def station_zenith(station_xyz: np.ndarray, obstime: Time) -> SkyCoord:
+    """
+    Zenith of a station in GCRS, the usual phase centre for sky images
+
+    Args:
+        station_xyz: ITRF position of the station in metres
+        obstime: observation time
+
+    Returns:
+        SkyCoord: zenith direction in GCRS
+    """
+    obstime = Time(obstime)
+    up_gcrs = itrs_to_gcrs_matrices(obstime)[0] @ enu_rotation_matrix(station_xyz)[2]
+    ra, dec = np.arctan2(up_gcrs[1], up_gcrs[0]), np.arcsin(up_gcrs[2])
+    return SkyCoord(ra=ra * u.rad, dec=dec * u.rad, frame=GCRS(obstime=obstime))
+
+
+def radec_to_lmn(ra: np.ndarray, dec: np.ndarray, phasecentre: SkyCoord, aberration: bool = True):
+    """
+    Convert ICRS ra, dec arrays of any shape (e.g. [n_sat, n_time]) into l, m, n relative to a phase centre.
+
+    This is a vectorized version of skycoord_to_lmn for many positions and one phase centre.
+    With a GCRS phase centre (like the station zenith), annual aberration and light deflection by the
+    Sun are applied at the obstime of the phase centre. The result agrees to within 1e-15 with transforming
+    the positions to GCRS at that obstime and projecting them. Without aberration the difference is up to 1e-4.
+
+    skycoord_to_lmn differs from this by up to 2e-4 (except near J2000): its SkyOffsetFrame does not
+    carry the obstime of the phase centre, so the positions are transformed with the default J2000 epoch.
+
+    Args:
+        ra: right ascension in degrees
+        dec: declination in degrees
+        phasecentre: phase centre, e.g. the station zenith in GCRS
+        aberration: apply aberration and light deflection for a GCRS phase centre. Defaults to True
+
+    Returns:
+        Tuple[np.ndarray]: l, m, n with the shape of ra and dec
+
+    Example:
+        >>> zenith = SkyCoord(ra=10 * u.deg, dec=50 * u.deg, frame="icrs")
+        >>> l, m, n = radec_to_lmn(np.array([10., 11.]), np.array([50., 50.]), zenith)
+        >>> float(round(l[1], 4)), float(round(m[1], 4))
+        (0.0112, 0.0001)
+    """
+    ra, dec = np.deg2rad(ra), np.deg2rad(dec)
+    directions = np.stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)], axis=-1)
+
+    if aberration and isinstance(getattr(phasecentre, "frame", phasecentre), GCRS):
+        tdb = phasecentre.obstime.tdb
+        astrom = erfa.apcg13(tdb.jd1, tdb.jd2)
+        directions = erfa.ldsun(directions, astrom["eh"], astrom["em"])
+        directions = erfa.ab(directions, astrom["v"], astrom["em"], astrom["bm1"])
+
+    lmn = directions @ lmn_rotation_matrix(phasecentre).T
+    return lmn[..., 0], lmn[..., 1], lmn[..., 2] - 1
+
+
+def altaz_to_lmn(alt: np.ndarray, az: np.ndarray, station_xyz: np.ndarray, obstime: Time,
+                 phasecentre: SkyCoord = None):
+    """
+    Convert topocentric alt, az arrays into l, m, n relative to a phase centre.
+
+    The last axis of alt and az is time if obstime is an array, e.g. shape [n_sat, n_time]. The rotation
+    matrices are computed once per time. The result agrees with skycoord_to_lmn on AltAz coordinates to
+    within 2e-5 (diurnal aberration and polar motion are ignored).
+
+    Args:
+        alt: altitude in degrees
+        az: azimuth in degrees (east of north)
+        station_xyz: ITRF position of the station in metres, e.g. db.phase_centres[station_name]
+        obstime: observation time(s)
+        phasecentre: phase centre. Defaults to the station zenith at the (first) observation time
+
+    Returns:
+        Tuple[np.ndarray]: l, m, n with the shape of alt and az
+    """
+    obstime = Time(obstime)
+    alt, az = np.deg2rad(alt), np.deg2rad(az)
+    enu = np.stack([np.cos(alt) * np.sin(az), np.cos(alt) * np.cos(az), np.sin(alt)], axis=-1)
+    directions_itrs = enu @ enu_rotation_matrix(station_xyz)
+
+    itrs_to_gcrs = itrs_to_gcrs_matrices(obstime)
+    if obstime.isscalar:
+        directions = directions_itrs @ itrs_to_gcrs[0].T
+    else:
+        directions = np.einsum("tij,...tj->...ti", itrs_to_gcrs, directions_itrs)
+
+    if phasecentre is None:
+        phasecentre = station_zenith(station_xyz, obstime.reshape(-1)[0])
+    elif not isinstance(getattr(phasecentre, "frame", phasecentre), GCRS):
+        phasecentre = phasecentre.transform_to(GCRS(obstime=obstime.reshape(-1)[0]))
+    lmn = directions @ lmn_rotation_matrix(phasecentre).T
+    return lmn[..., 0], lmn[..., 1], lmn[..., 2] - 1
+
+
 @numba.jit(parallel=True, fastmath=True, nopython=True)
 def sky_imager(visibilities, baselines, freq, npix_l, npix_m):
     """
@@ -85,7 +243,7 @@ def ground_imager(visibilities, freq, npix_p, npix_q, dims, station_pqr, height=
 
 
 def nearfield_imager(visibilities, baseline_indices, freqs, npix_p, npix_q, extent, station_pqr, height=1.5,
-                     max_memory_mb=200):
+                     max_memory_mb=200, engine="exact"):
     """
     Nearfield imager
 
@@ -99,10 +257,20 @@ def nearfield_imager(visibilities, baseline_indices, freqs, npix_p, npix_q, exte
         station_pqr: PQR coordinates of stations
         height: Height of image in metre
         max_memory_mb: Maximum amount of memory to use for the biggest array. Higher may improve performance.
+        engine: "exact" for the exact spherical wavefronts, or "fresnel" for the Fresnel approximation outside
+                the distance where its phase error is small (see nearfield_imager_fresnel), which is much faster
+                for images that are hundreds of metres or more across. Defaults to "exact"
 
     Returns:
         np.array(complex): Complex valued array of shape [npix_p, npix_q]
     """
+    if engine == "fresnel":
+        img, _ = nearfield_imager_fresnel(visibilities, baseline_indices, freqs, npix_p, npix_q, extent,
+                                          station_pqr, height=height, max_memory_mb=max_memory_mb)
+        return img
+    elif engine != "exact":
+        raise ValueError(f"Unknown engine {engine}, should be 'exact' or 'fresnel'")
+
     z = height
     x = np.linspace(extent[0], extent[1], npix_p)
     y = np.linspace(extent[2], extent[3], npix_q)
@@ -139,6 +307,643 @@ def nearfield_imager(visibilities, baseline_indices, freqs, npix_p, npix_q, exte
     return img
 
 
+def nearfield_steering_vectors(points, freq, station_pqr):
+    """
+    Response of the antennas to a source at the given points, for near-field imaging
+
+    The near-field image at a point x is a^H V a, with a the steering vector of x and V
+    the visibility matrix, which is the same sum as in nearfield_imager.
+
+    Args:
+        points: Positions in the same coordinates as station_pqr, shape [..., 3]
+        freq: Frequency in Hz
+        station_pqr: Positions of the antennas, shape [num_antennas, 3]
+
+    Returns:
+        np.array(complex): Steering vectors exp(-2 pi i d / lambda), with d the distance from each point to each
+        antenna, shape [..., num_antennas]
+    """
+    points = np.asarray(points, dtype=np.float64)
+    distances = np.linalg.norm(points[..., None, :] - station_pqr, axis=-1)
+    minus_j2pi_over_lamb = -2j * np.pi * freq / SPEED_OF_LIGHT
+    return ne.evaluate("exp(minus_j2pi_over_lamb * distances)")
+
+
+def _visibility_matrix(visibilities, baseline_indices, n_ant):
+    """Visibilities of one frequency as matrix, such that the nearfield sum over baselines is a^H M a"""
+    vis_matrix = np.zeros((n_ant, n_ant), dtype=np.complex128)
+    np.add.at(vis_matrix, (baseline_indices[:, 0], baseline_indices[:, 1]), visibilities)
+    return vis_matrix
+
+
+def nearfield_imager_points(visibilities, baseline_indices, freqs, points, station_pqr, max_memory_mb=200):
+    """
+    Nearfield imager for an arbitrary list of points
+
+    Gives the same values as nearfield_imager, but only at the given points. The visibilities are put in a
+    matrix M per frequency, so that the sum over baselines is a^H M a with a the steering vectors of a point
+    (see nearfield_steering_vectors). That takes one complex exponential per antenna instead of one per baseline
+    for each point. The points are evaluated in chunks, such that the steering vectors of a chunk use at most
+    max_memory_mb.
+
+    Args:
+        visibilities: Numpy array with visibilities, shape [num_visibilities x num_frequencies]
+        baseline_indices: List with tuples of antenna numbers in visibilities, shape [num_visibilities x 2]
+        freqs: List of frequencies
+        points: Positions in the same coordinates as station_pqr, shape [num_points, 3]
+        station_pqr: PQR coordinates of stations
+        max_memory_mb: Maximum amount of memory to use for the biggest array. Higher may improve performance.
+
+    Returns:
+        np.array(complex): Complex valued array of shape [num_points]
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    baseline_indices = np.asarray(baseline_indices)
+    n_ant = len(station_pqr)
+
+    values = np.zeros(len(points), dtype=np.complex128)
+    for ifreq, freq in enumerate(freqs):
+        vis_matrix = _visibility_matrix(visibilities[:, ifreq], baseline_indices, n_ant)
+        values += _nearfield_matrices_at_points(vis_matrix[np.newaxis], points, freq, station_pqr, max_memory_mb)[0]
+    values /= len(freqs) * len(baseline_indices)
+    return values
+
+
+def _nearfield_matrices_at_points(vis_matrices, points, freq, station_pqr, max_memory_mb=200):
+    """
+    a^H M a for a stack of visibility matrices M, at each point; the steering vectors a are computed once per point
+
+    Args:
+        vis_matrices: visibility matrices, shape [num_matrices, num_antennas, num_antennas]
+        points: Positions, shape [num_points, 3]
+        freq: Frequency in Hz
+        station_pqr: PQR coordinates of stations
+        max_memory_mb: Maximum amount of memory to use for the biggest array
+
+    Returns:
+        np.array(complex): shape [num_matrices, num_points]
+    """
+    n_matrices, n_ant, _ = vis_matrices.shape
+    # All matrices side by side, so that one matrix product serves all of them
+    vis_side_by_side = np.transpose(vis_matrices, (1, 0, 2)).reshape(n_ant, n_matrices * n_ant)
+    # The steering vectors and their product with the visibility matrices
+    chunksize = max(max_memory_mb * 1024 * 1024 // (16 * (1 + n_matrices) * n_ant), 1)
+
+    values = np.empty((n_matrices, len(points)), dtype=np.complex128)
+    for start in range(0, len(points), chunksize):
+        steering = nearfield_steering_vectors(points[start:start + chunksize], freq, station_pqr)
+        product = (steering.conj() @ vis_side_by_side).reshape(len(steering), n_matrices, n_ant)
+        values[:, start:start + chunksize] = np.einsum("pmi,pi->mp", product, steering)
+    return values
+
+
+def polygon_mask(polygons, npix_p, npix_q, extent):
+    """
+    Mask of the pixels of the nearfield_imager grid inside one or more polygons
+
+    Args:
+        polygons: Polygon as array of (p, q) vertices in metres, shape [num_vertices, 2], or a list of them
+        npix_p: Number of pixels in p-direction
+        npix_q: Number of pixels in q-direction
+        extent: Extent (in m) that the image spans
+
+    Returns:
+        np.array(bool): True inside any of the polygons, shape [npix_q, npix_p]
+
+    Example:
+        >>> lab = [(20, 30), (45, 30), (45, 50), (20, 50)]
+        >>> polygon_mask(lab, 150, 150, [-150, 150, -150, 150]).sum()
+        120
+    """
+    if np.ndim(polygons[0]) == 1:
+        polygons = [polygons]
+    x = np.linspace(extent[0], extent[1], npix_p)
+    y = np.linspace(extent[2], extent[3], npix_q)
+    posx, posy = np.meshgrid(x, y)
+    pixels = np.stack([posx.ravel(), posy.ravel()], axis=1)
+
+    mask = np.zeros(len(pixels), dtype=bool)
+    for polygon in polygons:
+        # A tiny radius, so that pixels on the edges are included
+        mask |= Path(np.asarray(polygon, dtype=np.float64)[:, :2]).contains_points(pixels, radius=1e-9)
+    return mask.reshape(npix_q, npix_p)
+
+
+def nearfield_imager_roi(visibilities, baseline_indices, freqs, npix_p, npix_q, extent, station_pqr, height=1.5,
+                         mask=None, polygons=None, max_memory_mb=200):
+    """
+    Nearfield imager for a region of interest of the nearfield_imager grid
+
+    Only the pixels in the mask (or inside the polygons) are evaluated, see nearfield_imager_points.
+
+    Args:
+        visibilities: Numpy array with visibilities, shape [num_visibilities x num_frequencies]
+        baseline_indices: List with tuples of antenna numbers in visibilities, shape [num_visibilities x 2]
+        freqs: List of frequencies
+        npix_p: Number of pixels in p-direction
+        npix_q: Number of pixels in q-direction
+        extent: Extent (in m) that the image should span
+        station_pqr: PQR coordinates of stations
+        height: Height of image in metre
+        mask: Pixels to evaluate, boolean array of shape [npix_q, npix_p]
+        polygons: Instead of mask: polygon or list of polygons (see polygon_mask) with the pixels to evaluate
+        max_memory_mb: Maximum amount of memory to use for the biggest array. Higher may improve performance.
+
+    Returns:
+        np.ma.MaskedArray(complex): Image of shape [npix_q, npix_p], masked outside the region of interest
+    """
+    if mask is None:
+        if polygons is None:
+            raise ValueError("Give a mask or polygons")
+        mask = polygon_mask(polygons, npix_p, npix_q, extent)
+    mask = np.asarray(mask, dtype=bool)
+    if mask.shape != (npix_q, npix_p):
+        raise ValueError(f"Mask should have shape {(npix_q, npix_p)}, got {mask.shape}")
+
+    x = np.linspace(extent[0], extent[1], npix_p)
+    y = np.linspace(extent[2], extent[3], npix_q)
+    q_ix, p_ix = np.nonzero(mask)
+    points = np.stack([x[p_ix], y[q_ix], np.full(len(p_ix), float(height))], axis=1)
+
+    img = np.zeros((npix_q, npix_p), dtype=np.complex128)
+    img[q_ix, p_ix] = nearfield_imager_points(visibilities, baseline_indices, freqs, points, station_pqr,
+                                              max_memory_mb=max_memory_mb)
+    return np.ma.MaskedArray(img, mask=~mask)
+
+
+class FresnelInfo(NamedTuple):
+    """How nearfield_imager_fresnel made an image"""
+    phase_error_bound: float  # maximum phase error (rad) of the Fresnel approximation of any pixel and baseline
+    exact_radius: float       # pixels closer than this (m) to the station centre were imaged exactly
+    n_exact_pixels: int       # number of pixels imaged exactly
+    n_polar_samples: int      # number of samples of the polar grid for the other pixels
+
+
+def _antenna_offsets(station_pqr, height):
+    """Horizontal antenna positions and their distances to the image plane (not in the horizontal plane)"""
+    station_pqr = np.asarray(station_pqr, dtype=np.float64)
+    horizontal = station_pqr[:, :2]
+    effective_radius = np.sqrt(np.sum(horizontal ** 2, axis=1) + (height - station_pqr[:, 2]) ** 2)
+    return horizontal, effective_radius
+
+
+def fresnel_phase_error_bound(distance, freq, station_pqr, height=1.5):
+    """
+    Upper bound of the phase error of the Fresnel approximation in nearfield_imager_fresnel
+
+    For an antenna at distance r from the horizontal projection of the station centre, taking into account the
+    height of the image plane, the distance to a pixel at horizontal distance R is approximated to second order
+    in r / R. The remainder is at most r^3 / (2 R^2 (1 - r / R)); a baseline has the remainder of two antennas.
+
+    Args:
+        distance: Horizontal distance (m) of the pixel to the station centre
+        freq: Frequency in Hz
+        station_pqr: PQR coordinates of stations
+        height: Height of image in metre. Defaults to 1.5
+
+    Returns:
+        float: phase error bound in radians, inf if the distance is within the station
+    """
+    _, effective_radius = _antenna_offsets(station_pqr, height)
+    r_max = effective_radius.max()
+    if distance <= r_max:
+        return np.inf
+    return 2 * np.pi * freq / SPEED_OF_LIGHT * r_max ** 3 / (distance ** 2 * (1 - r_max / distance))
+
+
+def _fresnel_polar_image(vis_matrix, freq, horizontal, effective_radius, theta_range, distance_range, oversample,
+                         max_memory_mb):
+    """
+    The Fresnel approximation of the nearfield sum on a polar grid, uniform in angle and in 1 / (2 * distance)
+
+    With u = 1 / (2 R) and rho the horizontal unit vector in direction theta, the distance of an antenna is
+    R - rho . r + u * q(theta), with q = |r_eff|^2 - (rho . r)^2. The constant R drops out of the sum, so the
+    image is band-limited in theta and in u; the grid samples it at oversample times the Nyquist rate.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: complex image [n_theta, n_u], theta samples, u samples
+    """
+    k = 2 * np.pi * freq / SPEED_OF_LIGHT
+    u_min, u_max = 1 / (2 * distance_range[1]), 1 / (2 * distance_range[0])
+    r_max = effective_radius.max()
+
+    # Highest rate of change of a baseline phase, per radian and per unit of u
+    theta_bandwidth = (2 * k * r_max + 4 * k * u_max * r_max ** 2) / (2 * np.pi)
+    u_bandwidth = k * r_max ** 2 / (2 * np.pi)
+    # Two extra samples on each side for the cubic interpolation
+    d_theta = 1 / (2 * theta_bandwidth * oversample)
+    thetas = np.arange(theta_range[0] - 2 * d_theta, theta_range[1] + 3 * d_theta, d_theta)
+    d_u = 1 / (2 * u_bandwidth * oversample)
+    us = np.arange(u_min - 2 * d_u, u_max + 3 * d_u, d_u)
+
+    n_ant = len(horizontal)
+    img = np.zeros((len(thetas), len(us)), dtype=np.complex128)
+    chunksize = max(max_memory_mb * 1024 * 1024 // (16 * 2 * n_ant * len(us)), 1)
+    j2pi_over_lamb = 1j * k
+    for start in range(0, len(thetas), chunksize):
+        theta = thetas[start:start + chunksize]
+        rho = np.stack([np.cos(theta), np.sin(theta)], axis=1)
+        projection = rho @ horizontal.T
+        q = effective_radius ** 2 - projection ** 2
+        u = us[None, :, None]
+        # Steering vectors exp(-2 pi i d / lambda) without the common phase of R, shape [theta, u, antenna]
+        steering = ne.evaluate("exp(j2pi_over_lamb * (projection3 - u * q3))",
+                               local_dict={"j2pi_over_lamb": j2pi_over_lamb, "u": u,
+                                           "projection3": projection[:, None, :], "q3": q[:, None, :]})
+        img[start:start + chunksize] = np.einsum("tui,tui->tu", steering.conj() @ vis_matrix, steering)
+    return img, thetas, us
+
+
+def nearfield_imager_fresnel(visibilities, baseline_indices, freqs, npix_p, npix_q, extent, station_pqr,
+                             height=1.5, exact_radius=None, max_phase_error=np.pi / 8, oversample=8,
+                             max_memory_mb=200):
+    """
+    Nearfield imager with the Fresnel approximation for pixels far enough from the station
+
+    Far from the station, the near-field image varies slowly with distance: to second order in (antenna
+    offset / distance) the image in a direction theta is a sum of Fresnel terms in u = 1 / (2 * distance). The
+    image is evaluated on a polar grid in theta and u that samples it at oversample times its Nyquist rate, and
+    interpolated (cubic) to the pixels. The cost then depends on the size of the station and the range of
+    distances, not on the number of pixels, so kilometre-wide images take about as long as small ones.
+
+    Pixels within exact_radius of the station centre are imaged exactly with nearfield_imager_points. By default
+    exact_radius is where the phase error bound (see fresnel_phase_error_bound) reaches max_phase_error; the
+    default pi / 8 is the same criterion as for the Fraunhofer distance 2 D^2 / lambda.
+
+    Args:
+        visibilities: Numpy array with visibilities, shape [num_visibilities x num_frequencies]
+        baseline_indices: List with tuples of antenna numbers in visibilities, shape [num_visibilities x 2]
+        freqs: List of frequencies
+        npix_p: Number of pixels in p-direction
+        npix_q: Number of pixels in q-direction
+        extent: Extent (in m) that the image should span
+        station_pqr: PQR coordinates of stations, with the station centre at the origin
+        height: Height of image in metre. Defaults to 1.5
+        exact_radius: Image pixels within this horizontal distance (m) exactly. Defaults to the distance where
+                      the phase error bound is max_phase_error at the highest frequency
+        max_phase_error: Phase error (rad) that determines the default exact_radius. Defaults to pi / 8
+        oversample: Sampling of the polar grid relative to the Nyquist rate. Defaults to 8
+        max_memory_mb: Maximum amount of memory to use for the biggest array. Defaults to 200
+
+    Returns:
+        Tuple[np.array(complex), FresnelInfo]: image of shape [npix_q, npix_p] (as nearfield_imager), and the
+        phase error bound, exact radius and number of evaluations
+    """
+    baseline_indices = np.asarray(baseline_indices)
+    station_pqr = np.asarray(station_pqr, dtype=np.float64)
+    horizontal, effective_radius = _antenna_offsets(station_pqr, height)
+    r_max = effective_radius.max()
+    freq_max = max(freqs)
+
+    if exact_radius is None:
+        # The bound decreases with distance; bisect for the distance where it equals max_phase_error
+        low, high = r_max, r_max * 2
+        while fresnel_phase_error_bound(high, freq_max, station_pqr, height) > max_phase_error:
+            low, high = high, high * 2
+        for _ in range(50):
+            middle = (low + high) / 2
+            if fresnel_phase_error_bound(middle, freq_max, station_pqr, height) > max_phase_error:
+                low = middle
+            else:
+                high = middle
+        exact_radius = high
+    exact_radius = max(exact_radius, r_max * 1.01)
+
+    x = np.linspace(extent[0], extent[1], npix_p)
+    y = np.linspace(extent[2], extent[3], npix_q)
+    posx, posy = np.meshgrid(x, y)
+    distances = np.hypot(posx, posy)
+    exact = distances < exact_radius
+
+    img = np.zeros((npix_q, npix_p), dtype=np.complex128)
+    if exact.any():
+        points = np.stack([posx[exact], posy[exact], np.full(exact.sum(), float(height))], axis=1)
+        img[exact] = nearfield_imager_points(visibilities, baseline_indices, freqs, points, station_pqr,
+                                             max_memory_mb=max_memory_mb)
+
+    far = ~exact
+    n_polar_samples = 0
+    phase_error_bound = 0.
+    if far.any():
+        far_distances = distances[far]
+        thetas_far = np.arctan2(posy[far], posx[far])
+        # Avoid a polar grid around the full circle for images on one side of the station
+        if thetas_far.max() - thetas_far.min() > np.pi:
+            thetas_far = np.mod(thetas_far, 2 * np.pi)
+        theta_range = (thetas_far.min(), thetas_far.max())
+        distance_range = (far_distances.min(), far_distances.max())
+        phase_error_bound = fresnel_phase_error_bound(distance_range[0], freq_max, station_pqr, height)
+
+        n_ant = len(station_pqr)
+        for ifreq, freq in enumerate(freqs):
+            vis_matrix = _visibility_matrix(visibilities[:, ifreq], baseline_indices, n_ant)
+            polar_img, thetas, us = _fresnel_polar_image(vis_matrix, freq, horizontal, effective_radius,
+                                                         theta_range, distance_range, oversample, max_memory_mb)
+            n_polar_samples += polar_img.size
+            coordinates = np.array([(thetas_far - thetas[0]) / (thetas[1] - thetas[0]),
+                                    (1 / (2 * far_distances) - us[0]) / (us[1] - us[0])])
+            img[far] += (map_coordinates(polar_img.real, coordinates, order=3) +
+                         1j * map_coordinates(polar_img.imag, coordinates, order=3))
+        img[far] /= len(freqs) * len(baseline_indices)
+
+    return img, FresnelInfo(phase_error_bound=float(phase_error_bound), exact_radius=float(exact_radius),
+                            n_exact_pixels=int(exact.sum()), n_polar_samples=n_polar_samples)
+
+
+class NearfieldPeak(NamedTuple):
+    """Result of nearfield_peak"""
+    p: float            # position of the peak in p (m)
+    q: float            # position of the peak in q (m)
+    power: float        # real part of the near-field image at the peak
+    p_pix: float        # position of the peak in pixels of the nearfield_imager grid, fractional with subpixel
+    q_pix: float
+    n_evaluations: int  # number of points where the image was evaluated
+
+
+def nearfield_peak(visibilities, baseline_indices, freqs, npix_p, npix_q, extent, station_pqr, height=1.5,
+                   coarse_step=4, top_k=4, subpixel=True, max_memory_mb=200):
+    """
+    Find the maximum of the near-field image without computing the full image
+
+    The image is evaluated on every coarse_step-th pixel of the nearfield_imager grid. From the top_k local
+    maxima of that coarse image, the step is halved until it is one pixel, each time moving to the best of the
+    eight neighbours. With subpixel, a parabola through the neighbours of the best pixel gives a position between
+    pixels, where the image is evaluated once more. This typically takes a few percent of the pixel evaluations of
+    the full image.
+
+    As in nearfield_imager, the pixels span the extent including both ends (np.linspace): pixel i in p is at
+    extent[0] + i * (extent[1] - extent[0]) / (npix_p - 1).
+
+    Args:
+        visibilities: Numpy array with visibilities, shape [num_visibilities x num_frequencies]
+        baseline_indices: List with tuples of antenna numbers in visibilities, shape [num_visibilities x 2]
+        freqs: List of frequencies
+        npix_p: Number of pixels in p-direction
+        npix_q: Number of pixels in q-direction
+        extent: Extent (in m) that the image should span
+        station_pqr: PQR coordinates of stations
+        height: Height of image in metre. Defaults to 1.5
+        coarse_step: Pixel step of the coarse image. Defaults to 4
+        top_k: Number of maxima of the coarse image that are refined. Defaults to 4
+        subpixel: Refine the position between pixels. Defaults to True
+        max_memory_mb: Maximum amount of memory to use for the biggest array. Defaults to 200
+
+    Returns:
+        NearfieldPeak
+
+    Example:
+        A point source at p = 30 m, q = -20 m, 1.5 m high, seen by a 5 x 5 grid of antennas 10 m apart:
+
+        >>> p, q = np.meshgrid(np.arange(-20., 21, 10), np.arange(-20., 21, 10))
+        >>> station_pqr = np.stack([p.ravel(), q.ravel(), np.zeros(p.size)], axis=1)
+        >>> freq = 50e6
+        >>> distances = np.linalg.norm(station_pqr - [30, -20, 1.5], axis=1)
+        >>> steering = np.exp(-2j * np.pi * freq * distances / SPEED_OF_LIGHT)
+        >>> baseline_indices = np.array(np.tril_indices(len(steering)))
+        >>> visibilities = np.outer(steering, steering.conj())[tuple(baseline_indices)][:, np.newaxis]
+        >>> peak = nearfield_peak(visibilities, baseline_indices.T, [freq], 101, 101, [-100, 100, -100, 100],
+        ...                       station_pqr)
+        >>> print(f"{peak.p:.1f} {peak.q:.1f}")
+        30.0 -20.0
+    """
+    pix_size_p = (extent[1] - extent[0]) / max(npix_p - 1, 1)
+    pix_size_q = (extent[3] - extent[2]) / max(npix_q - 1, 1)
+    evaluated = {}
+
+    def evaluate(pixels):
+        """Real part of the image at (q_pix, p_pix) pixels, only the ones that were not evaluated before"""
+        new_pixels = [pixel for pixel in dict.fromkeys(pixels) if pixel not in evaluated]
+        if new_pixels:
+            pixels_array = np.array(new_pixels, dtype=np.float64)
+            points = np.stack([extent[0] + pixels_array[:, 1] * pix_size_p,
+                               extent[2] + pixels_array[:, 0] * pix_size_q,
+                               np.full(len(new_pixels), float(height))], axis=1)
+            values = nearfield_imager_points(visibilities, baseline_indices, freqs, points, station_pqr,
+                                             max_memory_mb)
+            evaluated.update(zip(new_pixels, values.real))
+        return np.array([evaluated[pixel] for pixel in pixels])
+
+    # Coarse image, including the last row and column
+    coarse_q = np.unique(np.append(np.arange(0, npix_q, coarse_step), npix_q - 1))
+    coarse_p = np.unique(np.append(np.arange(0, npix_p, coarse_step), npix_p - 1))
+    coarse_pixels = [(int(q_ix), int(p_ix)) for q_ix in coarse_q for p_ix in coarse_p]
+    coarse_img = evaluate(coarse_pixels).reshape(len(coarse_q), len(coarse_p))
+
+    local_max = coarse_img == maximum_filter(coarse_img, size=3, mode="nearest")
+    candidates = np.argwhere(local_max)
+    candidates = candidates[np.argsort(coarse_img[local_max])[::-1][:top_k]]
+
+    neighbours = [(dq, dp) for dq in (-1, 0, 1) for dp in (-1, 0, 1)]
+    best_pixel, best_value = None, -np.inf
+    for coarse_q_ix, coarse_p_ix in candidates:
+        pixel = (int(coarse_q[coarse_q_ix]), int(coarse_p[coarse_p_ix]))
+        step = max(coarse_step // 2, 1)
+        while True:
+            around = [(min(max(pixel[0] + dq * step, 0), npix_q - 1), min(max(pixel[1] + dp * step, 0), npix_p - 1))
+                      for dq, dp in neighbours]
+            new_pixel = around[int(np.argmax(evaluate(around)))]
+            if new_pixel != pixel:
+                pixel = new_pixel
+            elif step > 1:
+                step //= 2
+            else:
+                break
+        if evaluated[pixel] > best_value:
+            best_pixel, best_value = pixel, evaluated[pixel]
+
+    q_pix, p_pix = float(best_pixel[0]), float(best_pixel[1])
+    if subpixel:
+        offsets = []
+        for axis, npix in ((0, npix_q), (1, npix_p)):
+            if not 0 < best_pixel[axis] < npix - 1:
+                offsets.append(0.)
+                continue
+            lower, upper = list(best_pixel), list(best_pixel)
+            lower[axis] -= 1
+            upper[axis] += 1
+            f_lower, f_upper = evaluate([tuple(lower), tuple(upper)])
+            curvature = f_lower - 2 * best_value + f_upper
+            offsets.append(float(np.clip(0.5 * (f_lower - f_upper) / curvature, -0.5, 0.5)) if curvature < 0 else 0.)
+        if any(offsets):
+            subpixel_pixel = (q_pix + offsets[0], p_pix + offsets[1])
+            subpixel_value = evaluate([subpixel_pixel])[0]
+            if subpixel_value > best_value:
+                (q_pix, p_pix), best_value = subpixel_pixel, subpixel_value
+
+    return NearfieldPeak(p=extent[0] + p_pix * pix_size_p, q=extent[2] + q_pix * pix_size_q, power=float(best_value),
+                         p_pix=p_pix, q_pix=q_pix, n_evaluations=len(evaluated))
+
+
+def stokes_visibilities(visibilities, stokes="IQUV"):
+    """
+    Stokes visibility matrices from the visibilities of all RCUs
+
+    The X and Y dipoles are the even and odd RCUs. With the correlations XX, XY, YX and YY between the antennas,
+    I = XX + YY, Q = XX - YY, U = XY + YX and V = -i (XY - YX), in the frame of the dipoles. All four are Hermitian,
+    so they image like Stokes I.
+
+    Args:
+        visibilities: Numpy array with visibilities of all RCUs, shape [2 * num_antennas, 2 * num_antennas]
+        stokes: Stokes parameters, any of "I", "Q", "U", "V". Defaults to "IQUV"
+
+    Returns:
+        np.array(complex): visibility matrices, shape [len(stokes), num_antennas, num_antennas]
+
+    Example:
+        Two antennas that see an unpolarised source, XX = YY and no XY:
+
+        >>> visibilities = np.kron(np.array([[2, 1], [1, 2]]), np.eye(2))
+        >>> visibilities_stokes_i, visibilities_stokes_v = stokes_visibilities(visibilities, "IV")
+        >>> visibilities_stokes_i.real
+        array([[4., 2.],
+               [2., 4.]])
+        >>> print(np.abs(visibilities_stokes_v).max())
+        0.0
+    """
+    xx = visibilities[0::2, 0::2]
+    xy = visibilities[0::2, 1::2]
+    yx = visibilities[1::2, 0::2]
+    yy = visibilities[1::2, 1::2]
+    products = {"I": lambda: xx + yy, "Q": lambda: xx - yy, "U": lambda: xy + yx, "V": lambda: -1j * (xy - yx)}
+    unknown = set(stokes) - set(products)
+    if unknown:
+        raise ValueError(f"Unknown Stokes parameters {''.join(sorted(unknown))}, should be in IQUV")
+    return np.array([products[parameter]() for parameter in stokes])
+
+
+def sky_imager_batch(vis_matrices, baselines, freq, npix_l, npix_m, max_memory_mb=200):
+    """
+    Sky images of several visibility matrices of the same station and frequency in one pass
+
+    Per pixel, the phases of the antennas are computed once and applied to all visibility matrices, e.g. the
+    time steps of an observation or the Stokes parameters. Each image is the same as sky_imager of that matrix.
+
+    Args:
+        vis_matrices: Numpy array with visibility matrices, shape [num_matrices, num_antennas, num_antennas]
+        baselines: Numpy array with distances between antennas, shape [num_antennas, num_antennas, 3]
+        freq: frequency
+        npix_l: Number of pixels in l-direction
+        npix_m: Number of pixels in m-direction
+        max_memory_mb: Maximum amount of memory to use for the biggest array. Defaults to 200
+
+    Returns:
+        np.array(float): Real valued array of shape [num_matrices, npix_m, npix_l]
+    """
+    vis_matrices = np.asarray(vis_matrices)
+    n_matrices, n_ant, _ = vis_matrices.shape
+    # Antenna positions relative to the first antenna, that is all sky_imager uses from the baselines
+    positions = -baselines[0]
+
+    # The same grid as sky_imager
+    m = -1 + np.arange(npix_m) * 2 / npix_m
+    l = 1 - np.arange(npix_l) * 2 / npix_l
+    m_grid, l_grid = np.meshgrid(m, l, indexing="ij")
+    n_grid = np.sqrt(1 - l_grid ** 2 - m_grid ** 2, where=l_grid ** 2 + m_grid ** 2 <= 1,
+                     out=np.full_like(l_grid, np.nan)) - 1
+    lmn = np.stack([l_grid.ravel(), m_grid.ravel(), n_grid.ravel()], axis=1)
+    above_horizon = np.isfinite(lmn[:, 2])
+
+    vis_side_by_side = np.transpose(vis_matrices, (1, 0, 2)).reshape(n_ant, n_matrices * n_ant)
+    chunksize = max(max_memory_mb * 1024 * 1024 // (16 * (1 + n_matrices) * n_ant), 1)
+    minus_j2pi_over_lamb = -2j * np.pi * freq / SPEED_OF_LIGHT
+    pixels = np.flatnonzero(above_horizon)
+    images = np.full((n_matrices, len(lmn)), np.nan)
+    for start in range(0, len(pixels), chunksize):
+        chunk = pixels[start:start + chunksize]
+        path_lengths = lmn[chunk] @ positions.T
+        phasors = ne.evaluate("exp(minus_j2pi_over_lamb * path_lengths)")
+        product = (phasors @ vis_side_by_side).reshape(len(chunk), n_matrices, n_ant)
+        images[:, chunk] = np.einsum("pmi,pi->mp", product, phasors.conj()).real / n_ant ** 2
+
+    return images.reshape(n_matrices, npix_m, npix_l)
+
+
+def sky_imager_stokes(visibilities, baselines, freq, npix_l, npix_m, stokes="IQUV", max_memory_mb=200):
+    """
+    Sky images of several Stokes parameters in one pass
+
+    Per pixel, the phases of the antennas are computed once and applied to all Stokes visibility matrices, so
+    all four cost little more than one. Each image is the same as sky_imager of the Stokes visibilities.
+
+    Args:
+        visibilities: Numpy array with visibilities of all RCUs, shape [2 * num_antennas, 2 * num_antennas]
+        baselines: Numpy array with distances between antennas, shape [num_antennas, num_antennas, 3]
+        freq: frequency
+        npix_l: Number of pixels in l-direction
+        npix_m: Number of pixels in m-direction
+        stokes: Stokes parameters, see stokes_visibilities. Defaults to "IQUV"
+        max_memory_mb: Maximum amount of memory to use for the biggest array. Defaults to 200
+
+    Returns:
+        Dict[str, np.array(float)]: Stokes parameter -> real valued array of shape [npix_m, npix_l]
+    """
+    images = sky_imager_batch(stokes_visibilities(visibilities, stokes), baselines, freq, npix_l, npix_m,
+                              max_memory_mb=max_memory_mb)
+    return dict(zip(stokes, images))
+
+
+def nearfield_imager_batch(vis_matrices, freq, npix_p, npix_q, extent, station_pqr, height=1.5, max_memory_mb=200):
+    """
+    Near-field images of several visibility matrices of the same station and frequency in one pass
+
+    Per pixel, the steering vectors are computed once and applied to all visibility matrices, e.g. the Stokes
+    parameters. Each image is the same as the ground image of make_xst_plots for that matrix, i.e. twice the real
+    part of nearfield_imager of its lower triangular part.
+
+    Args:
+        vis_matrices: Numpy array with visibility matrices, shape [num_matrices, num_antennas, num_antennas]
+        freq: Frequency in Hz
+        npix_p: Number of pixels in p-direction
+        npix_q: Number of pixels in q-direction
+        extent: Extent (in m) that the image should span
+        station_pqr: PQR coordinates of the antennas
+        height: Height of image in metre. Defaults to 1.5
+        max_memory_mb: Maximum amount of memory to use for the biggest array. Defaults to 200
+
+    Returns:
+        np.array(float): Real valued array of shape [num_matrices, npix_q, npix_p]
+    """
+    vis_matrices = np.tril(np.asarray(vis_matrices))
+    n_matrices, n_ant, _ = vis_matrices.shape
+
+    x = np.linspace(extent[0], extent[1], npix_p)
+    y = np.linspace(extent[2], extent[3], npix_q)
+    posx, posy = np.meshgrid(x, y)
+    points = np.stack([posx.ravel(), posy.ravel(), np.full(posx.size, float(height))], axis=1)
+
+    values = _nearfield_matrices_at_points(vis_matrices, points, freq, station_pqr, max_memory_mb)
+    images = 2 * values.real / (n_ant * (n_ant + 1) // 2)
+    return images.reshape(n_matrices, npix_q, npix_p)
+
+
+def nearfield_imager_stokes(visibilities, freq, npix_p, npix_q, extent, station_pqr, height=1.5, stokes="IQUV",
+                            max_memory_mb=200):
+    """
+    Near-field images of several Stokes parameters in one pass
+
+    Per pixel, the steering vectors are computed once and applied to all Stokes visibility matrices. Each image is
+    the same as the ground image of make_xst_plots for those Stokes visibilities, i.e. twice the real part of
+    nearfield_imager of their lower triangular part.
+
+    Args:
+        visibilities: Numpy array with visibilities of all RCUs, shape [2 * num_antennas, 2 * num_antennas]
+        freq: Frequency in Hz
+        npix_p: Number of pixels in p-direction
+        npix_q: Number of pixels in q-direction
+        extent: Extent (in m) that the image should span
+        station_pqr: PQR coordinates of the antennas
+        height: Height of image in metre. Defaults to 1.5
+        stokes: Stokes parameters, see stokes_visibilities. Defaults to "IQUV"
+        max_memory_mb: Maximum amount of memory to use for the biggest array. Defaults to 200
+
+    Returns:
+        Dict[str, np.array(float)]: Stokes parameter -> real valued array of shape [npix_q, npix_p]
+    """
+    images = nearfield_imager_batch(stokes_visibilities(visibilities, stokes), freq, npix_p, npix_q, extent,
+                                    station_pqr, height=height, max_memory_mb=max_memory_mb)
+    return dict(zip(stokes, images))
+
+
 def calibrate(vis, modelvis, maxiter=30, amplitudeonly=True):
     """
     Calibrate and subtract some sources
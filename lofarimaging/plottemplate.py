@@ -0,0 +1,376 @@
+"""Reusable sky and ground plot templates for plotting many images with the same layout
+
+A template builds the figure, axes, colorbar and static artists once. For every
+new image only the image data, color limits, markers and subtitle are updated.
+When the color limits stay the same, frames are drawn by blitting the animated
+artists over a cached background.
+"""
+
+import threading
+import collections
+from typing import Dict, List, Tuple, Callable, Hashable
+
+import numpy as np
+
+from matplotlib import cm
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import ListedColormap
+from matplotlib.patches import Circle
+from matplotlib.ticker import FormatStrFormatter
+import matplotlib.axes as maxes
+from mpl_toolkits.axes_grid1 import make_axes_locatable
+
+__all__ = ["SkyPlotTemplate", "GroundPlotTemplate", "get_plot_template", "clear_plot_templates"]
+
+__version__ = "1.5.0"
+
+# Maximum number of templates per thread, each template holds a figure and possibly a background map
+MAX_CACHED_TEMPLATES = 8
+
+_thread_templates = threading.local()
+
+
+class _PlotTemplate:
+    """Common drawing logic for plot templates"""
+    def __init__(self, fig: Figure, blit: bool):
+        if fig is None:
+            fig = Figure(figsize=(10, 10))
+        if fig.canvas is None or not hasattr(fig.canvas, "copy_from_bbox"):
+            FigureCanvasAgg(fig)
+        self.fig = fig
+        self.blit = blit
+        self._background = None
+        self._needs_full_draw = True
+        self._animated = []
+
+    def _set_clim(self, image: np.ndarray, vmin: float, vmax: float):
+        """Update the color limits, a change of limits requires a full redraw for the colorbar"""
+        if vmin is None:
+            vmin = self._vmin if self._vmin is not None else np.nanmin(image)
+        if vmax is None:
+            vmax = self._vmax if self._vmax is not None else np.nanmax(image)
+        if (vmin, vmax) != self.cimg.get_clim():
+            self.cimg.set_clim(vmin, vmax)
+            self._needs_full_draw = True
+
+    def draw(self):
+        """Draw the current frame on the canvas, blitting if possible"""
+        canvas = self.fig.canvas
+        if not self.blit:
+            canvas.draw()
+            return
+
+        if self._needs_full_draw or self._background is None:
+            # Animated artists are skipped by a normal draw, this gives the static background
+            canvas.draw()
+            self._background = canvas.copy_from_bbox(self.fig.bbox)
+            self._needs_full_draw = False
+        else:
+            canvas.restore_region(self._background)
+
+        for artist in self._animated:
+            if artist.get_visible():
+                artist.axes.draw_artist(artist)
+        canvas.blit(self.fig.bbox)
+
+    def plot(self, *args, **kwargs):
+        """
+        Plot lines on top of every frame, e.g. satellite trajectories. Arguments are passed to Axes.plot
+
+        Returns:
+            List of Line2D objects
+        """
+        lines = self.ax.plot(*args, animated=self.blit, **kwargs)
+        self._animated.extend(lines)
+        self._needs_full_draw = True
+        return lines
+
+    def to_rgb(self) -> np.ndarray:
+        """
+        Draw the current frame and return it as an RGB array
+
+        Returns:
+            np.ndarray: RGB image as uint8, shape [height, width, 3]
+        """
+        self.draw()
+        return np.asarray(self.fig.canvas.buffer_rgba())[:, :, :3].copy()
+
+    def close(self):
+        """Release the figure, the template can not be used afterwards"""
+        self.fig.clear()
+        self._background = None
+        self._animated = []
+
+    def savefig(self, filename: str, **kwargs):
+        """Save the current frame, kwargs are passed to Figure.savefig"""
+        for artist in self._animated:
+            artist.set_animated(False)
+        try:
+            self.fig.savefig(filename, **kwargs)
+        finally:
+            for artist in self._animated:
+                artist.set_animated(self.blit)
+        self._needs_full_draw = True
+
+
+class SkyPlotTemplate(_PlotTemplate):
+    """
+    Sky plot with the layout of make_sky_plot, for updating with new images
+
+    Example:
+        >>> template = SkyPlotTemplate((131, 131), title="Sky image")
+        >>> template.update(np.random.rand(131, 131), subtitle="SB 297", marked_bodies_lmn={'Sun': (0.1, 0.2, 0.)})
+        >>> template.to_rgb().shape
+        (1000, 1000, 3)
+    """
+    def __init__(self, shape: Tuple[int, int], title: str = "Sky plot", fig: Figure = None,
+                 vmin: float = None, vmax: float = None, blit: bool = True, **kwargs):
+        """
+        Build the figure for a sky plot
+
+        Args:
+            shape: shape of the images that will be plotted
+            title: Title for the plot
+            fig: existing figure object to be used
+            vmin: fixed minimum of the color scale. Defaults to the minimum of every image
+            vmax: fixed maximum of the color scale. Defaults to the maximum of every image
+            blit: draw frames by blitting the changing artists. Defaults to True
+            **kwargs: other options to be passed to plt.imshow
+        """
+        super().__init__(fig, blit)
+        self._vmin, self._vmax = vmin, vmax
+
+        ax = self.fig.add_subplot(1, 1, 1)
+        self.ax = ax
+        circle1 = Circle((0, 0), 1.0, edgecolor='k', fill=False, facecolor='none', alpha=0.3)
+        ax.add_artist(circle1)
+
+        self.cimg = ax.imshow(np.zeros(shape), origin='lower', cmap=cm.Spectral_r, extent=(1, -1, -1, 1),
+                              clip_path=circle1, clip_on=True, animated=blit, **kwargs)
+        divider = make_axes_locatable(ax)
+        cax = divider.append_axes("right", size="5%", pad=0.2, axes_class=maxes.Axes)
+        self.fig.colorbar(self.cimg, cax=cax, orientation="vertical", format="%.2e")
+
+        ax.set_xlim(1, -1)
+
+        ax.set_xticks(np.arange(-1, 1.1, 0.5))
+        ax.xaxis.set_major_formatter(FormatStrFormatter('%.1f'))
+        ax.set_yticks(np.arange(-1, 1.1, 0.5))
+        ax.yaxis.set_major_formatter(FormatStrFormatter('%.1f'))
+
+        # Labels
+        ax.set_xlabel('$ℓ$', fontsize=14)
+        ax.set_ylabel('$m$', fontsize=14)
+
+        ax.text(0.5, 1.05, title, fontsize=17, ha='center', va='bottom', transform=ax.transAxes)
+        self.subtitle = ax.text(0.5, 1.02, "", fontsize=12, ha='center', va='bottom', transform=ax.transAxes,
+                                animated=blit)
+
+        # Plot the compass directions, animated so that they are drawn on top of the image when blitting
+        compass = [ax.text(0.9, 0, 'E', horizontalalignment='center', verticalalignment='center', color='w',
+                           fontsize=17, animated=blit),
+                   ax.text(-0.9, 0, 'W', horizontalalignment='center', verticalalignment='center', color='w',
+                           fontsize=17, animated=blit),
+                   ax.text(0, 0.9, 'N', horizontalalignment='center', verticalalignment='center', color='w',
+                           fontsize=17, animated=blit),
+                   ax.text(0, -0.9, 'S', horizontalalignment='center', verticalalignment='center', color='w',
+                           fontsize=17, animated=blit)]
+
+        self.body_markers, = ax.plot([], [], marker='x', color='black', mew=0.5, linestyle='none', animated=blit)
+        self.body_labels = []
+
+        self._animated = [self.cimg, self.subtitle, *compass, self.body_markers]
+
+    def update(self, image: np.ndarray, subtitle: str = None, vmin: float = None, vmax: float = None,
+               marked_bodies_lmn: Dict[str, Tuple[float, float, float]] = None):
+        """
+        Update the plot with a new image
+
+        Args:
+            image: numpy array (two dimensions with data)
+            subtitle: new subtitle, None keeps the current subtitle
+            vmin: minimum of the color scale, defaults to the vmin of the template
+            vmax: maximum of the color scale, defaults to the vmax of the template
+            marked_bodies_lmn: dict with objects to annotate, None keeps the current objects
+        """
+        self.cimg.set_data(image)
+        self._set_clim(image, vmin, vmax)
+
+        if subtitle is not None:
+            self.subtitle.set_text(subtitle)
+
+        if marked_bodies_lmn is not None:
+            for label in self.body_labels:
+                self._animated.remove(label)
+                label.remove()
+            lmns = np.array(list(marked_bodies_lmn.values())).reshape(-1, 3)
+            self.body_markers.set_data(lmns[:, 0], lmns[:, 1])
+            self.body_labels = [self.ax.annotate(body_name, (lmn[0], lmn[1]), animated=self.blit)
+                                for body_name, lmn in marked_bodies_lmn.items()]
+            self._animated.extend(self.body_labels)
+
+
+class GroundPlotTemplate(_PlotTemplate):
+    """
+    Ground plot with the layout of make_ground_plot, for updating with new images
+
+    Example:
+        >>> dummy_map = np.zeros((100, 100, 3), dtype=np.uint8)
+        >>> template = GroundPlotTemplate((150, 150), dummy_map, [-300, 300, -100, 100], mark_max_power=True)
+        >>> template.update(np.random.rand(150, 150), subtitle="SB 297")
+        >>> template.to_rgb().shape
+        (1000, 1000, 3)
+    """
+    def __init__(self, shape: Tuple[int, int], background_map: np.ndarray, extent: List[float],
+                 title: str = "Ground plot", opacity: float = 0.6, fig: Figure = None, draw_contours: bool = False,
+                 mark_max_power: bool = False, db_format: bool = False, vmin: float = None, vmax: float = None,
+                 blit: bool = True, **kwargs):
+        """
+        Build the figure for a ground plot
+
+        Args:
+            shape: shape of the images that will be plotted
+            background_map: background map
+            extent: extent in metres
+            title: Title for the plot
+            opacity: maximum opacity of the plot
+            fig: existing figure object to be used
+            draw_contours: draw contours, these are recomputed for every image. Defaults to False
+            mark_max_power: mark the maximum power. Defaults to False
+            db_format: format colorbar labels for values in dB. Defaults to False
+            vmin: fixed minimum of the color scale. Defaults to the minimum of every image
+            vmax: fixed maximum of the color scale. Defaults to the maximum of every image
+            blit: draw frames by blitting the changing artists. Defaults to True
+            **kwargs: other options to be passed to plt.imshow
+        """
+        super().__init__(fig, blit)
+        self._vmin, self._vmax = vmin, vmax
+        self.extent = extent
+        self.opacity = opacity
+        self.draw_contours = draw_contours
+        self.mark_max_power = mark_max_power
+        self._contours = None
+
+        # Make colors semi-transparent in the lower 3/4 of the scale
+        cmap = cm.Spectral_r
+        cmap_with_alpha = cmap(np.arange(cmap.N))
+        cmap_with_alpha[:, -1] = np.clip(np.linspace(0, 1.5, cmap.N), 0., 1.)
+        cmap_with_alpha = ListedColormap(cmap_with_alpha)
+
+        ax = self.fig.add_subplot(111, ymargin=-0.4)
+        self.ax = ax
+        ax.imshow(background_map, extent=extent)
+        self.cimg = ax.imshow(np.zeros(shape), origin='lower', cmap=cmap_with_alpha, extent=extent,
+                              alpha=opacity, animated=blit, **kwargs)
+
+        divider = make_axes_locatable(ax)
+        cax = divider.append_axes("right", size="5%", pad=0.2, axes_class=maxes.Axes)
+        self.cbar = self.fig.colorbar(self.cimg, cax=cax, orientation="vertical",
+                                      format="%g" if db_format else "%.2e")
+        self.cbar.solids.set(alpha=1.0)
+
+        ax.set_xlabel('$W-E$ (metres)', fontsize=14)
+        ax.set_ylabel('$S-N$ (metres)', fontsize=14)
+
+        ax.text(0.5, 1.05, title, fontsize=17, ha='center', va='bottom', transform=ax.transAxes)
+        self.subtitle = ax.text(0.5, 1.02, "", fontsize=12, ha='center', va='bottom', transform=ax.transAxes,
+                                animated=blit)
+
+        # Change limits to match the original specified extent in the localnorth frame
+        ax.set_xlim(extent[0], extent[1])
+        ax.set_ylim(extent[2], extent[3])
+        ax.tick_params(axis='both', which='both', length=0)
+
+        # Place the NSEW coordinate directions, animated so that they are drawn on top of the image when blitting
+        compass = [ax.text(0.95, 0.5, 'E', color='w', fontsize=18, transform=ax.transAxes, ha='center', va='center',
+                           animated=blit),
+                   ax.text(0.05, 0.5, 'W', color='w', fontsize=18, transform=ax.transAxes, ha='center', va='center',
+                           animated=blit),
+                   ax.text(0.5, 0.95, 'N', color='w', fontsize=18, transform=ax.transAxes, ha='center', va='center',
+                           animated=blit),
+                   ax.text(0.5, 0.05, 'S', color='w', fontsize=18, transform=ax.transAxes, ha='center', va='center',
+                           animated=blit)]
+
+        ax.grid(True, alpha=0.3)
+
+        self.max_marker = Circle((0, 0), radius=8, color='red', fill=False, linewidth=2, animated=blit,
+                                 visible=mark_max_power)
+        ax.add_patch(self.max_marker)
+
+        self._animated = [self.cimg, self.subtitle, *compass, self.max_marker]
+
+    def update(self, image: np.ndarray, subtitle: str = None, vmin: float = None, vmax: float = None):
+        """
+        Update the plot with a new image
+
+        Args:
+            image: numpy array (two dimensions with data)
+            subtitle: new subtitle, None keeps the current subtitle
+            vmin: minimum of the color scale, defaults to the vmin of the template
+            vmax: maximum of the color scale, defaults to the vmax of the template
+        """
+        extent = self.extent
+        self.cimg.set_data(image)
+        self._set_clim(image, vmin, vmax)
+        # The colorbar is redrawn when the limits change, with the alpha of the image
+        self.cbar.solids.set(alpha=1.0)
+
+        if subtitle is not None:
+            self.subtitle.set_text(subtitle)
+
+        if self.draw_contours:
+            if self._contours is not None:
+                self._animated.remove(self._contours)
+                self._contours.remove()
+            ground_vmin_img, ground_vmax_img = self.cimg.get_clim()
+            self._contours = self.ax.contour(image, np.linspace(ground_vmin_img, ground_vmax_img, 15), origin='lower',
+                                             cmap=cm.Greys, extent=extent, linewidths=0.5, alpha=self.opacity)
+            self._contours.set_animated(self.blit)
+            self._animated.append(self._contours)
+
+        if self.mark_max_power:
+            max_idx = np.unravel_index(np.argmax(image), image.shape)
+            maxpixel_x = np.interp(max_idx[1], [0, image.shape[1]], [extent[0], extent[1]])
+            maxpixel_y = np.interp(max_idx[0], [0, image.shape[0]], [extent[2], extent[3]])
+            self.max_marker.set_center((maxpixel_x, maxpixel_y))
+
+
+def get_plot_template(key: Hashable, factory: Callable[[], _PlotTemplate]) -> _PlotTemplate:
+    """
+    Get a plot template that is reused within the current thread
+
+    Matplotlib figures should not be shared between threads, so every thread
+    (e.g. every worker in the realtime reader) keeps its own templates. At most
+    MAX_CACHED_TEMPLATES templates are kept per thread, the least recently used
+    one is dropped first. The template is borrowed: the next call with the same
+    key in this thread draws on the same figure.
+
+    Args:
+        key: hashable describing the plot configuration
+        factory: function without arguments that creates the template if it does not exist yet
+
+    Returns:
+        The template for this configuration
+    """
+    if not hasattr(_thread_templates, "templates"):
+        _thread_templates.templates = collections.OrderedDict()
+    templates = _thread_templates.templates
+    if key in templates:
+        templates.move_to_end(key)
+    else:
+        templates[key] = factory()
+        while len(templates) > MAX_CACHED_TEMPLATES:
+            _, template = templates.popitem(last=False)
+            template.close()
+    return templates[key]
+
+
+def clear_plot_templates():
+    """
+    Drop all plot templates of the current thread, e.g. when a worker thread is done
+    """
+    templates = getattr(_thread_templates, "templates", {})
+    for template in templates.values():
+        template.close()
+    templates.clear()
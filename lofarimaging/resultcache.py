@@ -0,0 +1,177 @@
+"""Content-addressed cache for sky and ground images
+
+Imaging is the expensive part of make_xst_plots, and the images only depend on the
+input visibilities and a few settings. A ResultCache stores computed images under a
+key that is a SHA-256 hash of everything they depend on: the bytes of the calibrated
+visibilities, station, RCU mode, subband, imaging parameters, subtracted sources and
+the code version. Since the key contains the calibrated data, a changed caltable gives
+new keys, so stale results are never returned; they are removed by the LRU eviction.
+
+Every entry is an .npz file in the cache directory. Reading an entry updates its
+modification time, and when the total size exceeds max_bytes the entries that were
+used least recently are removed. Entries are written to a temporary file and then
+renamed, so several processes (e.g. sweep workers) can share a cache directory.
+"""
+
+import os
+import hashlib
+import threading
+from typing import Dict, Optional
+
+import numpy as np
+
+__all__ = ["ResultCache"]
+
+__version__ = "1.5.0"
+
+# Increase when the imaging code changes in a way that changes the images
+CACHE_VERSION = 1
+
+
+def _update_hash(hasher, value):
+    """Add a value to a hash in a way that does not depend on the Python session"""
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        hasher.update(f"ndarray{value.dtype.str}{value.shape}".encode())
+        hasher.update(value.data)
+    elif isinstance(value, (list, tuple)):
+        hasher.update(f"{type(value).__name__}{len(value)}".encode())
+        for item in value:
+            _update_hash(hasher, item)
+    elif isinstance(value, dict):
+        hasher.update(f"dict{len(value)}".encode())
+        for item_key in sorted(value):
+            _update_hash(hasher, item_key)
+            _update_hash(hasher, value[item_key])
+    elif isinstance(value, (np.integer, np.floating)):
+        _update_hash(hasher, value.item())
+    else:
+        hasher.update(f"{type(value).__name__}:{value!r};".encode())
+
+
+class ResultCache:
+    """
+    Cache of computed images, stored as .npz files in a directory with a size limit
+
+    Example:
+        >>> cache = ResultCache("results/cache", max_bytes=2**30)
+        >>> key = cache.key(kind="sky", xst_data=np.ones((4, 4)), subband=297)
+        >>> cache.get(key) is None
+        True
+        >>> cache.put(key, sky_img=np.zeros((131, 131)))
+        >>> cache.get(key)["sky_img"].shape
+        (131, 131)
+    """
+
+    def __init__(self, cache_dir: str = "results/cache", max_bytes: int = 2 * 2**30):
+        """
+        Args:
+            cache_dir: directory for the cache files, created if needed. Defaults to "results/cache"
+            max_bytes: maximum total size of the cache files. Defaults to 2 GiB
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __repr__(self) -> str:
+        return f"ResultCache({self.cache_dir!r}, max_bytes={self.max_bytes})"
+
+    @staticmethod
+    def key(**parts) -> str:
+        """
+        Key for a result, a SHA-256 hash of all parts and the code version
+
+        Args:
+            **parts: everything the result depends on: numpy arrays (hashed by content), numbers, strings,
+                     lists, dicts or None
+
+        Returns:
+            str: hex digest
+        """
+        hasher = hashlib.sha256()
+        _update_hash(hasher, {"cache_version": CACHE_VERSION, "version": __version__, **parts})
+        return hasher.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def get(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        """
+        Look up a result
+
+        Args:
+            key: key from ResultCache.key
+
+        Returns:
+            Dict[str, np.ndarray]: the arrays that were stored, None if the key is not in the cache
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as npz:
+                arrays = {name: npz[name] for name in npz.files}
+            os.utime(path)
+        except (OSError, ValueError, EOFError):
+            # Not cached, evicted meanwhile or a broken file
+            self.misses += 1
+            return None
+        self.hits += 1
+        return arrays
+
+    def put(self, key: str, **arrays: np.ndarray):
+        """
+        Store a result and evict the least recently used results if the cache is too large
+
+        Args:
+            key: key from ResultCache.key
+            **arrays: arrays to store
+        """
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as fileobj:
+                np.savez(fileobj, **arrays)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Warning: could not write to result cache {self.cache_dir}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used results until the total size is at most max_bytes"""
+        entries = []
+        total_size = 0
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if not entry.name.endswith(".npz"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                total_size += stat.st_size
+
+        if total_size <= self.max_bytes:
+            return
+        for _, size, path in sorted(entries):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            if total_size <= self.max_bytes:
+                break
+
+    def clear(self):
+        """Remove all results, e.g. after changing code that is not covered by the key"""
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith(".npz"):
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
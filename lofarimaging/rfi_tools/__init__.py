@@ -1,5 +1,8 @@
 from .processing import *
 from .movie import *
 from .sweeps import *
+from .filters import *
+from .streaming import *
+from .detection import *
 from .realtime import *
 from .realtime_legacy import *
\ No newline at end of file
@@ -0,0 +1,185 @@
+"""Detection and localisation of RFI directly on array correlation matrices (ACMs)
+
+A strong point-like interferer adds a rank-one term to the ACM, which shows up as an
+eigenvalue far above the others. EigenDetector computes only the leading eigenpairs of
+each ACM and flags it when the largest eigenvalue stands out from the noise level
+estimated from the rest of the spectrum. This costs a fraction of a near-field image,
+so it can decide which blocks are worth imaging (it has the same check method as
+ChangeTrigger and can be passed as trigger to read_blocks).
+
+The leading eigenvectors span the signal subspace; music_nearfield_imager uses them
+to localise the interferers on the near-field grid with the MUSIC pseudo-spectrum,
+which has much sharper peaks than the near-field image itself.
+
+Note that bright sky sources (Cas A, Cyg A, the Sun) also give large eigenvalues; on
+calibrated data, use residual visibilities (see EwmaBackground) or subtract_sources.
+"""
+
+from typing import Hashable, NamedTuple, Optional
+
+import numpy as np
+import scipy.linalg
+import scipy.sparse.linalg
+
+from lofarimaging import nearfield_steering_vectors
+
+__all__ = [
+    "EigenDetection",
+    "EigenDetector",
+    "leading_eigenpairs",
+    "music_nearfield_imager",
+]
+
+
+class EigenDetection(NamedTuple):
+    """Result of EigenDetector.detect"""
+    eigenvalues: np.ndarray   # the leading eigenvalues, largest first
+    eigenvectors: np.ndarray  # the corresponding eigenvectors as columns, shape [n_ant, n_eigenvalues]
+    noise_level: float        # mean of the other eigenvalues
+    ratio: float              # largest eigenvalue / noise_level
+    flagged: bool             # ratio above the threshold of the detector
+
+
+def leading_eigenpairs(acm: np.ndarray, n_eigenvalues: int = 4, method: str = "eigh"):
+    """
+    Largest eigenvalues and their eigenvectors of a Hermitian ACM
+
+    Args:
+        acm: Hermitian matrix, shape [n_ant, n_ant]
+        n_eigenvalues: number of eigenpairs. Defaults to 4
+        method: "eigh" for a truncated LAPACK decomposition (only the requested eigenvectors are computed) or
+                "lanczos" for the iterative ARPACK solver, which is faster for few eigenpairs of large matrices.
+                Defaults to "eigh"
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: eigenvalues (largest first), eigenvectors as columns
+    """
+    n_ant = acm.shape[0]
+    n_eigenvalues = min(n_eigenvalues, n_ant)
+    if method == "eigh":
+        eigenvalues, eigenvectors = scipy.linalg.eigh(acm, subset_by_index=[n_ant - n_eigenvalues, n_ant - 1],
+                                                      check_finite=False)
+    elif method == "lanczos":
+        eigenvalues, eigenvectors = scipy.sparse.linalg.eigsh(acm, k=n_eigenvalues, which="LA")
+    else:
+        raise ValueError(f"Unknown method {method}, should be 'eigh' or 'lanczos'")
+    order = np.argsort(eigenvalues)[::-1]
+    return eigenvalues[order], eigenvectors[:, order]
+
+
+class EigenDetector:
+    """
+    Flag ACMs with a dominant eigenvalue
+
+    The noise level is the mean of the eigenvalues that are not computed, which follows
+    from the trace without a full decomposition. An ACM is flagged when its largest
+    eigenvalue is more than ratio_threshold times the noise level.
+
+    Example:
+        >>> detector = EigenDetector(ratio_threshold=20)
+        >>> detection = detector.detect(visibilities_stokes_i)
+        >>> if detection.flagged:
+        ...     spectrum = music_nearfield_imager(detection.eigenvectors[:, :1], freq, 300, 300,
+        ...                                       [-150, 150, -150, 150], station_xyz)
+    """
+
+    def __init__(self, ratio_threshold: float = 10., n_eigenvalues: int = 4, method: str = "eigh"):
+        """
+        Args:
+            ratio_threshold: minimum ratio of the largest eigenvalue to the noise level to flag an ACM.
+                             Defaults to 10
+            n_eigenvalues: number of leading eigenpairs to compute. Defaults to 4
+            method: eigensolver, "eigh" or "lanczos", see leading_eigenpairs. Defaults to "eigh"
+        """
+        self.ratio_threshold = ratio_threshold
+        self.n_eigenvalues = n_eigenvalues
+        self.method = method
+        self.flagged = 0
+        self.passed = 0
+        self.last_detection: Optional[EigenDetection] = None
+
+    def __repr__(self) -> str:
+        return (f"EigenDetector(ratio_threshold={self.ratio_threshold}, n_eigenvalues={self.n_eigenvalues}, "
+                f"method={self.method!r})")
+
+    def detect(self, acm: np.ndarray) -> EigenDetection:
+        """
+        Compute the leading eigenpairs of an ACM and decide whether it contains a strong point source
+
+        Args:
+            acm: Hermitian ACM (e.g. calibrated Stokes I visibilities, or all RCUs), shape [n_ant, n_ant]
+
+        Returns:
+            EigenDetection
+        """
+        acm = np.asarray(acm)
+        n_ant = acm.shape[0]
+        n_eigenvalues = min(self.n_eigenvalues, n_ant - 1)
+        eigenvalues, eigenvectors = leading_eigenpairs(acm, n_eigenvalues, self.method)
+        noise_level = float((np.trace(acm).real - eigenvalues.sum()) / (n_ant - n_eigenvalues))
+        ratio = float(eigenvalues[0] / noise_level) if noise_level > 0 else np.inf
+        detection = EigenDetection(eigenvalues, eigenvectors, noise_level, ratio, ratio > self.ratio_threshold)
+        if detection.flagged:
+            self.flagged += 1
+        else:
+            self.passed += 1
+        self.last_detection = detection
+        return detection
+
+    def check(self, subband: Hashable, acm: np.ndarray, timestamp=None) -> bool:
+        """
+        Whether an ACM should be imaged, the same interface as ChangeTrigger.check
+
+        Args:
+            subband: subband of the ACM (not used)
+            acm: ACM, shape [n_ant, n_ant]
+            timestamp: time of the ACM (not used)
+
+        Returns:
+            bool: True if the ACM is flagged
+        """
+        return self.detect(acm).flagged
+
+
+def music_nearfield_imager(signal_subspace: np.ndarray, freq: float, npix_p: int, npix_q: int, extent,
+                           station_pqr: np.ndarray, height: float = 1.5, max_memory_mb: int = 200) -> np.ndarray:
+    """
+    MUSIC pseudo-spectrum on the near-field grid
+
+    For the steering vector a of each pixel (see nearfield_steering_vectors), the pseudo-spectrum is
+    1 / (1 - |E^H a|^2 / |a|^2), with E the orthonormal signal eigenvectors. It is large where a lies in the
+    signal subspace, i.e. at the positions of the interferers. The denominator is the power of a in the noise
+    subspace, computed from the few signal eigenvectors instead of the many noise eigenvectors. The grid is the
+    same as for nearfield_imager.
+
+    Args:
+        signal_subspace: leading eigenvectors of the ACM as columns, shape [num_antennas, num_sources]
+        freq: Frequency in Hz
+        npix_p: Number of pixels in p-direction
+        npix_q: Number of pixels in q-direction
+        extent: Extent (in m) that the image should span
+        station_pqr: PQR coordinates of the antennas, in the same order as the rows of the ACM
+        height: Height of image in metre. Defaults to 1.5
+        max_memory_mb: Maximum amount of memory to use for the steering vectors. Defaults to 200
+
+    Returns:
+        np.array(float): pseudo-spectrum, shape [npix_q, npix_p]
+    """
+    signal_subspace = np.asarray(signal_subspace)
+    if signal_subspace.ndim == 1:
+        signal_subspace = signal_subspace[:, np.newaxis]
+    n_ant = signal_subspace.shape[0]
+
+    x = np.linspace(extent[0], extent[1], npix_p)
+    y = np.linspace(extent[2], extent[3], npix_q)
+    posx, posy = np.meshgrid(x, y)
+    points = np.stack([posx.ravel(), posy.ravel(), np.full(posx.size, float(height))], axis=1)
+
+    chunksize = max(max_memory_mb * 1024 * 1024 // (16 * n_ant), 1)
+    spectrum = np.empty(len(points))
+    for start in range(0, len(points), chunksize):
+        steering = nearfield_steering_vectors(points[start:start + chunksize], freq, station_pqr)
+        # |a|^2 == n_ant for every pixel
+        in_subspace = np.sum(np.abs(steering.conj() @ signal_subspace) ** 2, axis=1) / n_ant
+        spectrum[start:start + chunksize] = 1 / np.maximum(1 - in_subspace, np.finfo(float).eps)
+    return spectrum.reshape(npix_q, npix_p)
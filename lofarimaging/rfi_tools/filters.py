@@ -0,0 +1,414 @@
+"""Filters for sky images that bring out faint moving sources like satellites
+
+The filters from the satellite notebook as composable stages. Every stage works on a
+stack of images with shape [n_image, m, l] (a single image is treated as a stack of
+one) and returns a new stack. Masks and kernels depend only on the image shape and
+the stage settings, they are computed once and reused for every image. FFT based
+stages transform the whole stack at once; FilterPipeline splits long stacks in
+chunks that are filtered in parallel threads.
+
+Example:
+    >>> pipeline = FilterPipeline(HorizonMask(), SourceMask(marked_bodies_lmn), GaussianHighPass(sigma=10))
+    >>> filtered = pipeline(sky_images)
+"""
+
+import os
+import functools
+import concurrent.futures
+from typing import Dict, Sequence, Tuple, Union
+
+import numpy as np
+import scipy.fft
+from scipy.ndimage import gaussian_filter, median_filter
+
+__all__ = [
+    "FilterPipeline",
+    "HorizonMask",
+    "SourceMask",
+    "source_disk_masks",
+    "inpaint",
+    "GaussianHighPass",
+    "MedianBackground",
+    "WaveletDetail",
+    "PercentileClip",
+    "satellite_filter",
+]
+
+SourcesLmn = Dict[str, Tuple[float, float, float]]
+
+
+def _as_stack(images: np.ndarray) -> np.ndarray:
+    """Images as float array with shape [n_image, m, l]"""
+    images = np.asarray(images, dtype=np.float64)
+    if images.ndim == 2:
+        return images[np.newaxis]
+    if images.ndim != 3:
+        raise ValueError(f"Expected an image or a stack of images, got shape {images.shape}")
+    return images
+
+
+@functools.lru_cache(maxsize=32)
+def _horizon_mask(shape: Tuple[int, int]) -> np.ndarray:
+    """True outside the largest circle around the image centre, as in the notebook"""
+    rows, cols = shape
+    y, x = np.ogrid[:rows, :cols]
+    cy, cx = rows // 2, cols // 2
+    mask = np.sqrt((x - cx) ** 2 + (y - cy) ** 2) > (min(cx, cy) - 1)
+    mask.flags.writeable = False
+    return mask
+
+
+@functools.lru_cache(maxsize=32)
+def _gaussian_highpass(shape: Tuple[int, int], sigma: float) -> np.ndarray:
+    """
+    Gaussian high-pass 1 - exp(-d^2 / (2 sigma^2)), d the distance to zero frequency in frequency pixels
+
+    In the order of the unshifted FFT, so the stack does not need an fftshift.
+    """
+    ky = np.fft.fftfreq(shape[0], 1 / shape[0])[:, np.newaxis]
+    kx = np.fft.fftfreq(shape[1], 1 / shape[1])[np.newaxis, :]
+    highpass = 1 - np.exp(-(kx ** 2 + ky ** 2) / (2 * sigma ** 2))
+    highpass.flags.writeable = False
+    return highpass
+
+
+@functools.lru_cache(maxsize=32)
+def _gaussian_kernel_fft(padded_shape: Tuple[int, int], stddev: float) -> np.ndarray:
+    """
+    FFT of a Gaussian kernel of 8 * stddev + 1 pixels (as astropy's Gaussian2DKernel), centred at pixel 0
+
+    For the rfft2 of images zero padded to padded_shape.
+    """
+    half = int(4 * stddev + 0.5)
+    offsets = np.arange(-half, half + 1)
+    profile = np.exp(-offsets ** 2 / (2 * stddev ** 2))
+    kernel = np.zeros(padded_shape)
+    # Negative offsets wrap around, so the kernel is centred at (0, 0)
+    kernel[np.ix_(offsets % padded_shape[0], offsets % padded_shape[1])] = np.outer(profile, profile)
+    kernel_fft = scipy.fft.rfft2(kernel / kernel.sum())
+    kernel_fft.flags.writeable = False
+    return kernel_fft
+
+
+@functools.lru_cache(maxsize=32)
+def _outside_weight(shape: Tuple[int, int], padded_shape: Tuple[int, int], stddev: float) -> np.ndarray:
+    """Part of the Gaussian kernel that falls beyond the image edge, for every pixel of the image"""
+    inside = np.zeros(padded_shape)
+    inside[:shape[0], :shape[1]] = 1.
+    inside_weight = scipy.fft.irfft2(scipy.fft.rfft2(inside) * _gaussian_kernel_fft(padded_shape, stddev),
+                                     s=padded_shape)[:shape[0], :shape[1]]
+    outside_weight = np.clip(1. - inside_weight, 0., None)
+    outside_weight.flags.writeable = False
+    return outside_weight
+
+
+@functools.lru_cache(maxsize=32)
+def _disk_offsets(radius: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Row and column offsets of the pixels within radius of a pixel"""
+    half = int(np.ceil(radius))
+    dy, dx = np.mgrid[-half:half + 1, -half:half + 1]
+    inside = dy ** 2 + dx ** 2 < radius ** 2
+    return dy[inside], dx[inside]
+
+
+def source_disk_masks(shape: Tuple[int, int], sources_lmn: Union[SourcesLmn, Sequence[SourcesLmn]],
+                      radius: float = 15) -> np.ndarray:
+    """
+    Masks of disks around sources, for one or more images
+
+    Args:
+        shape: shape [m, l] of the sky images
+        sources_lmn: name -> (l, m, n) of the sources, or a list with one such dict per image
+        radius: radius of the disks in pixels. Defaults to 15
+
+    Returns:
+        np.ndarray: boolean masks, True within radius of a source, shape [n_image, m, l] (n_image is 1 for a
+                    single dict)
+    """
+    if isinstance(sources_lmn, dict):
+        sources_lmn = [sources_lmn]
+    rows, cols = shape
+    masks = np.zeros((len(sources_lmn), rows, cols), dtype=bool)
+
+    # Pixel positions of all sources of all images, as in sky_imager
+    image_ix = np.array([i for i, sources in enumerate(sources_lmn) for _ in sources], dtype=np.int64)
+    lm = np.array([(lmn[0], lmn[1]) for sources in sources_lmn for lmn in sources.values()],
+                  dtype=np.float64).reshape(-1, 2)
+    px = np.round((1 - lm[:, 0]) * cols / 2).astype(np.int64)
+    py = np.round((1 + lm[:, 1]) * rows / 2).astype(np.int64)
+    on_image = (px >= 0) & (px < cols) & (py >= 0) & (py < rows)
+
+    # Stamp a precomputed disk at every source, clipped at the image border
+    dy, dx = _disk_offsets(float(radius))
+    ys = py[on_image, np.newaxis] + dy[np.newaxis, :]
+    xs = px[on_image, np.newaxis] + dx[np.newaxis, :]
+    ims = np.broadcast_to(image_ix[on_image, np.newaxis], ys.shape)
+    inside = (ys >= 0) & (ys < rows) & (xs >= 0) & (xs < cols)
+    masks[ims[inside], ys[inside], xs[inside]] = True
+    return masks
+
+
+def inpaint(stack: np.ndarray, mask: np.ndarray = None, kernel_stddev: float = 4,
+            workers: int = None) -> np.ndarray:
+    """
+    Fill masked and NaN pixels with a normalized convolution of the valid pixels
+
+    The valid data and the weights (1 for valid pixels, 0 otherwise) are both convolved with a Gaussian kernel
+    with one FFT each, and the filled value is their ratio. This gives the same result as astropy's
+    interpolate_replace_nans with a Gaussian2DKernel, which convolves directly: pixels beyond the image edge count
+    as valid pixels with value 0, and pixels without valid pixels within the kernel stay NaN.
+
+    Args:
+        stack: image [m, l] or images [n_image, m, l]
+        mask: boolean mask (broadcastable to stack) of extra pixels to fill, e.g. from source_disk_masks.
+              Defaults to only filling NaN pixels
+        kernel_stddev: standard deviation of the Gaussian kernel in pixels. Defaults to 4
+        workers: number of threads for the FFT, see scipy.fft. Defaults to 1
+
+    Returns:
+        np.ndarray: images with the masked and NaN pixels filled
+    """
+    images = _as_stack(stack)
+    invalid = np.isnan(images)
+    if mask is not None:
+        invalid = invalid | np.broadcast_to(mask, images.shape)
+    weights = (~invalid).astype(np.float64)
+
+    # Zero padding of half the kernel size prevents wrapping around the edges
+    half = int(4 * kernel_stddev + 0.5)
+    padded_shape = tuple(scipy.fft.next_fast_len(n + half, real=True) for n in images.shape[1:])
+    kernel_fft = _gaussian_kernel_fft(padded_shape, float(kernel_stddev))
+    rows, cols = images.shape[1:]
+
+    def convolve(data):
+        data_fft = scipy.fft.rfft2(data, s=padded_shape, axes=(-2, -1), workers=workers)
+        return scipy.fft.irfft2(data_fft * kernel_fft, s=padded_shape, axes=(-2, -1),
+                                workers=workers)[:, :rows, :cols]
+
+    smoothed = convolve(np.where(invalid, 0., images))
+    # Like astropy's default boundary='fill', pixels beyond the image edge count as valid zeros
+    smoothed_weights = convolve(weights) + _outside_weight((rows, cols), padded_shape, float(kernel_stddev))
+
+    filled = images.copy()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # Round-off of the FFT can leave tiny weights where there are no valid pixels
+        fill = np.where(smoothed_weights > 1e-8, smoothed / smoothed_weights, np.nan)
+    filled[invalid] = fill[invalid]
+    return filled[0] if np.ndim(stack) == 2 else filled
+
+
+class HorizonMask:
+    """Set pixels outside the horizon circle to NaN"""
+
+    def __call__(self, stack: np.ndarray, indices: np.ndarray = None) -> np.ndarray:
+        stack = stack.copy()
+        stack[:, _horizon_mask(stack.shape[1:])] = np.nan
+        return stack
+
+
+class SourceMask:
+    """
+    Replace disks around bright sources by an interpolation of their surroundings
+
+    The pixels within radius of every source and outside the horizon are filled with a
+    normalized convolution with a Gaussian kernel (see inpaint). Afterwards the image is
+    smoothed slightly to blend the patches with the background.
+    """
+
+    def __init__(self, sources_lmn: Union[SourcesLmn, Sequence[SourcesLmn]], radius: float = 15,
+                 kernel_stddev: float = 4, smooth_sigma: float = 2):
+        """
+        Args:
+            sources_lmn: name -> (l, m, n) of the sources to mask, the same for all images, or a list with one
+                         dict per image of the stack (e.g. for the Sun, which moves)
+            radius: radius of the masked disks in pixels. Defaults to 15
+            kernel_stddev: standard deviation in pixels of the interpolation kernel. Defaults to 4
+            smooth_sigma: standard deviation in pixels of the smoothing afterwards, 0 to skip. Defaults to 2
+        """
+        self.sources_lmn = sources_lmn
+        self.radius = radius
+        self.kernel_stddev = kernel_stddev
+        self.smooth_sigma = smooth_sigma
+        self._shared_mask = None
+
+    def masks(self, shape: Tuple[int, int], indices: np.ndarray) -> np.ndarray:
+        """
+        Masks of the sources for the images at indices, True within radius of a source
+
+        Args:
+            shape: shape [m, l] of the images
+            indices: positions of the images in the input of the pipeline
+
+        Returns:
+            np.ndarray: boolean masks, broadcastable to shape [len(indices), m, l]
+        """
+        if isinstance(self.sources_lmn, dict):
+            if self._shared_mask is None or self._shared_mask.shape[1:] != tuple(shape):
+                self._shared_mask = source_disk_masks(shape, self.sources_lmn, self.radius)
+            return self._shared_mask
+        return source_disk_masks(shape, [self.sources_lmn[i] for i in indices], self.radius)
+
+    def __call__(self, stack: np.ndarray, indices: np.ndarray = None) -> np.ndarray:
+        if indices is None:
+            indices = np.arange(len(stack))
+        outside = _horizon_mask(stack.shape[1:])
+        result = inpaint(stack, self.masks(stack.shape[1:], indices) | outside, self.kernel_stddev)
+        if self.smooth_sigma > 0:
+            result = gaussian_filter(result, sigma=(0, self.smooth_sigma, self.smooth_sigma))
+        result[:, outside] = np.nan
+        return result
+
+
+class GaussianHighPass:
+    """
+    Remove large structures (e.g. the Milky Way) with a Gaussian high-pass filter in the FFT domain
+
+    NaN pixels are taken as 0 for the transform and are NaN again in the result.
+    """
+
+    def __init__(self, sigma: float = 10, workers: int = None):
+        """
+        Args:
+            sigma: width of the filter in frequency pixels, larger removes fewer structures. Defaults to 10
+            workers: number of threads for the FFT, see scipy.fft. Defaults to 1
+        """
+        self.sigma = sigma
+        self.workers = workers
+
+    def __call__(self, stack: np.ndarray, indices: np.ndarray = None) -> np.ndarray:
+        nans = np.isnan(stack)
+        spectrum = scipy.fft.fft2(np.where(nans, 0., stack), axes=(-2, -1), workers=self.workers)
+        spectrum *= _gaussian_highpass(stack.shape[1:], float(self.sigma))
+        result = scipy.fft.ifft2(spectrum, axes=(-2, -1), workers=self.workers).real
+        result[nans] = np.nan
+        return result
+
+
+class MedianBackground:
+    """Subtract a median filtered background, NaN pixels are taken as 0 for the background"""
+
+    def __init__(self, size: int = 100):
+        """
+        Args:
+            size: size in pixels of the median filter. Defaults to 100
+        """
+        self.size = size
+
+    def __call__(self, stack: np.ndarray, indices: np.ndarray = None) -> np.ndarray:
+        background = median_filter(np.nan_to_num(stack, nan=0.), size=(1, self.size, self.size))
+        return stack - background
+
+
+class WaveletDetail:
+    """Keep only the detail coefficients of a 2D wavelet decomposition (requires PyWavelets)"""
+
+    def __init__(self, wavelet: str = "db4", level: int = 2):
+        """
+        Args:
+            wavelet: wavelet name, see pywt.wavelist(). Defaults to "db4"
+            level: decomposition level, higher removes larger structures. Defaults to 2
+        """
+        self.wavelet = wavelet
+        self.level = level
+
+    def __call__(self, stack: np.ndarray, indices: np.ndarray = None) -> np.ndarray:
+        try:
+            import pywt
+        except ImportError:
+            raise ImportError("WaveletDetail needs PyWavelets, install it with 'pip install PyWavelets'")
+
+        nans = np.isnan(stack)
+        coeffs = pywt.wavedec2(np.where(nans, 0., stack), self.wavelet, level=self.level, axes=(-2, -1))
+        coeffs[0] = np.zeros_like(coeffs[0])
+        result = pywt.waverec2(coeffs, self.wavelet, axes=(-2, -1))
+        # The reconstruction can be one pixel larger for odd sizes
+        result = result[:, :stack.shape[1], :stack.shape[2]]
+        result[nans] = np.nan
+        return result
+
+
+class PercentileClip:
+    """Set pixels above a percentile of their image to NaN, e.g. remaining bright residuals"""
+
+    def __init__(self, percentile: float = 95):
+        """
+        Args:
+            percentile: percentile per image above which pixels are set to NaN. Defaults to 95
+        """
+        self.percentile = percentile
+
+    def __call__(self, stack: np.ndarray, indices: np.ndarray = None) -> np.ndarray:
+        limits = np.nanpercentile(stack, self.percentile, axis=(1, 2))
+        return np.where(stack > limits[:, np.newaxis, np.newaxis], np.nan, stack)
+
+
+class FilterPipeline:
+    """
+    Stages applied one after the other to a stack of images
+
+    A stage is any callable stage(stack, indices) -> stack, where indices are the positions of the
+    images of the stack in the full input (for stages with per-image settings).
+    """
+
+    def __init__(self, *stages):
+        self.stages = list(stages)
+
+    def __repr__(self) -> str:
+        return f"FilterPipeline({', '.join(type(stage).__name__ for stage in self.stages)})"
+
+    def _filter_chunk(self, stack: np.ndarray, indices: np.ndarray) -> np.ndarray:
+        for stage in self.stages:
+            stack = stage(stack, indices)
+        return stack
+
+    def __call__(self, images: np.ndarray, chunk_size: int = 16, n_workers: int = None) -> np.ndarray:
+        """
+        Filter an image or a stack of images
+
+        Args:
+            images: image with shape [m, l] or stack with shape [n_image, m, l]
+            chunk_size: number of images that are filtered together. Defaults to 16
+            n_workers: number of threads that filter chunks in parallel. Defaults to the number of CPUs
+
+        Returns:
+            np.ndarray: filtered images, same shape as images
+        """
+        stack = _as_stack(images)
+        if n_workers is None:
+            n_workers = os.cpu_count() or 1
+        bounds = list(range(0, len(stack), chunk_size))
+
+        result = np.empty_like(stack)
+
+        def filter_chunk(start):
+            indices = np.arange(start, min(start + chunk_size, len(stack)))
+            result[indices] = self._filter_chunk(stack[indices], indices)
+
+        if n_workers <= 1 or len(bounds) <= 1:
+            for start in bounds:
+                filter_chunk(start)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+                list(executor.map(filter_chunk, bounds))
+
+        return result[0] if np.ndim(images) == 2 else result
+
+
+def satellite_filter(sources_lmn: Union[SourcesLmn, Sequence[SourcesLmn]], sigma: float = 10,
+                     clip_percentile: float = 95) -> FilterPipeline:
+    """
+    The filter of the notebook for the _filtered_sat_traj images: mask the bright sources, Gaussian high-pass
+    and clip the brightest residuals
+
+    Args:
+        sources_lmn: sources to mask, see SourceMask
+        sigma: width of the high-pass filter, see GaussianHighPass. Defaults to 10
+        clip_percentile: percentile above which pixels are set to NaN, None to skip. Defaults to 95
+
+    Returns:
+        FilterPipeline
+    """
+    stages = [SourceMask(sources_lmn), GaussianHighPass(sigma=sigma)]
+    if clip_percentile is not None:
+        stages.append(PercentileClip(clip_percentile))
+    return FilterPipeline(*stages)
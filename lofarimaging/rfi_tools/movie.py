@@ -1,11 +1,103 @@
+import queue
+import threading
+
 import cv2
+import numpy as np
 
 __all__ = [
     "generate_movie",
     "generate_movie_from_list",
+    "MovieWriter",
 ]
 
 
+class MovieWriter:
+    """
+    MP4 writer that encodes frames in a separate thread
+
+    Frames are passed through a bounded queue, so the producer blocks instead of
+    building up frames in memory when the encoder is slower than the rendering.
+    The frame size is taken from the first frame, other frames are resized to it.
+
+    Example:
+        >>> with MovieWriter("sky_movie.mp4", fps=10) as movie:
+        ...     for frame in frames:
+        ...         movie.write(frame)
+    """
+
+    def __init__(self, output_path, fps=10, max_queue=8):
+        """
+        Start the encoder thread
+
+        Args:
+            output_path (str): Path of the MP4 file.
+            fps (int): Frames per second for the movie.
+            max_queue (int): Maximum number of frames waiting for the encoder.
+        """
+        self.output_path = output_path
+        self.fps = fps
+        self.frames_written = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._encode, name="MovieWriter", daemon=True)
+        self._thread.start()
+
+    def _encode(self):
+        out = None
+        size = None
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                break
+            if self._error is not None:
+                continue
+            try:
+                if out is None:
+                    size = (frame.shape[1], frame.shape[0])
+                    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+                    out = cv2.VideoWriter(self.output_path, fourcc, self.fps, size)
+                # Frames are RGB (as from matplotlib), OpenCV expects BGR
+                frame = cv2.cvtColor(np.ascontiguousarray(frame[:, :, :3]), cv2.COLOR_RGB2BGR)
+                if (frame.shape[1], frame.shape[0]) != size:
+                    frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+                out.write(frame)
+                self.frames_written += 1
+            except Exception as e:
+                self._error = e
+        if out is not None:
+            out.release()
+
+    def write(self, frame):
+        """
+        Queue a frame for encoding, blocks while the queue is full
+
+        Args:
+            frame (np.ndarray): RGB (or RGBA) image as uint8, shape [height, width, 3]
+        """
+        if self._error is not None:
+            raise RuntimeError(f"Error writing {self.output_path}") from self._error
+        if self._closed:
+            raise RuntimeError(f"MovieWriter for {self.output_path} is closed")
+        self._queue.put(frame)
+
+    def close(self):
+        """Encode the remaining frames and finish the file"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise RuntimeError(f"Error writing {self.output_path}") from self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
 def generate_movie(sources, output_path, fps=10):
     if not sources:
         print("Image list is empty.")
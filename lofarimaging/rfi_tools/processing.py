@@ -3,13 +3,17 @@ import time
 import glob
 import datetime
 import re
+import concurrent.futures
+import numpy as np
 import pandas as pd
+import h5py
 from lofarimaging import read_acm_cube, make_xst_plots
 
 __all__ = [
     "get_subbands",
     "get_obstime",
     "analyze_files",
+    "catalog_summary",
     "print_summary",
     "measure_processing_duration",
 ]
@@ -27,31 +31,137 @@ def get_obstime(file_path):
     return datetime.datetime.strptime(obsdatestr + ":" + obstimestr, '%Y%m%d:%H%M%S')
 
 
-def analyze_files(data_files):
+CATALOG_FILENAME = ".xst_catalog.h5"
+
+# Columns of the catalog besides the file names: name -> dtype
+_CATALOG_COLUMNS = {
+    "timestamp": np.int64,  # microseconds since 1970
+    "subband": np.int32,  # -1 if the .h file has no --xcsubband
+    "dat_mtime_ns": np.int64,
+    "dat_size": np.int64,
+    "h_mtime_ns": np.int64,
+    "h_size": np.int64,
+}
+
+
+def _read_catalog(catalog_path):
+    """Catalog as dict of column arrays, None if it does not exist or can not be read"""
+    if not os.path.exists(catalog_path):
+        return None
+    try:
+        with h5py.File(catalog_path, "r") as h5file:
+            catalog = {name: h5file[name][:] for name in _CATALOG_COLUMNS}
+            catalog["dat_file"] = h5file["dat_file"].asstr()[:]
+            catalog["h_file"] = h5file["h_file"].asstr()[:]
+    except (OSError, KeyError) as e:
+        print(f"Warning: could not read catalog {catalog_path} ({e}), it will be rebuilt")
+        return None
+    return catalog
+
+
+def _write_catalog(catalog_path, catalog):
+    """Write the catalog to a temporary file and replace the old one"""
+    tmp_path = catalog_path + ".tmp"
+    try:
+        with h5py.File(tmp_path, "w") as h5file:
+            for name, dtype in _CATALOG_COLUMNS.items():
+                h5file.create_dataset(name, data=np.asarray(catalog[name], dtype=dtype))
+            for name in ("dat_file", "h_file"):
+                h5file.create_dataset(name, data=np.asarray(catalog[name], dtype=object),
+                                      dtype=h5py.string_dtype())
+        os.replace(tmp_path, catalog_path)
+    except OSError as e:
+        print(f"Warning: could not write catalog {catalog_path}: {e}")
+
+
+def _parse_pair(dat_file, h_file):
+    """Catalog row for a .dat and .h file"""
+    timestamp = get_obstime(dat_file)
+    timestamp2 = get_obstime(h_file)
+    if timestamp != timestamp2:
+        print(f"Warning: timestamps do not match for {dat_file} and {h_file}")
+    subband = get_subbands(h_file)
+    return np.datetime64(timestamp, "us").astype(np.int64), -1 if subband is None else subband
+
+
+def analyze_files(data_files, catalog_path=None, use_catalog=True, max_workers=8):
+    """
+    Make a table of the XST files (.dat and .h) in a directory
+
+    The table is kept in a catalog file in the data directory. On later calls, only files that are new
+    or have a different modification time or size are parsed, in parallel threads.
+
+    Args:
+        data_files (str): Directory with the .dat and .h files.
+        catalog_path (str): Catalog file. Defaults to .xst_catalog.h5 in data_files.
+        use_catalog (bool): If False, parse all files and do not read or write the catalog.
+        max_workers (int): Number of threads for parsing the .h files.
+    Returns:
+        pd.DataFrame: timestamp, subband, dat_file and h_file of every file, sorted by timestamp and subband.
+        dict: Summary of the files, see catalog_summary.
+    """
     dat_files = sorted(glob.glob(os.path.join(data_files, '*.dat')))
     h_files = sorted(glob.glob(os.path.join(data_files, '*.h')))
 
     assert len(dat_files) == len(h_files), "Mismatch in number of .dat and .h files"
 
-    data_list = []
+    if catalog_path is None:
+        catalog_path = os.path.join(data_files, CATALOG_FILENAME)
+    old_catalog = _read_catalog(catalog_path) if use_catalog else None
+    old_rows = {}
+    if old_catalog is not None:
+        old_rows = {dat_file: i for i, dat_file in enumerate(old_catalog["dat_file"])}
+
+    n_files = len(dat_files)
+    catalog = {name: np.zeros(n_files, dtype=dtype) for name, dtype in _CATALOG_COLUMNS.items()}
+    catalog["dat_file"], catalog["h_file"] = dat_files, h_files
+
+    to_parse = []
+    for i, (dat_file, h_file) in enumerate(zip(dat_files, h_files)):
+        dat_stat, h_stat = os.stat(dat_file), os.stat(h_file)
+        catalog["dat_mtime_ns"][i], catalog["dat_size"][i] = dat_stat.st_mtime_ns, dat_stat.st_size
+        catalog["h_mtime_ns"][i], catalog["h_size"][i] = h_stat.st_mtime_ns, h_stat.st_size
+
+        old_i = old_rows.get(dat_file)
+        if old_i is not None and old_catalog["h_file"][old_i] == h_file and \
+                all(old_catalog[name][old_i] == catalog[name][i]
+                    for name in ("dat_mtime_ns", "dat_size", "h_mtime_ns", "h_size")):
+            catalog["timestamp"][i] = old_catalog["timestamp"][old_i]
+            catalog["subband"][i] = old_catalog["subband"][old_i]
+        else:
+            to_parse.append(i)
+
+    if to_parse:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            parsed = executor.map(_parse_pair, [dat_files[i] for i in to_parse], [h_files[i] for i in to_parse])
+            for i, (timestamp, subband) in zip(to_parse, parsed):
+                catalog["timestamp"][i], catalog["subband"][i] = timestamp, subband
+
+    if use_catalog and (to_parse or old_catalog is None or len(old_rows) != n_files):
+        _write_catalog(catalog_path, catalog)
+
+    subbands = catalog["subband"].astype(np.int64)
+    if np.any(subbands < 0):
+        subbands = np.where(subbands < 0, np.nan, subbands)
+    df = pd.DataFrame({
+        "timestamp": pd.to_datetime(catalog["timestamp"], unit="us"),
+        "subband": subbands,
+        "dat_file": dat_files,
+        "h_file": h_files
+    })
+    df = df.sort_values(by=["timestamp", "subband"]).reset_index(drop=True)
 
-    for dat_file, h_file in zip(dat_files, h_files):
-        timestamp = get_obstime(dat_file)
-        timestamp2 = get_obstime(h_file)
-        if timestamp != timestamp2:
-            print(f"Warning: timestamps do not match for {dat_file} and {h_file}")
-        subband = get_subbands(h_file)
+    return df, catalog_summary(df)
 
-        data_list.append({
-            "timestamp": timestamp,
-            "subband": subband,
-            "dat_file": dat_file,
-            "h_file": h_file
-        })
-
-    df = pd.DataFrame(data_list)
-    df = df.sort_values(by=["timestamp", "subband"]).reset_index(drop=True)
 
+def catalog_summary(df):
+    """
+    Summary of a table of XST files as made by analyze_files, for print_summary
+    Args:
+        df (pd.DataFrame): DataFrame containing the data files and their metadata.
+    Returns:
+        dict: Number of files, subband range, time range and averages.
+    """
     average_measures_per_subband = round(df["subband"].value_counts().mean(), 2)
     measurement_duration = round((df["timestamp"].max() - df["timestamp"].min()).total_seconds() / len(df), 2) if len(df) > 1 else None
 
@@ -68,7 +178,7 @@ def analyze_files(data_files):
         "measurement_duration": measurement_duration
     }
 
-    return df, summary
+    return summary
 
 
 def print_summary(summary):
@@ -105,7 +215,7 @@ def measure_processing_duration(df, station_name, station_type, rcu_mode, temp_d
     try:
         print(f"Generating image for subband {subband} at time {obstime} and height {height} m.")
         visibilities = read_acm_cube(xst_filename, station_type)[0]
-        _, _, _ = make_xst_plots(visibilities, station_name, obstime, subband, rcu_mode, caltable_dir=caltable_dir, map_zoom=18, outputpath=temp_dir, mark_max_power=True, height=height, return_only_paths=True)
+        _, _, _ = make_xst_plots(visibilities, station_name, obstime, subband, rcu_mode, caltable_dir=caltable_dir, map_zoom=18, outputpath=temp_dir, mark_max_power=True, height=height, return_only_paths=True, reuse_figures=True)
     except Exception as e:
         print(f"Error generating image for {xst_filename}: {e}")
 
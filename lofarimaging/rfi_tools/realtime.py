@@ -83,7 +83,11 @@ def wait_for_dat_file(input_path, sleep_interval=0.2):
         time.sleep(sleep_interval)
 
 
-def read_blocks(input_path, output_path, caltable_dir, temp_dir, sleep_interval, station_name, integration_time_s, rcu_mode, height, extent, pixels_per_metre, step=1, max_threads=4):
+def read_blocks(input_path, output_path, caltable_dir, temp_dir, sleep_interval, station_name, integration_time_s, rcu_mode, height, extent, pixels_per_metre, step=1, max_threads=4, background=None,
+                integrator=None, trigger=None):
+    # integrator: optional SlidingIntegrator; when given, the integrated ACMs it emits are imaged
+    # background: optional SubbandBackgrounds; when given, residual visibilities are imaged
+    # trigger: optional ChangeTrigger or EigenDetector; when given, only blocks it accepts are imaged
     # Get station type and number of RCU channels based on name
     station_type = get_station_type(station_name)
     num_rcu = rcus_in_station(station_type)
@@ -103,6 +107,7 @@ def read_blocks(input_path, output_path, caltable_dir, temp_dir, sleep_interval,
     buffer = np.array([], dtype=np.complex128)
 
     block_counter = 0      # Counts total blocks seen
+    imaging_counter = 0    # Counts blocks that are candidates for imaging
     subband_counter = 0    # Tracks current subband for image labeling
 
     # Read min/max subbands from metadata file
@@ -110,6 +115,9 @@ def read_blocks(input_path, output_path, caltable_dir, temp_dir, sleep_interval,
     state.current_dat_file = os.path.basename(filename)
     min_subband, max_subband = get_subbands(input_path)
     state.subband_range = (min_subband, max_subband)
+    with state.pending_lock:
+        state.blocks_imaged = 0
+        state.blocks_skipped = 0
 
     def process_block_wrapper(block, subband, timestamp):
         try:
@@ -133,7 +141,7 @@ def read_blocks(input_path, output_path, caltable_dir, temp_dir, sleep_interval,
                 block, station_name, timestamp, subband, rcu_mode,
                 map_zoom=18, outputpath=temp_dir, mark_max_power=True,
                 height=height, return_only_paths=True, caltable_dir=caltable_dir,
-                extent=extent, pixels_per_metre=pixels_per_metre,
+                extent=extent, pixels_per_metre=pixels_per_metre, reuse_figures=True,
             )
             duration = time.time() - start_time
             with state.pending_lock:
@@ -187,8 +195,22 @@ def read_blocks(input_path, output_path, caltable_dir, temp_dir, sleep_interval,
                     block_counter += 1
                     state.last_block = block_counter
 
+                    # Integrated ACMs are emitted at the cadence of the integrator
+                    if integrator is not None:
+                        block = integrator.add(subband, block)
+                        if block is None:
+                            continue
+
+                    # The background model sees every candidate block, also the ones skipped by step
+                    if background is not None:
+                        block = background.update(subband, block)
+                        if block is None:
+                            logger.debug(f"Block {block_counter} used to initialize the background of subband {subband}")
+                            continue
+
                     # Step filtering: only process 1 of every N blocks
-                    if block_counter % step != 0:
+                    imaging_counter += 1
+                    if imaging_counter % step != 0:
                         continue
 
                     # Health checks: system is falling behind (currently inactive)
@@ -201,11 +223,19 @@ def read_blocks(input_path, output_path, caltable_dir, temp_dir, sleep_interval,
                         logger.info(f"[STOP] Block {block_counter} skipped.")
                         continue
 
+                    # Change triage: skip blocks that are about the same as the last imaged block of this subband
+                    if trigger is not None and not trigger.check(subband, block, obstime):
+                        with state.pending_lock:
+                            state.blocks_skipped += 1
+                        logger.debug(f"Block {block_counter}, subband {subband} skipped by {trigger!r}")
+                        continue
+
                     # Send block to be processed by an available thread
                     print(f"Submitting block {block_counter}, subband {subband}")
                     logger.info(f"Submitting block {block_counter}, subband {subband}")
                     with state.pending_lock:
                         state.pending_tasks += 1
+                        state.blocks_imaged += 1
 
                     executor.submit(process_block_wrapper, block, subband, obstime)
 
@@ -0,0 +1,473 @@
+"""Streaming operations on the time stream of array correlation matrices (ACMs)
+
+Moving sources like satellites stand out best when the slowly varying sky is removed
+from the visibilities before imaging. The background models in this module estimate
+that sky from the ACMs seen so far, either as an exponential moving average or as a
+running median over a bounded window, and return the residual visibilities of every
+new ACM. They only keep a fixed amount of state, so they work the same on an ACM cube
+that is read block by block (iter_acm_blocks) as on the live stream in read_blocks.
+SlidingIntegrator averages the last ACMs of a subband to bring out sources that are
+too faint in a single block, ChangeTrigger skips imaging ACMs that hardly differ from
+the last imaged ACM of their subband.
+
+The residual of an ACM is taken against the background of the *previous* ACMs, so a
+satellite that appears in one block is not partly subtracted from itself.
+
+Example:
+    >>> model = EwmaBackground(alpha=0.05)
+    >>> for residual in subtract_background(iter_acm_blocks("20230111_072042_xst.dat", "intl"), model):
+    ...     img = sky_imager(residual, baselines, freq, 131, 131)
+"""
+
+import os
+import datetime
+from typing import Callable, Dict, Hashable, Iterable, Iterator, Optional, Union
+
+import numpy as np
+import scipy.linalg
+
+from lofarimaging import rcus_in_station
+
+__all__ = [
+    "EwmaBackground",
+    "RunningMedianBackground",
+    "SubbandBackgrounds",
+    "SlidingIntegrator",
+    "ChangeTrigger",
+    "subtract_background",
+    "iter_acm_blocks",
+]
+
+
+class EwmaBackground:
+    """
+    Background of an ACM stream as an exponential moving average
+
+    Cheap (one multiply-add per visibility) and with constant memory, but a bright
+    source that stays in view for a while leaks into the background.
+    """
+
+    def __init__(self, alpha: float = 0.05, min_blocks: int = 1):
+        """
+        Args:
+            alpha: weight of a new ACM in the average, the background follows changes over roughly 1 / alpha
+                   blocks. Defaults to 0.05
+            min_blocks: number of ACMs to see before residuals are returned. Defaults to 1
+        """
+        if not 0 < alpha <= 1:
+            raise ValueError(f"alpha should be in (0, 1], got {alpha}")
+        self.alpha = alpha
+        self.min_blocks = max(int(min_blocks), 1)
+        self.reset()
+
+    def __repr__(self) -> str:
+        return f"EwmaBackground(alpha={self.alpha}, min_blocks={self.min_blocks})"
+
+    def reset(self):
+        """Forget all ACMs seen so far"""
+        self.count = 0
+        self._background = None
+
+    @property
+    def ready(self) -> bool:
+        """True when enough ACMs have been seen to return residuals"""
+        return self.count >= self.min_blocks
+
+    @property
+    def background(self) -> Optional[np.ndarray]:
+        """Current background ACM, None before the first update"""
+        return self._background
+
+    def update(self, acm: np.ndarray) -> Optional[np.ndarray]:
+        """
+        Add an ACM to the background
+
+        Args:
+            acm: array correlation matrix, shape [n_ant, n_ant]
+
+        Returns:
+            np.ndarray: acm minus the background of the previous ACMs, None while not ready
+        """
+        acm = np.asarray(acm)
+        residual = acm - self._background if self.ready else None
+        if self._background is None:
+            self._background = acm.astype(np.complex128, copy=True)
+        else:
+            # In place, the background is not reallocated for every block
+            self._background *= 1 - self.alpha
+            self._background += self.alpha * acm
+        self.count += 1
+        return residual
+
+
+class RunningMedianBackground:
+    """
+    Background of an ACM stream as the median of the last ACMs
+
+    The real and imaginary parts are medians over a window of the last ACMs, which is
+    robust against sources that are bright in less than half the window. ACMs are
+    Hermitian, so only the upper triangle is stored and used for the median. Computing
+    the median costs O(window) per visibility; with refresh > 1 the median is only
+    recomputed every refresh blocks and the last one is used in between, which makes
+    the median approximate but the cost per block window / refresh times smaller.
+    """
+
+    def __init__(self, window: int = 32, refresh: int = 1, min_blocks: int = 1):
+        """
+        Args:
+            window: number of ACMs in the median. Defaults to 32
+            refresh: recompute the median every refresh blocks. Defaults to 1
+            min_blocks: number of ACMs to see before residuals are returned. Defaults to 1
+        """
+        if window < 1 or refresh < 1:
+            raise ValueError(f"window and refresh should be at least 1, got {window} and {refresh}")
+        self.window = int(window)
+        self.refresh = int(refresh)
+        self.min_blocks = max(int(min_blocks), 1)
+        self.reset()
+
+    def __repr__(self) -> str:
+        return f"RunningMedianBackground(window={self.window}, refresh={self.refresh}, min_blocks={self.min_blocks})"
+
+    def reset(self):
+        """Forget all ACMs seen so far"""
+        self.count = 0
+        self._ring = None
+        self._triu = None
+        self._background = None
+        self._stale = True
+
+    @property
+    def ready(self) -> bool:
+        """True when enough ACMs have been seen to return residuals"""
+        return self.count >= self.min_blocks
+
+    @property
+    def background(self) -> Optional[np.ndarray]:
+        """Current background ACM, None before the first update"""
+        if self._stale and self.count > 0:
+            self._compute_median()
+        return self._background
+
+    def _compute_median(self):
+        n_filled = min(self.count, self.window)
+        values = self._ring[:n_filled]
+        packed = np.median(values.real, axis=0) + 1j * np.median(values.imag, axis=0)
+        n_ant = self._background.shape[0]
+        background = np.zeros((n_ant, n_ant), dtype=np.complex128)
+        background[self._triu] = packed
+        background.T[self._triu] = packed.conj()
+        self._background = background
+        self._stale = False
+
+    def update(self, acm: np.ndarray) -> Optional[np.ndarray]:
+        """
+        Add an ACM to the window
+
+        Args:
+            acm: array correlation matrix, shape [n_ant, n_ant]
+
+        Returns:
+            np.ndarray: acm minus the background of the previous ACMs, None while not ready
+        """
+        acm = np.asarray(acm)
+        residual = None
+        if self.ready:
+            if self._stale and self.count % self.refresh == 0:
+                self._compute_median()
+            residual = acm - self._background
+
+        if self._ring is None:
+            n_ant = acm.shape[0]
+            self._triu = np.triu_indices(n_ant)
+            self._ring = np.empty((self.window, len(self._triu[0])), dtype=np.complex128)
+            self._background = np.zeros((n_ant, n_ant), dtype=np.complex128)
+        self._ring[self.count % self.window] = acm[self._triu]
+        self.count += 1
+        self._stale = True
+        if self.count == self.min_blocks:
+            # The first residual should not wait for the refresh cadence
+            self._compute_median()
+        return residual
+
+
+class SubbandBackgrounds:
+    """
+    One background model per subband, for streams that cycle through subbands
+
+    Example:
+        >>> backgrounds = SubbandBackgrounds(lambda: EwmaBackground(alpha=0.05))
+        >>> residual = backgrounds.update(subband, acm)
+    """
+
+    def __init__(self, factory: Callable[[], object] = EwmaBackground):
+        """
+        Args:
+            factory: function without arguments that returns a new background model. Defaults to EwmaBackground
+        """
+        self.factory = factory
+        self.models: Dict[Hashable, object] = {}
+
+    def __repr__(self) -> str:
+        return f"SubbandBackgrounds({self.factory!r}, subbands={sorted(self.models)})"
+
+    def model(self, subband: Hashable):
+        """Background model of a subband, created on first use"""
+        if subband not in self.models:
+            self.models[subband] = self.factory()
+        return self.models[subband]
+
+    def update(self, subband: Hashable, acm: np.ndarray) -> Optional[np.ndarray]:
+        """
+        Add an ACM to the background of its subband
+
+        Args:
+            subband: subband of the ACM
+            acm: array correlation matrix, shape [n_ant, n_ant]
+
+        Returns:
+            np.ndarray: residual visibilities, None while the model of this subband is not ready
+        """
+        return self.model(subband).update(acm)
+
+    def reset(self):
+        """Forget all subbands"""
+        self.models.clear()
+
+
+class SlidingIntegrator:
+    """
+    Average of the last ACMs of every subband, over a sliding window
+
+    Every subband has a ring buffer with its last window ACMs and their running sum. A
+    new ACM is added to the sum and the ACM it replaces in the ring is subtracted, so an
+    update costs the same for every window length. Memory is window + 1 ACMs per
+    subband. Once the window is full, the average is emitted every cadence blocks of
+    that subband: cadence 1 gives a sliding average, cadence == window gives
+    consecutive, non-overlapping integrations.
+
+    Example:
+        >>> integrator = SlidingIntegrator(window=10, cadence=5)
+        >>> integrated = integrator.add(subband, acm)  # None if nothing is emitted for this block
+    """
+
+    # Recompute the running sums from the ring every this many windows, against rounding drift
+    RESYNC_WINDOWS = 64
+
+    def __init__(self, window: int = 10, cadence: int = 1):
+        """
+        Args:
+            window: number of ACMs in the average. Defaults to 10
+            cadence: emit an average every cadence ACMs of a subband. Defaults to 1
+        """
+        if window < 1 or cadence < 1:
+            raise ValueError(f"window and cadence should be at least 1, got {window} and {cadence}")
+        self.window = int(window)
+        self.cadence = int(cadence)
+        self.reset()
+
+    def __repr__(self) -> str:
+        return f"SlidingIntegrator(window={self.window}, cadence={self.cadence})"
+
+    def reset(self):
+        """Forget all subbands"""
+        self._rings: Dict[Hashable, np.ndarray] = {}
+        self._sums: Dict[Hashable, np.ndarray] = {}
+        self.counts: Dict[Hashable, int] = {}
+
+    def add(self, subband: Hashable, acm: np.ndarray) -> Optional[np.ndarray]:
+        """
+        Add an ACM to the window of its subband
+
+        Args:
+            subband: subband of the ACM
+            acm: array correlation matrix, shape [n_ant, n_ant]
+
+        Returns:
+            np.ndarray: average of the last window ACMs of this subband, None if nothing is emitted for this ACM
+        """
+        acm = np.asarray(acm)
+        if subband not in self._rings:
+            self._rings[subband] = np.zeros((self.window,) + acm.shape, dtype=np.complex128)
+            self._sums[subband] = np.zeros(acm.shape, dtype=np.complex128)
+            self.counts[subband] = 0
+        ring, running_sum = self._rings[subband], self._sums[subband]
+        count = self.counts[subband]
+
+        oldest = ring[count % self.window]
+        running_sum -= oldest
+        running_sum += acm
+        oldest[...] = acm
+        count += 1
+        self.counts[subband] = count
+
+        if count % (self.RESYNC_WINDOWS * self.window) == 0:
+            np.sum(ring, axis=0, out=running_sum)
+
+        if count < self.window or (count - self.window) % self.cadence != 0:
+            return None
+        return running_sum / self.window
+
+
+class ChangeTrigger:
+    """
+    Decide whether an ACM differs enough from the last imaged ACM of its subband to image it
+
+    Two change metrics are available:
+
+    - "frobenius": ||acm - last||_F / ||last||_F, the relative size of the difference.
+      Costs one pass over the visibilities.
+    - "eigen": relative change of the n_eigenvalues largest eigenvalues, which only
+      reacts to changes in the strongest sources and ignores noise in the weak
+      eigenvalues. Costs a partial eigendecomposition.
+
+    An ACM is imaged when its change exceeds threshold, when it is the first of its
+    subband, or when the last image of the subband is at least heartbeat seconds old.
+
+    Example:
+        >>> trigger = ChangeTrigger(threshold=0.05, heartbeat=60)
+        >>> if trigger.check(subband, acm, obstime):
+        ...     make_xst_plots(acm, ...)
+    """
+
+    METRICS = ("frobenius", "eigen")
+
+    def __init__(self, threshold: float = 0.05, heartbeat: Optional[float] = 60., metric: str = "frobenius",
+                 n_eigenvalues: int = 5):
+        """
+        Args:
+            threshold: minimum relative change for imaging. Defaults to 0.05
+            heartbeat: image at least every heartbeat seconds per subband, None to image only on changes.
+                       Defaults to 60
+            metric: "frobenius" or "eigen". Defaults to "frobenius"
+            n_eigenvalues: number of eigenvalues compared for metric "eigen". Defaults to 5
+        """
+        if metric not in self.METRICS:
+            raise ValueError(f"Unknown metric {metric}, should be one of {self.METRICS}")
+        self.threshold = threshold
+        self.heartbeat = heartbeat
+        self.metric = metric
+        self.n_eigenvalues = n_eigenvalues
+        self.reset()
+
+    def __repr__(self) -> str:
+        return (f"ChangeTrigger(threshold={self.threshold}, heartbeat={self.heartbeat}, metric={self.metric!r}, "
+                f"n_eigenvalues={self.n_eigenvalues})")
+
+    def reset(self):
+        """Forget the last imaged ACMs and reset the counters"""
+        self._references: Dict[Hashable, np.ndarray] = {}
+        self._imaged_at: Dict[Hashable, Union[float, datetime.datetime, None]] = {}
+        self.imaged = 0
+        self.skipped = 0
+        self.last_distance: Optional[float] = None
+
+    def _signature(self, acm: np.ndarray) -> np.ndarray:
+        """What is compared between ACMs: the ACM itself or its largest eigenvalues"""
+        if self.metric == "frobenius":
+            return np.array(acm, dtype=np.complex128)
+        n_ant = acm.shape[0]
+        n_eigenvalues = min(self.n_eigenvalues, n_ant)
+        # ACMs are Hermitian; eigh only looks at the lower triangle
+        return scipy.linalg.eigh(acm, eigvals_only=True, subset_by_index=[n_ant - n_eigenvalues, n_ant - 1],
+                                 check_finite=False)
+
+    def distance(self, subband: Hashable, acm: np.ndarray) -> float:
+        """
+        Relative change of an ACM with respect to the last imaged ACM of its subband
+
+        Args:
+            subband: subband of the ACM
+            acm: array correlation matrix, shape [n_ant, n_ant]
+
+        Returns:
+            float: relative change, inf if nothing was imaged for this subband yet
+        """
+        return self._distance(self._references.get(subband), self._signature(np.asarray(acm)))
+
+    @staticmethod
+    def _distance(reference: Optional[np.ndarray], signature: np.ndarray) -> float:
+        if reference is None:
+            return np.inf
+        reference_norm = np.linalg.norm(reference)
+        if reference_norm == 0:
+            return np.inf if np.any(signature) else 0.
+        return float(np.linalg.norm(signature - reference) / reference_norm)
+
+    def _heartbeat_due(self, subband: Hashable, timestamp) -> bool:
+        if self.heartbeat is None or timestamp is None or self._imaged_at.get(subband) is None:
+            return False
+        age = timestamp - self._imaged_at[subband]
+        if isinstance(age, datetime.timedelta):
+            age = age.total_seconds()
+        return age >= self.heartbeat
+
+    def check(self, subband: Hashable, acm: np.ndarray,
+              timestamp: Union[float, datetime.datetime, None] = None) -> bool:
+        """
+        Whether to image an ACM; if so, it becomes the reference for its subband
+
+        Args:
+            subband: subband of the ACM
+            acm: array correlation matrix, shape [n_ant, n_ant]
+            timestamp: time of the ACM as datetime or seconds, for the heartbeat. Defaults to None (no heartbeat)
+
+        Returns:
+            bool: True if the ACM should be imaged
+        """
+        signature = self._signature(np.asarray(acm))
+        self.last_distance = self._distance(self._references.get(subband), signature)
+        if self.last_distance <= self.threshold and not self._heartbeat_due(subband, timestamp):
+            self.skipped += 1
+            return False
+        self._references[subband] = signature
+        self._imaged_at[subband] = timestamp
+        self.imaged += 1
+        return True
+
+
+def subtract_background(acms: Iterable[np.ndarray], model) -> Iterator[np.ndarray]:
+    """
+    Residual visibilities of a sequence of ACMs
+
+    The ACMs are consumed one at a time, so with iter_acm_blocks the cube is never
+    completely in memory. ACMs seen while the model is not ready yield no residual.
+
+    Args:
+        acms: ACMs in time order, each with shape [n_ant, n_ant] (e.g. a cube or iter_acm_blocks)
+        model: background model, e.g. EwmaBackground or RunningMedianBackground
+
+    Yields:
+        np.ndarray: residual visibilities, shape [n_ant, n_ant]
+    """
+    for acm in acms:
+        residual = model.update(acm)
+        if residual is not None:
+            yield residual
+
+
+def iter_acm_blocks(filename: str, station_type: str, start: int = 0, stop: int = None,
+                    step: int = 1) -> Iterator[np.ndarray]:
+    """
+    Read the time slots of an ACM binary data cube one at a time
+
+    Like read_acm_cube, but memory mapped, so only the time slots that are used are read.
+
+    Args:
+        filename: File containing the array correlation matrices.
+        station_type: Kind of station that produced the correlation. One of 'core', 'remote', 'intl'.
+        start: first time slot. Defaults to 0
+        stop: last time slot (exclusive). Defaults to all time slots
+        step: step in time slots. Defaults to 1
+
+    Yields:
+        np.ndarray: ACM of one time slot, shape [n_rcu, n_rcu]
+    """
+    num_rcu = rcus_in_station(station_type)
+    itemsize = np.dtype(np.complex128).itemsize
+    time_slots = os.path.getsize(filename) // (num_rcu * num_rcu * itemsize)
+    if time_slots == 0:
+        return
+    cube = np.memmap(filename, dtype=np.complex128, mode="r", shape=(time_slots, num_rcu, num_rcu))
+    for t_idx in range(*slice(start, stop, step).indices(time_slots)):
+        yield np.array(cube[t_idx])
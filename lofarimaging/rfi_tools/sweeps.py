@@ -1,7 +1,27 @@
-from lofarimaging import read_acm_cube, make_xst_plots
-from lofarimaging.rfi_tools import generate_movie_from_list
+import os
+import time
+import datetime
+import collections
+import concurrent.futures
+import multiprocessing
+from typing import NamedTuple
+
+import numba
+import numexpr
+import numpy as np
+import pandas as pd
+from lofarantpos.db import LofarAntennaDatabase
+
+from lofarimaging import read_acm_cube, make_xst_plots, merge_hdf5
+from lofarimaging.rfi_tools import generate_movie_from_list, MovieWriter
 
 __all__ = [
+    "ObservationIndex",
+    "SweepJob",
+    "plan_time_sweep",
+    "plan_subband_sweep",
+    "run_sweep",
+    "print_sweep_summary",
     "generate_time_sweep",
     "generate_subband_sweep",
     "generate_height_sweep",
@@ -10,7 +30,369 @@ __all__ = [
     "get_number_of_measurements_height_sweep",
 ]
 
-def generate_time_sweep(df, subbands, height, station_name, station_type, rcu_mode, temp_dir, output_dir, caltable_dir: str = "../CalTables/", fps=10, short_sweep=False):
+
+class ObservationIndex:
+    """
+    Index of the observations in a DataFrame from analyze_files by subband and time
+
+    Per subband, the timestamps are kept as a sorted array, so the first observation at or after a time
+    is found with a binary search instead of filtering and sorting the DataFrame.
+
+    Example:
+        >>> index = ObservationIndex(df)
+        >>> row = index.at_or_after(284, pd.Timestamp("2023-01-11 07:20"))
+    """
+
+    def __init__(self, df):
+        """
+        Build the index
+
+        Args:
+            df (pd.DataFrame): DataFrame with at least the columns timestamp and subband.
+        """
+        self.df = df
+        subbands = df['subband'].to_numpy()
+        timestamps = pd.to_datetime(df['timestamp']).to_numpy(dtype='datetime64[ns]')
+        valid = ~pd.isna(subbands)
+        rows = np.nonzero(valid)[0]
+        order = np.lexsort((timestamps[rows], subbands[rows].astype(np.int64)))
+        rows = rows[order]
+        sorted_subbands = subbands[rows].astype(np.int64)
+        bounds = np.flatnonzero(np.diff(sorted_subbands)) + 1
+        self._rows = {}
+        self._times = {}
+        for sb_rows in np.split(rows, bounds):
+            if len(sb_rows) == 0:
+                continue
+            subband = int(subbands[sb_rows[0]])
+            self._rows[subband] = sb_rows
+            self._times[subband] = timestamps[sb_rows]
+
+    @property
+    def subbands(self):
+        """Sorted list of the subbands in the index"""
+        return sorted(self._rows)
+
+    def rows(self, subband):
+        """
+        All observations of a subband
+        Args:
+            subband (int): Subband number.
+        Returns:
+            pd.DataFrame: Rows of the subband, sorted by timestamp.
+        """
+        return self.df.iloc[self._rows.get(int(subband), np.zeros(0, dtype=np.int64))]
+
+    def positions_at_or_after(self, subband, times):
+        """
+        Positions (as for df.iloc) of the first observations of a subband at or after the given times
+        Args:
+            subband (int): Subband number.
+            times: Times to look up, anything pd.to_datetime accepts.
+        Returns:
+            np.ndarray: Positions in the DataFrame, -1 where there is no observation at or after the time.
+        """
+        if np.ndim(times) == 0:
+            times = np.array([pd.Timestamp(times).to_datetime64()], dtype='datetime64[ns]')
+        else:
+            times = pd.to_datetime(times).to_numpy(dtype='datetime64[ns]')
+        sb_times = self._times.get(int(subband))
+        if sb_times is None:
+            return np.full(len(times), -1, dtype=np.int64)
+        ix = np.searchsorted(sb_times, times, side='left')
+        found = ix < len(sb_times)
+        return np.where(found, self._rows[int(subband)][np.minimum(ix, len(sb_times) - 1)], -1)
+
+    def plan(self, times, subbands):
+        """
+        First observation at or after every time for every subband, for planning a sweep
+        Args:
+            times (list): Times to look up.
+            subbands (list): Subband numbers.
+        Returns:
+            np.ndarray: Positions in the DataFrame, shape [len(times), len(subbands)], -1 where there is no
+                observation at or after the time.
+        """
+        positions = np.full((len(times), len(subbands)), -1, dtype=np.int64)
+        for sb_ix, subband in enumerate(subbands):
+            positions[:, sb_ix] = self.positions_at_or_after(subband, times)
+        return positions
+
+    def at_or_after(self, subband, t):
+        """
+        First observation of a subband at or after a time
+        Args:
+            subband (int): Subband number.
+            t: Time, anything pd.to_datetime accepts.
+        Returns:
+            pd.Series: Row of the DataFrame, or None if there is no observation at or after t.
+        """
+        position = self.positions_at_or_after(subband, t)[0]
+        return self.df.iloc[position] if position >= 0 else None
+
+
+class _SweepMovie:
+    """
+    Frames of one sweep movie: PNG paths that are collected in a list file and encoded at the end,
+    or rendered frames that are passed directly to a MovieWriter.
+    """
+
+    def __init__(self, temp_dir, output_dir, name, fps, save_png):
+        self.list_path = f"{temp_dir}/{name.replace('_movie_', '_image_list_')}.txt"
+        self.movie_path = f"{output_dir}/{name}.mp4"
+        self.fps = fps
+        self.paths = [] if save_png else None
+        self.writer = None if save_png else MovieWriter(self.movie_path, fps=fps)
+
+    def add(self, frame):
+        if self.writer is None:
+            self.paths.append(frame)
+        else:
+            self.writer.write(frame)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            return
+        # Export the image list for movie generation
+        with open(self.list_path, "w") as list_file:
+            list_file.write("\n".join(self.paths))
+        generate_movie_from_list(self.list_path, self.movie_path, fps=self.fps)
+
+
+class SweepJob(NamedTuple):
+    """One image of a sweep"""
+    dat_file: str
+    obstime: datetime.datetime
+    subband: int
+    height: float
+
+
+def plan_time_sweep(df, subbands, height, short_sweep=False, index=None):
+    """
+    Jobs for a time sweep: all observations of every subband, in time order
+    Args:
+        df (pd.DataFrame): DataFrame containing the data files and their metadata.
+        subbands (list): List of subbands to process.
+        height (float): Height for the plots.
+        short_sweep (bool): If True, only the first 3 time instants of the first subband.
+        index (ObservationIndex): Index of df, built from df if not given.
+    Returns:
+        List[SweepJob]: Jobs in movie order.
+    """
+    if index is None:
+        index = ObservationIndex(df)
+    if short_sweep:
+        subbands = subbands[:1]
+
+    jobs = []
+    for subband in subbands:
+        subband_data = index.rows(subband)
+        if short_sweep:
+            subband_data = subband_data.head(3)
+        for dat_file, obstime in zip(subband_data['dat_file'], subband_data['timestamp']):
+            jobs.append(SweepJob(dat_file, obstime, subband, height))
+    return jobs
+
+
+def plan_subband_sweep(df, times, subbands, heights, index=None):
+    """
+    Jobs for a subband or height sweep: for every time and subband the first observation at or after that time,
+    imaged at every height
+    Args:
+        df (pd.DataFrame): DataFrame containing the data files and their metadata.
+        times (list): List of times to process.
+        subbands (list): List of subbands to process.
+        heights (list): List of heights to process.
+        index (ObservationIndex): Index of df, built from df if not given.
+    Returns:
+        List[SweepJob]: Jobs in movie order.
+    """
+    if index is None:
+        index = ObservationIndex(df)
+
+    jobs = []
+    positions = index.plan(times, subbands)
+    for t, t_positions in zip(times, positions):
+        for subband, position in zip(subbands, t_positions):
+            if position < 0:
+                print(f"No data found for subband {subband} at {t}")
+                continue
+            closest_row = df.iloc[position]
+            for height in heights:
+                jobs.append(SweepJob(closest_row['dat_file'], closest_row['timestamp'], subband, height))
+    return jobs
+
+
+# Antenna database of a sweep worker process, set by _init_sweep_worker
+_worker_db = None
+
+
+def _limit_threads(n_threads):
+    """Limit the threads of numba, numexpr and (if threadpoolctl is installed) BLAS in this process"""
+    numba.set_num_threads(max(min(n_threads, numba.config.NUMBA_NUM_THREADS), 1))
+    numexpr.set_num_threads(max(n_threads, 1))
+    try:
+        import threadpoolctl
+    except ImportError:
+        return
+    threadpoolctl.threadpool_limits(max(n_threads, 1))
+
+
+def _init_sweep_worker(n_threads=None):
+    global _worker_db
+    _worker_db = LofarAntennaDatabase()
+    if n_threads is not None:
+        # Every worker would otherwise use all cores, n_workers times over
+        _limit_threads(n_threads)
+
+
+def _run_sweep_job(job, station_name, station_type, rcu_mode, caltable_dir, temp_dir, save_png, cache=None, db=None,
+                   collect_tracks=False, hdf5_filename=None):
+    """
+    Make the sky and near field image of one job
+
+    Returns the images (PNG paths if save_png, otherwise RGB frames), the error message (None on success),
+    the duration in seconds and, if collect_tracks, the records that were added to the tracking history.
+    """
+    start_time = time.time()
+    tracking_history = make_xst_plots.tracking_history
+    n_tracks = tracking_history.total
+    sky = nf = error = None
+    try:
+        visibilities = read_acm_cube(job.dat_file, station_type)[0]
+        plot_kwargs = dict(caltable_dir=caltable_dir, map_zoom=18, outputpath=temp_dir, mark_max_power=True,
+                           height=job.height, reuse_figures=True, db=db, hdf5_filename=hdf5_filename, cache=cache)
+        if save_png:
+            sky, nf, _ = make_xst_plots(visibilities, station_name, job.obstime, job.subband, rcu_mode,
+                                        return_only_paths=True, **plot_kwargs)
+        else:
+            sky, nf, _ = make_xst_plots(visibilities, station_name, job.obstime, job.subband, rcu_mode,
+                                        save_png=False, return_frames=True, **plot_kwargs)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+
+    tracks = []
+    if collect_tracks:
+        tracks = tracking_history.since(n_tracks)
+        tracking_history.clear()
+    return sky, nf, error, time.time() - start_time, tracks
+
+
+def _run_sweep_job_in_worker(job, job_number, *args):
+    # Workers can not write to the same HDF5 file, every job gets its own file that is merged afterwards
+    temp_dir = args[4]
+    hdf5_filename = os.path.join(temp_dir, f"results_job{job_number:06d}.h5")
+    return _run_sweep_job(job, *args, db=_worker_db, collect_tracks=True, hdf5_filename=hdf5_filename)
+
+
+def run_sweep(jobs, station_name, station_type, rcu_mode, temp_dir, caltable_dir, sky_movie=None, nf_movie=None,
+              save_png=True, n_workers=None, item_duration=None, cache=None):
+    """
+    Make the images of a list of sweep jobs and pass them to the movies in the order of the jobs
+    Args:
+        jobs (List[SweepJob]): Jobs, e.g. from plan_time_sweep or plan_subband_sweep.
+        station_name (str): Name of the station.
+        station_type (str): Type of the station.
+        rcu_mode (str): RCU mode.
+        temp_dir (str): Temporary directory for storing images.
+        caltable_dir (str): Caltable directory.
+        sky_movie: Receives the sky images, with a method add. None skips them.
+        nf_movie: Receives the near field images, with a method add. None skips them.
+        save_png (bool): If True, the images are saved as PNG and the paths are passed to the movies, otherwise
+            RGB frames are passed. Defaults to True.
+        n_workers (int): Number of worker processes, 0 runs all jobs in this process. Defaults to half the CPUs.
+            Each worker uses at most cpu_count // n_workers threads for numba, numexpr and BLAS.
+        item_duration (float): Expected duration of one job in seconds, e.g. from measure_processing_duration.
+            Used for the ETA until the first jobs are done.
+        cache (ResultCache): Cache for the sky and ground images, shared by the workers. Defaults to None.
+    Returns:
+        dict: Number of jobs, number of successful jobs, failed jobs with their errors and the total duration.
+    """
+    if n_workers is None:
+        n_workers = max((os.cpu_count() or 2) // 2, 1)
+
+    start_time = time.time()
+    durations = []
+    failures = []
+    job_args = (station_name, station_type, rcu_mode, caltable_dir, temp_dir, save_png, cache)
+
+    def handle_result(job, result, job_number=None):
+        sky, nf, error, duration, tracks = result
+        durations.append(duration)
+        for record in tracks:
+            make_xst_plots.tracking_history.append_record(record)
+        job_hdf5 = os.path.join(temp_dir, f"results_job{job_number:06d}.h5") if job_number is not None else None
+        if job_hdf5 is not None and os.path.exists(job_hdf5):
+            merge_hdf5(job_hdf5, os.path.join(temp_dir, "results.h5"))
+            os.remove(job_hdf5)
+        if error is not None:
+            print(f"Error generating image for {job.dat_file}: {error}")
+            failures.append((job, error))
+        else:
+            if sky_movie is not None:
+                sky_movie.add(sky)
+            if nf_movie is not None:
+                nf_movie.add(nf)
+
+        # Until jobs are done, use the expected duration for the ETA
+        per_item = np.mean(durations) if item_duration is None or len(durations) >= max(n_workers, 1) \
+            else item_duration
+        remaining = len(jobs) - len(durations)
+        eta = datetime.timedelta(seconds=int(remaining * per_item / max(n_workers, 1)))
+        print(f"  {len(durations)}/{len(jobs)} images, ETA {eta}", end='\r')
+
+    if n_workers == 0:
+        db = LofarAntennaDatabase()
+        for job in jobs:
+            handle_result(job, _run_sweep_job(job, *job_args, db=db))
+    elif len(jobs) > 0:
+        # Results are handled in job order; at most max_pending jobs are in flight
+        pending = collections.deque()
+        max_pending = 2 * n_workers
+
+        def handle_oldest():
+            job_number, future = pending.popleft()
+            handle_result(jobs[job_number], future.result(), job_number)
+        # Forking a process that has already made plots can hang at exit, so workers are started from
+        # a clean fork server where available
+        mp_context = multiprocessing.get_context("forkserver") \
+            if "forkserver" in multiprocessing.get_all_start_methods() else None
+        threads_per_worker = max((os.cpu_count() or 1) // n_workers, 1)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context,
+                                                    initializer=_init_sweep_worker,
+                                                    initargs=(threads_per_worker,)) as executor:
+            try:
+                for job_number, job in enumerate(jobs):
+                    while len(pending) >= max_pending:
+                        handle_oldest()
+                    pending.append((job_number, executor.submit(_run_sweep_job_in_worker, job, job_number,
+                                                                *job_args)))
+                while pending:
+                    handle_oldest()
+            except BaseException:
+                executor.shutdown(cancel_futures=True)
+                raise
+
+    summary = {
+        "number_of_jobs": len(jobs),
+        "number_succeeded": len(jobs) - len(failures),
+        "failures": failures,
+        "duration": time.time() - start_time
+    }
+    print()
+    print_sweep_summary(summary)
+    return summary
+
+
+def print_sweep_summary(summary):
+    print(f"Sweep done: {summary['number_succeeded']}/{summary['number_of_jobs']} images in "
+          f"{datetime.timedelta(seconds=int(summary['duration']))}")
+    for job, error in summary['failures']:
+        print(f"  Failed: subband {job.subband} at {job.obstime}, height {job.height} m ({job.dat_file}): {error}")
+
+
+def generate_time_sweep(df, subbands, height, station_name, station_type, rcu_mode, temp_dir, output_dir, caltable_dir: str = "../CalTables/", fps=10, short_sweep=False, save_png=True, index=None, n_workers=None, item_duration=None, cache=None):
     """
     Generate a time sweep movie from the given DataFrame and parameters.
     Args:
@@ -23,53 +405,36 @@ def generate_time_sweep(df, subbands, height, station_name, station_type, rcu_mo
         temp_dir (str): Temporary directory for storing images.
         output_dir (str): Output directory for the movie.
         fps (int): Frames per second for the movie.
+        save_png (bool): If True, save every frame as PNG in temp_dir (200 dpi, tight bounding box) and encode
+            the movie from those files. Otherwise frames are passed directly to the movie encoder, which is faster
+            but gives frames at the figure resolution (100 dpi) without cropping. Defaults to True.
+        index (ObservationIndex): Index of df, built from df if not given.
+        n_workers (int): Number of worker processes, see run_sweep.
+        item_duration (float): Expected duration per image for the ETA, e.g. from measure_processing_duration.
+        cache (ResultCache): Cache for the sky and ground images, so a rerun skips images that were made before.
         short_sweep (bool): If True, only process the first 3 time instants.
+    Returns:
+        dict: Summary of the sweep, see run_sweep.
     """
 
     print("Generating images for time sweep...")
 
-    sky_movie = []
-    nf_movie = []
+    jobs = plan_time_sweep(df, subbands, height, short_sweep=short_sweep, index=index)
 
-    if short_sweep:
-        subbands = subbands[:1]
-        subband_data = df[df['subband'] == subbands[0]].head(3)
-    else:
-        subband_data = None
-
-    # Loop to generate images for each subband and time
-    for subband in subbands:
-        if not short_sweep:
-            subband_data = df[df['subband'] == subband]
+    sky_movie = _SweepMovie(temp_dir, output_dir, "sky_movie_time_sweep", fps, save_png)
+    nf_movie = _SweepMovie(temp_dir, output_dir, "nf_movie_time_sweep", fps, save_png)
 
-        for index, row in subband_data.iterrows():
-            xst_filename = row['dat_file']
-            obstime = row['timestamp']
-
-            try:
-                print(f"Generating image for subband {subband} at time {obstime} and height {height} m.")
-                visibilities = read_acm_cube(xst_filename, station_type)[0]
-                sky_image_path, nf_image_path, _ = make_xst_plots(visibilities, station_name, obstime, subband, rcu_mode, caltable_dir=caltable_dir, map_zoom=18, outputpath=temp_dir, mark_max_power=True, height=height, return_only_paths=True)
-                sky_movie.append(sky_image_path)
-                nf_movie.append(nf_image_path)
-            except Exception as e:
-                print(f"Error generating image for {xst_filename}: {e}")
-
-    # Export the image lists for movie generation
-    with open(f"{temp_dir}/sky_image_list_time_sweep.txt", "w") as sky_file:
-        sky_file.write("\n".join(sky_movie))
-
-    with open(f"{temp_dir}/nf_image_list_time_sweep.txt", "w") as nf_file:
-        nf_file.write("\n".join(nf_movie))
+    summary = run_sweep(jobs, station_name, station_type, rcu_mode, temp_dir, caltable_dir, sky_movie, nf_movie,
+                        save_png=save_png, n_workers=n_workers, item_duration=item_duration, cache=cache)
 
     print("Image generation complete for time sweep.")
-    generate_movie_from_list(f"{temp_dir}/sky_image_list_time_sweep.txt", f"{output_dir}/sky_movie_time_sweep.mp4", fps=fps)
-    generate_movie_from_list(f"{temp_dir}/nf_image_list_time_sweep.txt", f"{output_dir}/nf_movie_time_sweep.mp4", fps=fps)
+    sky_movie.close()
+    nf_movie.close()
     print("Movie generation complete.")
-    return
+    return summary
 
 
-def generate_subband_sweep(df, times, subbands, height, station_name, station_type, rcu_mode, temp_dir, output_dir, caltable_dir: str = "../CalTables/", fps=10, short_sweep=False):
+def generate_subband_sweep(df, times, subbands, height, station_name, station_type, rcu_mode, temp_dir, output_dir, caltable_dir: str = "../CalTables/", fps=10, short_sweep=False, save_png=True, index=None, n_workers=None, item_duration=None, cache=None):
     '''
     Generate a subband sweep movie from the given DataFrame and parameters.
     Args:
@@ -83,58 +448,40 @@ def generate_subband_sweep(df, times, subbands, height, station_name, station_ty
         temp_dir (str): Temporary directory for storing images.
         output_dir (str): Output directory for the movie.
         fps (int): Frames per second for the movie.
+        save_png (bool): If True, save every frame as PNG in temp_dir (200 dpi, tight bounding box) and encode
+            the movie from those files. Otherwise frames are passed directly to the movie encoder, which is faster
+            but gives frames at the figure resolution (100 dpi) without cropping. Defaults to True.
+        index (ObservationIndex): Index of df, built from df if not given.
+        n_workers (int): Number of worker processes, see run_sweep.
+        item_duration (float): Expected duration per image for the ETA, e.g. from measure_processing_duration.
+        cache (ResultCache): Cache for the sky and ground images, so a rerun skips images that were made before.
         short_sweep (bool): If True, only process the first 3 subbands.
+    Returns:
+        dict: Summary of the sweep, see run_sweep.
     '''
 
     print("Generating images for subband sweep...")
 
-    sky_movie = []
-    nf_movie = []
-
     if short_sweep:
         subbands = subbands[:3]
         times = times[:1]
 
-    # Loop to generate images for each subband and time
-    for t in times:
-        for subband in subbands:
-            subband_data = df[df['subband'] == subband]
+    jobs = plan_subband_sweep(df, times, subbands, [height], index=index)
 
-            subband_data = subband_data[subband_data['timestamp'] >= t]
-            subband_data = subband_data.sort_values('timestamp')
-            closest_row = subband_data.iloc[0] if not subband_data.empty else None
+    sky_movie = _SweepMovie(temp_dir, output_dir, "sky_movie_subband_sweep", fps, save_png)
+    nf_movie = _SweepMovie(temp_dir, output_dir, "nf_movie_subband_sweep", fps, save_png)
 
-            if closest_row is None:
-                print(f"No data found for subband {subband} at {t}")
-                continue
-
-            xst_filename = closest_row['dat_file']
-            obstime = closest_row['timestamp']
-
-            try:
-                print(f"Generating image for subband {subband} at time {obstime} and height {height} m.")
-                visibilities = read_acm_cube(xst_filename, station_type)[0]
-                sky_image_path, nf_image_path, _ = make_xst_plots(visibilities, station_name, obstime, subband, rcu_mode, caltable_dir=caltable_dir, map_zoom=18, outputpath=temp_dir, mark_max_power=True, height=height, return_only_paths=True)
-                sky_movie.append(sky_image_path)
-                nf_movie.append(nf_image_path)
-            except Exception as e:
-                print(f"Error generating image for {xst_filename}: {e}")
-
-    # Export the image lists for movie generation
-    with open(f"{temp_dir}/sky_image_list_subband_sweep.txt", "w") as sky_file:
-        sky_file.write("\n".join(sky_movie))
-
-    with open(f"{temp_dir}/nf_image_list_subband_sweep.txt", "w") as nf_file:
-        nf_file.write("\n".join(nf_movie))
+    summary = run_sweep(jobs, station_name, station_type, rcu_mode, temp_dir, caltable_dir, sky_movie, nf_movie,
+                        save_png=save_png, n_workers=n_workers, item_duration=item_duration, cache=cache)
 
     print("Image generation complete for subband sweep.")
-    generate_movie_from_list(f"{temp_dir}/sky_image_list_subband_sweep.txt", f"{output_dir}/sky_movie_subband_sweep.mp4", fps=fps)
-    generate_movie_from_list(f"{temp_dir}/nf_image_list_subband_sweep.txt", f"{output_dir}/nf_movie_subband_sweep.mp4", fps=fps)
+    sky_movie.close()
+    nf_movie.close()
     print("Movie generation complete.")
-    return
+    return summary
 
 
-def generate_height_sweep(df, times, subbands, heights, station_name, station_type, rcu_mode, temp_dir, output_dir, caltable_dir: str = "../CalTables/", fps=10, short_sweep=False):
+def generate_height_sweep(df, times, subbands, heights, station_name, station_type, rcu_mode, temp_dir, output_dir, caltable_dir: str = "../CalTables/", fps=10, short_sweep=False, save_png=True, index=None, n_workers=None, item_duration=None, cache=None):
     '''
     Generate a height sweep movie from the given DataFrame and parameters.
     Args:
@@ -148,53 +495,36 @@ def generate_height_sweep(df, times, subbands, heights, station_name, station_ty
         temp_dir (str): Temporary directory for storing images.
         output_dir (str): Output directory for the movie.
         fps (int): Frames per second for the movie.
+        save_png (bool): If True, save every frame as PNG in temp_dir (200 dpi, tight bounding box) and encode
+            the movie from those files. Otherwise frames are passed directly to the movie encoder, which is faster
+            but gives frames at the figure resolution (100 dpi) without cropping. Defaults to True.
+        index (ObservationIndex): Index of df, built from df if not given.
+        n_workers (int): Number of worker processes, see run_sweep.
+        item_duration (float): Expected duration per image for the ETA, e.g. from measure_processing_duration.
+        cache (ResultCache): Cache for the sky and ground images, so a rerun skips images that were made before.
         short_sweep (bool): If True, only process the first 3 heights.
+    Returns:
+        dict: Summary of the sweep, see run_sweep.
     '''
 
     print("Generating images for height sweep...")
 
-    sky_movie = []
-    nf_movie = []
-
     if short_sweep:
         subbands = subbands[:1]
         times = times[:1]
         heights = heights[:3]
 
-    # Loop to generate images for each subband and time
-    for t in times:
-        for subband in subbands:
-            subband_data = df[df['subband'] == subband]
+    jobs = plan_subband_sweep(df, times, subbands, heights, index=index)
 
-            subband_data = subband_data[subband_data['timestamp'] >= t]
-            subband_data = subband_data.sort_values('timestamp')
-            closest_row = subband_data.iloc[0] if not subband_data.empty else None
+    nf_movie = _SweepMovie(temp_dir, output_dir, "nf_movie_height_sweep", fps, save_png)
 
-            if closest_row is None:
-                print(f"No data found for subband {subband} at {t}")
-                continue
-
-            for height in heights:
-                xst_filename = closest_row['dat_file']
-                obstime = closest_row['timestamp']
-
-                try:
-                    print(f"Generating image for subband {subband} at time {obstime} and height {height} m.")
-                    visibilities = read_acm_cube(xst_filename, station_type)[0]
-                    sky_image_path, nf_image_path, _ = make_xst_plots(visibilities, station_name, obstime, subband, rcu_mode, caltable_dir=caltable_dir, map_zoom=18, outputpath=temp_dir, mark_max_power=True, height=height, return_only_paths=True)
-                    sky_movie.append(sky_image_path)
-                    nf_movie.append(nf_image_path)
-                except Exception as e:
-                    print(f"Error generating image for {xst_filename}: {e}")
-
-    # Export the image list for movie generation
-    with open(f"{temp_dir}/nf_image_list_height_sweep.txt", "w") as nf_file:
-        nf_file.write("\n".join(nf_movie))
+    summary = run_sweep(jobs, station_name, station_type, rcu_mode, temp_dir, caltable_dir, nf_movie=nf_movie,
+                        save_png=save_png, n_workers=n_workers, item_duration=item_duration, cache=cache)
 
     print("Image generation complete for height sweep.")
-    generate_movie_from_list(f"{temp_dir}/nf_image_list_height_sweep.txt", f"{output_dir}/nf_movie_height_sweep.mp4", fps=fps)
+    nf_movie.close()
     print("Movie generation complete.")
-    return
+    return summary
 
 
 def get_number_of_measurements_time_sweep(df, subbands, short_sweep=False):
@@ -1,48 +1,139 @@
 import imageio
 import os
+import collections
+import concurrent.futures
+import multiprocessing
 import numpy as np
-import matplotlib.pyplot as plt
 
-from lofarimaging import sky_imager, make_sky_plot
+from lofarimaging import sky_imager_batch, SkyPlotTemplate
 
-def make_sky_video(visibilities_all, baselines, freq, marked_all_lmn, marked_sats_traj_lmn, station_name, subband, obstime, 
-                   fname, t_end, t_start=0, step=1, npix=131, fps=5, output_dir='./videoresult'):
+# Plot template of a render worker process, set by _init_render_worker
+_worker_template = None
 
+
+def _make_template(npix, station_name, marked_all_lmn, marked_sats_traj_lmn):
+    """One figure for all frames, only the image and the subtitle change"""
+    template = SkyPlotTemplate((npix, npix), title=f"Sky image {station_name}")
+    template.update(np.zeros((npix, npix)), marked_bodies_lmn=marked_all_lmn)
+    for sat_name, (l, m, n) in marked_sats_traj_lmn.items():
+        template.plot(l, m, color='white', linestyle='-', alpha=0.3, linewidth=0.8)
+    return template
+
+
+def _init_render_worker(npix, station_name, marked_all_lmn, marked_sats_traj_lmn):
+    global _worker_template
+    _worker_template = _make_template(npix, station_name, marked_all_lmn, marked_sats_traj_lmn)
+
+
+def _render_frame(img_t, subtitle, template=None):
+    """Render one sky image to RGB, on the given template or the template of this worker"""
+    template = template if template is not None else _worker_template
+    template.update(img_t, subtitle=subtitle)
+    return template.to_rgb()
+
+
+def make_sky_video(visibilities_all, baselines, freq, marked_all_lmn, marked_sats_traj_lmn, station_name, subband, obstime,
+                   fname, t_end, t_start=0, step=1, npix=131, fps=5, output_dir='./videoresult', video_format='gif',
+                   batch_size=16, n_workers=None, background=None):
+    """
+    Image every time step of an observation and write the sky images as a video
+
+    Frames are imaged in batches with sky_imager_batch, rendered in parallel worker processes and appended
+    to the video while the next frames are rendered, so memory use does not grow with the number of frames.
+
+    Args:
+        visibilities_all: visibilities, shape [n_time, n_ant, n_ant]
+        baselines: baselines, shape [n_ant, n_ant, 3]
+        freq: frequency in Hz
+        marked_all_lmn: dict with bodies to mark, name -> (l, m, n)
+        marked_sats_traj_lmn: dict with satellite trajectories to plot, name -> (l array, m array, n array)
+        station_name: station name for the title
+        subband: subband for the subtitle
+        obstime: observation time
+        fname: prefix for the output filename
+        t_end: last time index (exclusive)
+        t_start: first time index. Defaults to 0
+        step: step in time index. Defaults to 1
+        npix: number of pixels in l and m. Defaults to 131
+        fps: frames per second. Defaults to 5
+        output_dir: output directory. Defaults to './videoresult'
+        video_format: 'gif' or 'mp4'. Defaults to 'gif'
+        batch_size: number of frames imaged in one call of sky_imager_batch. Defaults to 16
+        n_workers: number of render processes, 0 renders in this process. Defaults to half the CPUs
+        background: background model (e.g. EwmaBackground or RunningMedianBackground) that is updated with the
+            visibilities of every frame; the residual visibilities are imaged. Frames seen while the model is
+            not ready are skipped. Defaults to None (image the visibilities as they are)
+
+    Returns:
+        str: path of the video
+    """
     os.makedirs(output_dir, exist_ok=True)
-   
-    # static background
-    #n_med = min(n_for_median, visibilities_all.shape[0])
-    #vis_median = np.median(visibilities_all[:n_med], axis=0)
-    #print(f"Median background")
+
+    if video_format not in ('gif', 'mp4'):
+        raise ValueError(f"Unsupported video format: {video_format}")
+    if n_workers is None:
+        n_workers = max((os.cpu_count() or 2) // 2, 1)
 
     timesteps = range(t_start, t_end, step)
+    video_path = os.path.join(output_dir, f'{fname}_skyvideo_fps{fps}.{video_format}')
+
+    if video_format == 'mp4':
+        # The frames are 1000x1000 pixels, which is a multiple of 8
+        writer = imageio.get_writer(video_path, fps=fps, macro_block_size=8)
+    else:
+        writer = imageio.get_writer(video_path, fps=fps)
+
+    template_args = (npix, station_name, marked_all_lmn, marked_sats_traj_lmn)
+    if n_workers > 0:
+        # Forking after the imager has started its threads can hang at exit, so workers are started from
+        # a clean fork server where available
+        mp_context = multiprocessing.get_context("forkserver") \
+            if "forkserver" in multiprocessing.get_all_start_methods() else None
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context,
+                                                          initializer=_init_render_worker, initargs=template_args)
+        template = None
+    else:
+        executor = None
+        template = _make_template(*template_args)
+
+    # Rendered frames are written in order; at most max_pending frames are in flight
+    pending = collections.deque()
+    max_pending = 2 * max(n_workers, 1)
+
+    def write_oldest():
+        writer.append_data(pending.popleft().result())
+
+    try:
+        for batch_start in range(0, len(timesteps), batch_size):
+            batch = timesteps[batch_start:batch_start + batch_size]
+            if background is None:
+                visibilities = [visibilities_all[t_idx] for t_idx in batch]
+            else:
+                # In time order, the model has to see the frames one after the other
+                residuals = [(t_idx, background.update(visibilities_all[t_idx])) for t_idx in batch]
+                batch = [t_idx for t_idx, residual in residuals if residual is not None]
+                visibilities = [residual for _, residual in residuals if residual is not None]
+            if not batch:
+                continue
+            images = sky_imager_batch(visibilities, baselines, freq, npix, npix)
+
+            for t_idx, img_t in zip(batch, images):
+                subtitle = f"SB {subband} ({freq/1e6:.1f} MHz) — t={t_idx}"
+                if executor is None:
+                    writer.append_data(_render_frame(img_t, subtitle, template))
+                    continue
+                while len(pending) >= max_pending:
+                    write_oldest()
+                pending.append(executor.submit(_render_frame, img_t, subtitle))
+
+            print(f"  Frame {min(batch_start + batch_size, len(timesteps))}/{len(timesteps)}", end='\r')
+
+        while pending:
+            write_oldest()
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        writer.close()
 
-    frames = []
-    for i, t_idx in enumerate(timesteps):
-        #vis_residual = visibilities_all[t_idx] - vis_median
-        img_t = sky_imager(visibilities_all[t_idx], baselines, freq, npix, npix)
-        frames.append(img_t)
-        print(f"  Frame {i+1}/{len(timesteps)}", end='\r')
-    print(f"\nAll frames done")
-
-    # render and save GIF
-    gif_path = os.path.join(output_dir, f'{fname}_skyvideo_fps{fps}.gif')
-    gif_frames = []
-
-    for i, img_t in enumerate(frames):
-        t_idx = t_start + i * step
-        fig = make_sky_plot(img_t, marked_all_lmn, title=f"Sky image {station_name}", 
-                            subtitle=f"SB {subband} ({freq/1e6:.1f} MHz) — t={t_idx}")
-        
-        for sat_name, (l, m, n) in marked_sats_traj_lmn.items():
-            fig.axes[0].plot(l, m, color='white', linestyle='-', alpha=0.3, linewidth=0.8)
-
-        fig.canvas.draw()
-        frame_img = np.frombuffer(fig.canvas.tostring_rgb(), dtype=np.uint8)
-        frame_img = frame_img.reshape(fig.canvas.get_width_height()[::-1] + (3,))
-        gif_frames.append(frame_img)
-        plt.close(fig)
-
-    imageio.mimsave(gif_path, gif_frames, fps=fps)
-    print(f"GIF saved: {gif_path}")
-    return gif_path
\ No newline at end of file
+    print(f"\nVideo saved: {video_path}")
+    return video_path
@@ -1,7 +1,11 @@
 """Functions for working with LOFAR single station data"""
 
 import os
+import sys
 import datetime
+import subprocess
+import tempfile
+import concurrent.futures
 from typing import List, Dict, Tuple, Union
 import threading
 
@@ -29,14 +33,20 @@ from lofarantpos.db import LofarAntennaDatabase
 import lofarantpos
 
 from .maputil import get_map, make_leaflet_map
-from .lofarimaging import nearfield_imager, sky_imager, skycoord_to_lmn, subtract_sources
+from .lofarimaging import (nearfield_imager, nearfield_imager_batch, nearfield_peak, sky_imager_batch,
+                           skycoord_to_lmn, subtract_sources, stokes_visibilities)
 from .hdf5util import write_hdf5
+from .fastplot import render_sky_image, render_ground_image, write_png, ground_overlay
+from .plottemplate import SkyPlotTemplate, GroundPlotTemplate, get_plot_template
+from .trackstore import PeakTrackStore
+from .resultcache import ResultCache
 
 
 __all__ = ["sb_from_freq", "freq_from_sb", "find_caltable", "read_caltable",
            "rcus_in_station", "read_acm_cube", "get_station_pqr", "get_station_xyz", "get_station_type",
            "make_sky_plot", "make_ground_plot", "make_xst_plots", "apply_calibration",
-           "get_full_station_name", "get_extent_lonlat", "make_sky_movie", "reimage_sky"]
+           "get_full_station_name", "get_extent_lonlat", "make_sky_movie", "reimage_sky", "figure_to_rgb",
+           "locate_xst_peak"]
 
 __version__ = "1.5.0"
 
@@ -52,7 +62,7 @@ GENERIC_REMOTE_201512 = [0, 13, 12, 4, 11, 11, 7, 8, 2, 7, 11, 2, 10, 2, 6, 3, 8
 
 assert version.parse(lofarantpos.__version__) >= version.parse("0.4.0")
 
-tracking_lock = threading.Lock()
+tracking_lock = threading.RLock()
 
 
 def sb_from_freq(freq: float, rcu_mode: Union[int, str] = 1) -> int:
@@ -628,6 +638,69 @@ def get_extent_lonlat(extent_m: List[int],
     return [lon_min, lon_max, lat_min, lat_max]
 
 
+def figure_to_rgb(fig: Figure) -> np.ndarray:
+    """
+    Draw a figure and return it as an RGB array
+
+    Args:
+        fig: matplotlib figure with an Agg-based canvas
+
+    Returns:
+        np.ndarray: RGB image as uint8, shape [height, width, 3]
+    """
+    fig.canvas.draw()
+    return np.asarray(fig.canvas.buffer_rgba())[:, :, :3].copy()
+
+
+def _cached_image(cache: ResultCache, compute, **key_parts) -> np.ndarray:
+    """Image from the cache if it was computed before, otherwise compute() which is then stored"""
+    if cache is None:
+        return compute()
+    key = cache.key(**key_parts)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached["image"]
+    image = compute()
+    cache.put(key, image=image)
+    return image
+
+
+def _image_key(visibilities: np.ndarray, station_name: str, rcu_mode: Union[str, int], subband: int,
+               subtract: List[str], obstime, stokes: str) -> Dict:
+    """
+    Cache key parts of an image of calibrated data, shared by make_xst_plots (and the sweeps) and reimage_*
+
+    The values are normalised to what is stored in the HDF5 file (short station name, obstime to the second),
+    so that reimaging an observation finds the images of make_xst_plots. The Sun and Moon positions, and thus
+    obstime, only matter when subtracting.
+    """
+    return dict(visibilities=visibilities, station_name=str(station_name)[:5], rcu_mode=str(rcu_mode),
+                subband=int(subband), subtract=subtract,
+                obstime=str(obstime)[:19] if subtract is not None else None, stokes=stokes)
+
+
+def _per_stokes(results: Dict):
+    """The result for a single Stokes parameter as is, a dict Stokes parameter -> result for several"""
+    return next(iter(results.values())) if len(results) == 1 else results
+
+
+def _pixel_to_metre(pixel: float, npix: int, lower: float, upper: float) -> float:
+    """
+    Position of a (fractional) pixel of the near-field imaging grid, np.linspace(lower, upper, npix)
+
+    This is where nearfield_imager evaluates the image, and the convention of nearfield_peak, so that peaks
+    from make_xst_plots and locate_xst_peak can be compared in tracking_history.
+    """
+    return lower + pixel * (upper - lower) / max(npix - 1, 1)
+
+
+def _peak_lonlat(x: float, y: float, height: float, station_name: str, pqr_to_xyz: np.ndarray) -> Tuple[float, float]:
+    """Longitude and latitude of a point in station XYZ"""
+    [p, q, _] = pqr_to_xyz.T @ np.array([x, y, height])
+    lon, lat, _ = lofargeotiff.pqr_to_longlatheight([p, q], station_name)
+    return lon, lat
+
+
 def make_xst_plots(xst_data: np.ndarray,
                    station_name: str,
                    obstime: datetime.datetime,
@@ -648,7 +721,15 @@ def make_xst_plots(xst_data: np.ndarray,
                    outputpath: str = "results",
                    subtract: List[str] = None,
                    mark_max_power: bool = False,
-                   return_only_paths: bool = False):
+                   return_only_paths: bool = False,
+                   fast_render: bool = False,
+                   reuse_figures: bool = False,
+                   save_png: bool = True,
+                   return_frames: bool = False,
+                   db: LofarAntennaDatabase = None,
+                   cache: ResultCache = None,
+                   nearfield_engine: str = "exact",
+                   stokes: str = "I"):
     """
     Create sky and ground plots for an XST file
 
@@ -669,10 +750,33 @@ def make_xst_plots(xst_data: np.ndarray,
         outputpath: Directory where results can be saved. Defaults to 'results'
         subtract: List of sources to subtract. Defaults to None
         return_only_paths: Return only the paths instead of images. Defaults to False
-
+        fast_render: Write the PNGs with the fast rasterizer from fastplot instead of matplotlib figures.
+                     The PNGs have the same resolution (200 dpi) as the matplotlib ones, but no contours are drawn
+                     and the figures returned are None. Defaults to False
+        reuse_figures: Draw on plot templates that are kept per thread and reused for the next call with the
+                       same layout, instead of creating new figures (see get_plot_template). The templates are
+                       overwritten by the next call, so the figures returned are None. Defaults to False
+        save_png: Save the sky and near field images as PNG in outputpath. If False, the paths returned are
+                  None. Defaults to True
+        return_frames: Return the rendered sky and near field images as RGB arrays (uint8, shape
+                       [height, width, 3]) instead of figures, e.g. to pass to a MovieWriter. Defaults to False
+        db: instance of LofarAntennaDatabase to reuse. Defaults to a new instance
+        cache: ResultCache to take the sky and ground images from if they were computed before with the same
+               calibrated data and settings, and to store new images in. Defaults to None (no caching)
+        nearfield_engine: "exact" or "fresnel", see nearfield_imager. "fresnel" is much faster for extents of
+                          many hundreds of metres. Defaults to "exact"
+        stokes: Stokes parameters to image, e.g. "I", "IQUV" or ["I", "V"] (see stokes_visibilities). All of them
+                are imaged in one pass (with the "exact" engine), which costs little more than Stokes I alone.
+                The PNGs of parameters other than I get the suffix _stokes<parameter>, the leaflet map shows the
+                first one. Sources are only subtracted from Stokes I. Defaults to "I"
+
+    The location and power of the maximum of the Stokes I ground image are appended to the PeakTrackStore
+    make_xst_plots.tracking_history. The location is that of the pixel on the imaging grid, which spans the
+    extent including both ends (np.linspace), as for locate_xst_peak.
 
     Returns:
-        Sky_figure, ground_figure, Leaflet map
+        Sky_figure, ground_figure, Leaflet map (or sky_frame, ground_frame, Leaflet map with return_frames).
+        With more than one Stokes parameter, the sky and ground results are dicts Stokes parameter -> result.
 
     Example:
         >>> xst_data = read_acm_cube("test/20170720_095816_mode_3_xst_sb297.dat", "intl")[0]
@@ -721,13 +825,12 @@ def make_xst_plots(xst_data: np.ndarray,
 
     # Split into the XX and YY polarisations (RCUs)
     # This needs to be modified in future for LBA sparse
-    visibilities_xx = visibilities[0::2, 0::2]
-    visibilities_yy = visibilities[1::2, 1::2]
-    # Stokes I
-    visibilities_stokes_i = visibilities_xx + visibilities_yy
+    stokes = "".join(stokes)
+    visibilities_stokes = stokes_visibilities(visibilities, stokes)
 
     # Setup the database
-    db = LofarAntennaDatabase()
+    if db is None:
+        db = LofarAntennaDatabase()
 
     station_xyz, pqr_to_xyz = get_station_xyz(station_name, rcu_mode, db)
 
@@ -761,46 +864,97 @@ def make_xst_plots(xst_data: np.ndarray,
         if body_coord.transform_to(AltAz(location=station_earthlocation, obstime=obstime_astropy)).alt > 0:
             marked_bodies_lmn[body_name] = skycoord_to_lmn(marked_bodies[body_name], zenith)
 
-    if subtract is not None:
-        visibilities_stokes_i = subtract_sources(visibilities_stokes_i, baselines, freq, marked_bodies_lmn, subtract)
-
-    sky_img = sky_imager(visibilities_stokes_i, baselines, freq, npix_l, npix_m)
+    if subtract is not None and stokes != "I":
+        print(f"Warning: sources are only subtracted from Stokes I, not from Stokes {stokes.replace('I', '')}")
+        if "I" not in stokes:
+            subtract = None
 
-    marked_bodies_lmn_only3 = {k: v for (k, v) in marked_bodies_lmn.items() if k in ('Cas A', 'Cyg A', 'Sun')}
+    if subtract is not None:
+        stokes_i = stokes.index("I")
+        visibilities_stokes[stokes_i] = subtract_sources(visibilities_stokes[stokes_i], baselines, freq,
+                                                         marked_bodies_lmn, subtract)
 
-    # Plot the resulting sky image
-    sky_fig = plt.figure(figsize=(10, 10))
+    # The images depend on the calibrated data and these settings
+    image_key = _image_key(visibilities, station_name, rcu_mode, subband, subtract, obstime, stokes)
 
-    if sky_vmin is None and subtract is not None:
-        # Tendency to oversubtract, we don't want to see that
-        sky_vmin = np.quantile(sky_img, 0.05)
+    # All Stokes parameters in one pass, shape [len(stokes), npix_m, npix_l]
+    sky_imgs = _cached_image(cache, lambda: sky_imager_batch(visibilities_stokes, baselines, freq, npix_l, npix_m),
+                             kind="sky_imgs", npix=(npix_l, npix_m), **image_key)
 
-    make_sky_plot(sky_img, marked_bodies_lmn_only3, title=f"Sky image for {station_name}",
-                  subtitle=f"SB {subband} ({freq / 1e6:.1f} MHz), {str(obstime)[:16]}", fig=sky_fig,
-                  vmin=sky_vmin, vmax=sky_vmax)
+    marked_bodies_lmn_only3 = {k: v for (k, v) in marked_bodies_lmn.items() if k in ('Cas A', 'Cyg A', 'Sun')}
 
-    sky_image_path = os.path.join(outputpath, f"sky_{fname}_calibrated.png")
-    sky_fig.savefig(sky_image_path, bbox_inches='tight', dpi=200)
-    plt.close(sky_fig)
+    sky_image_paths, sky_figs, sky_frames = {}, {}, {}
+    for parameter, sky_img in zip(stokes, sky_imgs):
+        title_suffix = "" if parameter == "I" else f", Stokes {parameter}"
+        png_suffix = "" if parameter == "I" else f"_stokes{parameter}"
+
+        parameter_vmin = sky_vmin
+        if parameter_vmin is None and subtract is not None and parameter == "I":
+            # Tendency to oversubtract, we don't want to see that
+            parameter_vmin = np.quantile(sky_img, 0.05)
+
+        sky_image_path = os.path.join(outputpath, f"sky_{fname}_calibrated{png_suffix}.png") if save_png else None
+        sky_frame = None
+
+        # Plot the resulting sky image
+        if fast_render:
+            sky_fig = None
+            sky_frame = render_sky_image(sky_img, marked_bodies_lmn_only3,
+                                         title=f"Sky image for {station_name}{title_suffix}",
+                                         subtitle=f"SB {subband} ({freq / 1e6:.1f} MHz), {str(obstime)[:16]}",
+                                         vmin=parameter_vmin, vmax=sky_vmax, dpi=200)
+            if save_png:
+                write_png(sky_image_path, sky_frame)
+        elif reuse_figures:
+            sky_template = get_plot_template(
+                ("sky", sky_img.shape, station_name, parameter),
+                lambda: SkyPlotTemplate(sky_img.shape, title=f"Sky image for {station_name}{title_suffix}"))
+            sky_template.update(sky_img, subtitle=f"SB {subband} ({freq / 1e6:.1f} MHz), {str(obstime)[:16]}",
+                                vmin=parameter_vmin, vmax=sky_vmax, marked_bodies_lmn=marked_bodies_lmn_only3)
+            if save_png:
+                sky_template.savefig(sky_image_path, bbox_inches='tight', dpi=200)
+            if return_frames:
+                sky_frame = sky_template.to_rgb()
+            sky_fig = None
+        else:
+            sky_fig = plt.figure(figsize=(10, 10))
+            make_sky_plot(sky_img, marked_bodies_lmn_only3, title=f"Sky image for {station_name}{title_suffix}",
+                          subtitle=f"SB {subband} ({freq / 1e6:.1f} MHz), {str(obstime)[:16]}", fig=sky_fig,
+                          vmin=parameter_vmin, vmax=sky_vmax)
+            if save_png:
+                sky_fig.savefig(sky_image_path, bbox_inches='tight', dpi=200)
+            if return_frames:
+                sky_frame = figure_to_rgb(sky_fig)
+            plt.close(sky_fig)
+
+        sky_image_paths[parameter], sky_figs[parameter], sky_frames[parameter] = sky_image_path, sky_fig, sky_frame
 
     if sky_only:
-        return sky_fig
+        return _per_stokes(sky_frames if return_frames else sky_figs)
 
     npix_x, npix_y = int(ground_resolution * (extent[1] - extent[0])), int(ground_resolution * (extent[3] - extent[2]))
 
     os.environ["NUMEXPR_NUM_THREADS"] = "3"
 
-    # Select a subset of visibilities, only the lower triangular part
-    baseline_indices = np.tril_indices(visibilities_stokes_i.shape[0])
-
-    visibilities_selection = visibilities_stokes_i[baseline_indices]
-
-    ground_img = nearfield_imager(visibilities_selection.flatten()[:, np.newaxis],
-                                  np.array(baseline_indices).T,
-                                  [freq], npix_x, npix_y, extent, station_xyz, height=height)
-
-    # Correct for taking only lower triangular part
-    ground_img = np.real(2 * ground_img)
+    def compute_ground_imgs():
+        if nearfield_engine == "exact":
+            # All Stokes parameters in one pass
+            return nearfield_imager_batch(visibilities_stokes, freq, npix_x, npix_y, extent, station_xyz,
+                                          height=height)
+        # Select a subset of visibilities, only the lower triangular part
+        baseline_indices = np.tril_indices(visibilities_stokes.shape[1])
+        ground_imgs = [nearfield_imager(vis[baseline_indices].flatten()[:, np.newaxis],
+                                        np.array(baseline_indices).T,
+                                        [freq], npix_x, npix_y, extent, station_xyz, height=height,
+                                        engine=nearfield_engine)
+                       for vis in visibilities_stokes]
+
+        # Correct for taking only lower triangular part
+        return np.real(2 * np.array(ground_imgs))
+
+    ground_imgs = _cached_image(cache, compute_ground_imgs, kind="ground_imgs", coordinates="xyz",
+                                extent=list(extent), npix=(npix_x, npix_y), height=float(height),
+                                engine=nearfield_engine, **image_key)
 
     # Convert bottom left and upper right to PQR just for lofargeo
     lon_center, lat_center, _ = lofargeotiff.pqr_to_longlatheight([0, 0, 0], station_name)
@@ -809,45 +963,76 @@ def make_xst_plots(xst_data: np.ndarray,
 
     background_map = get_map(*extent_lonlat, zoom=map_zoom)
 
-    # Find maximum power and its location
-    maxpower = np.max(ground_img)
-    maxpower_dB = 10 * np.log10(maxpower)
-    maxpixel_ypix, maxpixel_xpix = np.unravel_index(np.argmax(ground_img), ground_img.shape)
-    maxpixel_x = np.interp(maxpixel_xpix, [0, npix_x], [extent[0], extent[1]])
-    maxpixel_y = np.interp(maxpixel_ypix, [0, npix_y], [extent[2], extent[3]])
-    [maxpixel_p, maxpixel_q, _] = pqr_to_xyz.T @ np.array([maxpixel_x, maxpixel_y, height])
-    maxpixel_lon, maxpixel_lat, _ = lofargeotiff.pqr_to_longlatheight([maxpixel_p, maxpixel_q], station_name)
-
-    # Store tracking data in global state or return it
-    if not hasattr(make_xst_plots, "tracking_history"):
-        make_xst_plots.tracking_history = []
-
-    with tracking_lock:
-        make_xst_plots.tracking_history.append({
-            "timestamp": obstime.isoformat(),
-            "lat": float(maxpixel_lat),
-            "lon": float(maxpixel_lon),
-            "x_m": float(maxpixel_x),
-            "y_m": float(maxpixel_y),
-            "power_db": float(maxpower_dB),
-            "subband": int(subband)
-        })
-
-
-    # Show location of maximum
-    #print(f"Maximum of {maxpower_dB:.2f} dB at {maxpixel_x:.0f}m east, {maxpixel_y:.0f}m north of station center " +
-    #      f"(lat/long {maxpixel_lat:.5f}, {maxpixel_lon:.5f})")
-
-    # Mark ground_img maximum with a red circle around it
-    ground_fig, folium_overlay = make_ground_plot(ground_img, background_map, extent,
-                                                  title=f"Near field image for {station_name}",
-                                                  subtitle=f"SB {subband} ({freq / 1e6:.1f} MHz), {str(obstime)[:16]}, {height:.1f} m",
-                                                  opacity=opacity, vmin=ground_vmin, vmax=ground_vmax,
-                                                  mark_max_power=mark_max_power)
-
-    nf_image_path = os.path.join(outputpath, f"nearfield_{fname}_calibrated.png")
-    ground_fig.savefig(nf_image_path, bbox_inches='tight', dpi=200)
-    plt.close(ground_fig)
+    # Find maximum power and its location, only Stokes I is tracked
+    if "I" in stokes:
+        ground_img = ground_imgs[stokes.index("I")]
+        maxpower = np.max(ground_img)
+        maxpower_dB = 10 * np.log10(maxpower)
+        maxpixel_ypix, maxpixel_xpix = np.unravel_index(np.argmax(ground_img), ground_img.shape)
+        maxpixel_x = _pixel_to_metre(maxpixel_xpix, npix_x, extent[0], extent[1])
+        maxpixel_y = _pixel_to_metre(maxpixel_ypix, npix_y, extent[2], extent[3])
+        maxpixel_lon, maxpixel_lat = _peak_lonlat(maxpixel_x, maxpixel_y, height, station_name, pqr_to_xyz)
+
+        # Store tracking data in the global peak track store
+        make_xst_plots.tracking_history.append(obstime, lat=float(maxpixel_lat), lon=float(maxpixel_lon),
+                                               x_m=float(maxpixel_x), y_m=float(maxpixel_y),
+                                               power_db=float(maxpower_dB), subband=int(subband))
+
+        # Show location of maximum
+        #print(f"Maximum of {maxpower_dB:.2f} dB at {maxpixel_x:.0f}m east, {maxpixel_y:.0f}m north of station center " +
+        #      f"(lat/long {maxpixel_lat:.5f}, {maxpixel_lon:.5f})")
+
+    nf_image_paths, ground_figs, ground_frames, folium_overlays = {}, {}, {}, {}
+    for parameter, ground_img in zip(stokes, ground_imgs):
+        title_suffix = "" if parameter == "I" else f", Stokes {parameter}"
+        png_suffix = "" if parameter == "I" else f"_stokes{parameter}"
+
+        nf_image_path = os.path.join(outputpath, f"nearfield_{fname}_calibrated{png_suffix}.png") if save_png else None
+        ground_frame = None
+
+        # Mark ground_img maximum with a red circle around it
+        if fast_render:
+            ground_fig = None
+            ground_frame = render_ground_image(ground_img, background_map, extent,
+                                               title=f"Near field image for {station_name}{title_suffix}",
+                                               subtitle=f"SB {subband} ({freq / 1e6:.1f} MHz), {str(obstime)[:16]}, {height:.1f} m",
+                                               opacity=opacity, vmin=ground_vmin, vmax=ground_vmax,
+                                               mark_max_power=mark_max_power,
+                                               background_key=(tuple(extent_lonlat), map_zoom), dpi=200)
+            if save_png:
+                write_png(nf_image_path, ground_frame)
+            folium_overlay = ground_overlay(ground_img, vmin=ground_vmin, vmax=ground_vmax)
+        elif reuse_figures:
+            ground_template = get_plot_template(
+                ("ground", ground_img.shape, tuple(extent), tuple(extent_lonlat), map_zoom, station_name, opacity,
+                 mark_max_power, parameter),
+                lambda: GroundPlotTemplate(ground_img.shape, background_map, extent,
+                                           title=f"Near field image for {station_name}{title_suffix}", opacity=opacity,
+                                           draw_contours=True, mark_max_power=mark_max_power))
+            ground_template.update(ground_img,
+                                   subtitle=f"SB {subband} ({freq / 1e6:.1f} MHz), {str(obstime)[:16]}, {height:.1f} m",
+                                   vmin=ground_vmin, vmax=ground_vmax)
+            if save_png:
+                ground_template.savefig(nf_image_path, bbox_inches='tight', dpi=200)
+            if return_frames:
+                ground_frame = ground_template.to_rgb()
+            ground_fig = None
+            folium_overlay = ground_overlay(ground_img, vmin=ground_vmin, vmax=ground_vmax)
+        else:
+            ground_fig, folium_overlay = make_ground_plot(ground_img, background_map, extent,
+                                                          title=f"Near field image for {station_name}{title_suffix}",
+                                                          subtitle=f"SB {subband} ({freq / 1e6:.1f} MHz), {str(obstime)[:16]}, {height:.1f} m",
+                                                          opacity=opacity, vmin=ground_vmin, vmax=ground_vmax,
+                                                          mark_max_power=mark_max_power)
+            if save_png:
+                ground_fig.savefig(nf_image_path, bbox_inches='tight', dpi=200)
+            if return_frames:
+                ground_frame = figure_to_rgb(ground_fig)
+            plt.close(ground_fig)
+
+        nf_image_paths[parameter], ground_figs[parameter], ground_frames[parameter] = \
+            nf_image_path, ground_fig, ground_frame
+        folium_overlays[parameter] = folium_overlay
 
 
     tags = {"generated_with": f"lofarimaging v{__version__}",
@@ -863,47 +1048,204 @@ def make_xst_plots(xst_data: np.ndarray,
     #                           (lon_min, lat_max), (lon_max, lat_min), as_pqr=False,
     #                           stationname=station_name, obsdate=obstime, tags=tags)
 
-    leaflet_map = make_leaflet_map(folium_overlay, lon_center, lat_center, lon_min, lat_min, lon_max, lat_max)
+    # The map shows the first Stokes parameter
+    leaflet_map = make_leaflet_map(folium_overlays[stokes[0]], lon_center, lat_center,
+                                   lon_min, lat_min, lon_max, lat_max)
 
-    write_hdf5(hdf5_filename, xst_data, visibilities, sky_img, ground_img, station_name, subband, rcu_mode,
-               freq, obstime, extent, extent_lonlat, height, marked_bodies_lmn, calibration_info, subtract)
+    write_hdf5(hdf5_filename, xst_data, visibilities, dict(zip(stokes, sky_imgs)), dict(zip(stokes, ground_imgs)),
+               station_name, subband, rcu_mode, freq, obstime, extent, extent_lonlat, height, marked_bodies_lmn,
+               calibration_info, subtract)
 
     if return_only_paths:
-        return sky_image_path, nf_image_path, leaflet_map
-    return sky_fig, ground_fig, leaflet_map
+        return _per_stokes(sky_image_paths), _per_stokes(nf_image_paths), leaflet_map
+    if return_frames:
+        return _per_stokes(sky_frames), _per_stokes(ground_frames), leaflet_map
+    return _per_stokes(sky_figs), _per_stokes(ground_figs), leaflet_map
+
+
+# Peak detections of all calls to make_xst_plots. Can be replaced with a store with another capacity or spill file
+make_xst_plots.tracking_history = PeakTrackStore(lock=tracking_lock)
+
+
+def locate_xst_peak(xst_data: np.ndarray,
+                    station_name: str,
+                    obstime: datetime.datetime,
+                    subband: int,
+                    rcu_mode: int,
+                    caltable_dir: str = "CalTables/",
+                    extent: List[float] = None,
+                    pixels_per_metre: float = 0.5,
+                    height: float = 1.5,
+                    coarse_step: int = 4,
+                    top_k: int = 4,
+                    track: bool = True,
+                    db: LofarAntennaDatabase = None) -> Dict:
+    """
+    Locate the maximum of the near-field image of an XST file without making the image
+
+    The fast counterpart of the peak detection in make_xst_plots: the Stokes I near-field image is only
+    evaluated on a coarse grid and refined around its maxima (see nearfield_peak), and the position is
+    refined between pixels. No plots or HDF5 output are made.
+
+    Args:
+        xst_data: Correlation data as numpy array, shape n_ant x n_ant
+        station_name: Full station name, e.g. "DE603LBA"
+        obstime: Observation time as a datetime object
+        subband: Subband number
+        rcu_mode: RCU mode
+        caltable_dir: Caltable directory. Defaults to "CalTables".
+        extent: Extent (in m) for ground image. Defaults to [-150, 150, -150, 150]
+        pixels_per_metre: Pixels per metre of the grid that is searched. Defaults to 0.5.
+        height: Height (in m) for ground image. Defaults to 1.5.
+        coarse_step: Pixel step of the coarse grid. Defaults to 4
+        top_k: Number of maxima of the coarse grid that are refined. Defaults to 4
+        track: Append the peak to make_xst_plots.tracking_history. Defaults to True
+        db: instance of LofarAntennaDatabase to reuse. Defaults to a new instance
+
+    Returns:
+        Dict: x_m, y_m (station XYZ), lon, lat, power_db and n_evaluations (number of pixels evaluated)
+
+    Example:
+        >>> xst_data = read_acm_cube("test/20170720_095816_mode_3_xst_sb297.dat", "intl")[0]
+        >>> peak = locate_xst_peak(xst_data, "DE603", datetime.datetime(2017, 7, 20, 9, 58, 16), 297, 3,
+        ...                        caltable_dir="test/CalTables")
+    """
+    if extent is None:
+        extent = [-150, 150, -150, 150]
+    if db is None:
+        db = LofarAntennaDatabase()
+
+    freq = freq_from_sb(subband, rcu_mode=rcu_mode)
+    visibilities, _ = apply_calibration(xst_data, station_name, rcu_mode, subband, caltable_dir=caltable_dir)
+    visibilities_stokes_i = visibilities[0::2, 0::2] + visibilities[1::2, 1::2]
+
+    station_xyz, pqr_to_xyz = get_station_xyz(station_name, rcu_mode, db)
+    station_name = get_full_station_name(station_name, rcu_mode)
+
+    npix_x = int(pixels_per_metre * (extent[1] - extent[0]))
+    npix_y = int(pixels_per_metre * (extent[3] - extent[2]))
+    baseline_indices = np.tril_indices(visibilities_stokes_i.shape[0])
+    peak = nearfield_peak(visibilities_stokes_i[baseline_indices][:, np.newaxis], np.array(baseline_indices).T,
+                          [freq], npix_x, npix_y, extent, station_xyz, height=height, coarse_step=coarse_step,
+                          top_k=top_k)
+
+    # Same scale as the ground image of make_xst_plots, which corrects for the lower triangular part
+    power_db = 10 * np.log10(2 * peak.power)
+    lon, lat = _peak_lonlat(peak.p, peak.q, height, station_name, pqr_to_xyz)
+    if track:
+        make_xst_plots.tracking_history.append(obstime, lat=float(lat), lon=float(lon), x_m=float(peak.p),
+                                               y_m=float(peak.q), power_db=float(power_db), subband=int(subband))
+
+    return {"x_m": float(peak.p), "y_m": float(peak.q), "lon": float(lon), "lat": float(lat),
+            "power_db": float(power_db), "n_evaluations": peak.n_evaluations}
+
+
+def _read_sky_chunk(h5file: h5py.File, obsnums: List[str]) -> List[Tuple[np.ndarray, Dict]]:
+    """Read the sky images and the attributes needed for plotting of some observations"""
+    chunk = []
+    for obsnum in obsnums:
+        obs_h5 = h5file[obsnum]
+        attrs = {key: obs_h5.attrs[key] for key in ("obstime", "frequency", "station_name", "subband",
+                                                    "source_names", "source_lmn")}
+        chunk.append((obs_h5["sky_img"][:, :], attrs))
+    return chunk
 
 
 def make_sky_movie(moviefilename: str, h5file: h5py.File, obsnums: List[str], vmin=None, vmax=None,
-                   marked_bodies=["Cas A", "Cyg A", "Sun"]) -> None:
+                   marked_bodies=["Cas A", "Cyg A", "Sun"], fps: int = 5, bitrate: int = 800,
+                   chunk_size: int = 32) -> None:
     """
     Make movie of a list of observations
+
+    All frames are drawn on one plot template, only the image and labels are updated. The frames are
+    piped to ffmpeg as raw RGB, so memory use does not grow with the number of observations. The sky
+    images are read from the HDF5 file in chunks, the next chunk is read while the current one is drawn.
+
+    Args:
+        moviefilename: output filename, e.g. "sky_movie.mp4"
+        h5file: HDF5 file with the observations
+        obsnums: observations to put in the movie, e.g. ["obs000001", "obs000002"]
+        vmin: fixed minimum of the color scale. Defaults to the minimum of every image
+        vmax: fixed maximum of the color scale. Defaults to the maximum of every image
+        marked_bodies: names of the sources to mark, None marks all. Defaults to ["Cas A", "Cyg A", "Sun"]
+        fps: frames per second. Defaults to 5
+        bitrate: bitrate of the video in kbit/s. Defaults to 800
+        chunk_size: number of observations read from the HDF5 file at once. Defaults to 32
     """
-    fig = plt.figure(figsize=(10,10))
-    for obsnum in tqdm.tqdm(obsnums):
-        obs_h5 = h5file[obsnum]
-        skydata_h5 = obs_h5["sky_img"]
-        obstime = obs_h5.attrs["obstime"]
-        freq = obs_h5.attrs["frequency"]
-        station_name = obs_h5.attrs["station_name"]
-        subband = obs_h5.attrs["subband"]
-        marked_bodies_lmn = dict(zip(obs_h5.attrs["source_names"], obs_h5.attrs["source_lmn"]))
-        if marked_bodies is not None:
-            marked_bodies_lmn = {k: v for k, v in marked_bodies_lmn.items() if k in marked_bodies}
-        make_sky_plot(skydata_h5[:, :], marked_bodies_lmn,
-                      title=f"Sky image for {station_name}",
-                      subtitle=f"SB {subband} ({freq / 1e6:.1f} MHz), {str(obstime)[:16]}",
-                      animated=True, fig=fig, label=obsnum, vmin=vmin, vmax=vmax)
-
-    # Thanks to Maaijke Mevius for making this animation work!
-    ims = fig.get_children()[1:]
-    ims = [ims[i:i+2] for i in range(0, len(ims), 2)]
-    ani = matplotlib.animation.ArtistAnimation(fig, ims, interval=30, blit=False, repeat_delay=1000)
-    writer = matplotlib.animation.writers['ffmpeg'](fps=5, bitrate=800)
-    ani.save(moviefilename, writer=writer, dpi=fig.dpi)
+    template = None
+    ffmpeg = None
+    progress = tqdm.tqdm(total=len(obsnums))
+    chunks = [obsnums[i:i + chunk_size] for i in range(0, len(obsnums), chunk_size)]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as reader:
+        next_chunk = reader.submit(_read_sky_chunk, h5file, chunks[0]) if chunks else None
+        try:
+            for chunk_ix in range(len(chunks)):
+                chunk = next_chunk.result()
+                if chunk_ix + 1 < len(chunks):
+                    next_chunk = reader.submit(_read_sky_chunk, h5file, chunks[chunk_ix + 1])
+
+                for sky_img, attrs in chunk:
+                    obstime, freq, subband = attrs["obstime"], attrs["frequency"], attrs["subband"]
+                    marked_bodies_lmn = dict(zip(attrs["source_names"], attrs["source_lmn"]))
+                    if marked_bodies is not None:
+                        marked_bodies_lmn = {k: v for k, v in marked_bodies_lmn.items() if k in marked_bodies}
+
+                    if template is None:
+                        template = SkyPlotTemplate(sky_img.shape, title=f"Sky image for {attrs['station_name']}",
+                                                   vmin=vmin, vmax=vmax)
+
+                    template.update(sky_img, subtitle=f"SB {subband} ({freq / 1e6:.1f} MHz), {str(obstime)[:16]}",
+                                    marked_bodies_lmn=marked_bodies_lmn)
+                    frame = template.to_rgb()
+                    # The video encoder needs an even width and height
+                    frame = frame[:frame.shape[0] // 2 * 2, :frame.shape[1] // 2 * 2]
+
+                    if ffmpeg is None:
+                        # A file instead of a pipe for the errors, so that ffmpeg can not block on a full pipe
+                        ffmpeg_errors = tempfile.TemporaryFile()
+                        ffmpeg = subprocess.Popen(
+                            [matplotlib.rcParams["animation.ffmpeg_path"], "-y", "-loglevel", "error",
+                             "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{frame.shape[1]}x{frame.shape[0]}",
+                             "-r", str(fps), "-i", "pipe:", "-vcodec", "h264", "-pix_fmt", "yuv420p",
+                             "-b:v", f"{bitrate}k", moviefilename],
+                            stdin=subprocess.PIPE, stderr=ffmpeg_errors)
+                    ffmpeg.stdin.write(np.ascontiguousarray(frame).tobytes())
+                    progress.update()
+        finally:
+            progress.close()
+            # Do not hide an exception from the loop (e.g. BrokenPipeError when ffmpeg died) behind ffmpeg's exit code
+            loop_failed = sys.exc_info()[0] is not None
+            if template is not None:
+                template.close()
+            if ffmpeg is not None:
+                try:
+                    ffmpeg.stdin.close()
+                except BrokenPipeError:
+                    pass
+                returncode = ffmpeg.wait()
+                ffmpeg_errors.seek(0)
+                ffmpeg_message = ffmpeg_errors.read().decode(errors="replace").strip()
+                ffmpeg_errors.close()
+                if returncode != 0:
+                    if loop_failed:
+                        print(f"Warning: ffmpeg failed writing {moviefilename}: {ffmpeg_message}")
+                    else:
+                        raise RuntimeError(f"ffmpeg failed writing {moviefilename} (exit code {returncode}): "
+                                           f"{ffmpeg_message}")
+
+
+def _stored_sky_image(obs_group: h5py.Group, parameter: str):
+    """Sky image of a Stokes parameter stored by make_xst_plots, None if it was not imaged"""
+    for name in ("sky_img", f"sky_img_{parameter}"):
+        if name in obs_group and obs_group[name].attrs.get("stokes", "I") == parameter:
+            return obs_group[name]
+    return None
 
 
 def reimage_sky(h5: h5py.File, obsnum: str, db: lofarantpos.db.LofarAntennaDatabase,
-                subtract: List[str] = None, vmin: float = None, vmax: float = None):
+                subtract: List[str] = None, vmin: float = None, vmax: float = None, cache: ResultCache = None,
+                stokes: str = "I"):
     """
     Reimage the sky for one observation in an HDF5 file
 
@@ -911,10 +1253,13 @@ def reimage_sky(h5: h5py.File, obsnum: str, db: lofarantpos.db.LofarAntennaDatab
         h5 (h5py.File): HDF5 file
         obsnum (str): observation number
         db (lofarantpos.db.LofarAntennaDatabase): instance of lofar antenna database
-        subtract (List[str], optional): List of sources to subtract, e.g. ["Cas A", "Sun"]
+        subtract (List[str], optional): List of sources to subtract, e.g. ["Cas A", "Sun"], only for Stokes I
+        cache (ResultCache, optional): Cache for the sky image, shared with make_xst_plots
+        stokes (str, optional): Stokes parameters, e.g. "I" or "IQUV". Stored images are reused, the others are
+                                imaged in one pass. Defaults to "I"
 
     Returns:
-        matplotlib.Figure
+        matplotlib.Figure, or a dict Stokes parameter -> matplotlib.Figure for more than one Stokes parameter
 
     Example:
         >>> from lofarantpos.db import LofarAntennaDatabase
@@ -925,33 +1270,52 @@ def reimage_sky(h5: h5py.File, obsnum: str, db: lofarantpos.db.LofarAntennaDatab
     subband = h5[obsnum].attrs['subband']
     obstime = h5[obsnum].attrs['obstime']
     rcu_mode = h5[obsnum].attrs['rcu_mode']
-    sky_data = h5[obsnum]["sky_img"]
     freq = h5[obsnum].attrs['frequency']
     marked_bodies_lmn = dict(zip(h5[obsnum].attrs["source_names"], h5[obsnum].attrs["source_lmn"]))
     visibilities = h5[obsnum]['calibrated_data'][:]
-    visibilities_xx = visibilities[0::2, 0::2]
-    visibilities_yy = visibilities[1::2, 1::2]
-    # Stokes I
-    visibilities_stokes_i = visibilities_xx + visibilities_yy
-
-    if subtract is not None:
+    stokes = "".join(stokes)
+    if subtract is not None and stokes != "I":
+        print(f"Warning: sources are only subtracted from Stokes I, not from Stokes {stokes.replace('I', '')}")
+        if "I" not in stokes:
+            subtract = None
+
+    # Stored images can be used if nothing is subtracted from them
+    sky_data = {parameter: _stored_sky_image(h5[obsnum], parameter) for parameter in stokes}
+    to_image = "".join(parameter for parameter in stokes
+                       if sky_data[parameter] is None or (parameter == "I" and subtract is not None))
+    if to_image:
+        npix_l, npix_m = h5[obsnum]["sky_img"].shape
         station_xyz, _ = get_station_xyz(station_name, rcu_mode, db)
         baselines = station_xyz[:, np.newaxis, :] - station_xyz[np.newaxis, :, :]
-        visibilities_stokes_i = subtract_sources(visibilities_stokes_i, baselines, freq, marked_bodies_lmn, subtract)
-        sky_data = sky_imager(visibilities_stokes_i, baselines, freq, sky_data.shape[0], sky_data.shape[1])
-        if vmin is None:
-            vmin = np.quantile(sky_data, 0.05)
-
-    sky_fig = make_sky_plot(sky_data, {k: v for k, v in marked_bodies_lmn.items()},
-                            title=f"Sky image for {station_name}",
-                            subtitle=f"SB {subband} ({freq / 1e6:.1f} MHz), {str(obstime)[:16]}",
-                            vmin=vmin, vmax=vmax)
-
-    return sky_fig
+        visibilities_stokes = stokes_visibilities(visibilities, to_image)
+        if subtract is not None:
+            stokes_i = to_image.index("I")
+            visibilities_stokes[stokes_i] = subtract_sources(visibilities_stokes[stokes_i], baselines, freq,
+                                                             marked_bodies_lmn, subtract)
+        sky_imgs = _cached_image(cache,
+                                 lambda: sky_imager_batch(visibilities_stokes, baselines, freq, npix_l, npix_m),
+                                 kind="sky_imgs", npix=(npix_l, npix_m),
+                                 **_image_key(visibilities, station_name, rcu_mode, subband, subtract, obstime,
+                                              to_image))
+        sky_data.update(zip(to_image, sky_imgs))
+
+    sky_figs = {}
+    for parameter in stokes:
+        parameter_vmin = vmin
+        if parameter_vmin is None and subtract is not None and parameter == "I":
+            parameter_vmin = np.quantile(sky_data[parameter], 0.05)
+
+        title_suffix = "" if parameter == "I" else f", Stokes {parameter}"
+        sky_figs[parameter] = make_sky_plot(sky_data[parameter], {k: v for k, v in marked_bodies_lmn.items()},
+                                            title=f"Sky image for {station_name}{title_suffix}",
+                                            subtitle=f"SB {subband} ({freq / 1e6:.1f} MHz), {str(obstime)[:16]}",
+                                            vmin=parameter_vmin, vmax=vmax)
+
+    return _per_stokes(sky_figs)
 
 
 def reimage_nearfield(h5: h5py.File, obsnum: str, db: lofarantpos.db.LofarAntennaDatabase, extent: List[float] = None,
-                      subtract: bool = None):
+                      subtract: bool = None, cache: ResultCache = None, stokes: str = "I", height: float = 1.5):
     """
     Reimage nearfield for ground image
 
@@ -960,10 +1324,15 @@ def reimage_nearfield(h5: h5py.File, obsnum: str, db: lofarantpos.db.LofarAntenn
         obsnum (str): observation number
         db (lofarantpos.db.LofarAntennaDatabase): instance of lofar antenna database
         extent (List[float], optional): Imaging extent in metres
-        subtract (List[str], optional): List of sources to subtract, e.g. ["Cas A", "Sun"]
+        subtract (List[str], optional): List of sources to subtract, e.g. ["Cas A", "Sun"], only for Stokes I
+        cache (ResultCache, optional): Cache for the ground image, see make_xst_plots. The image is in PQR
+                                       coordinates, so it is not shared with the XYZ images of make_xst_plots
+        stokes (str, optional): Stokes parameters, e.g. "I" or "IQUV", imaged in one pass. Defaults to "I"
+        height (float, optional): Height of the image plane in metres. Defaults to 1.5
 
     Returns:
-        fig, leaflet map
+        fig, leaflet map (dicts Stokes parameter -> fig and Stokes parameter -> leaflet map for more than one
+        Stokes parameter)
 
     Example:
         >>> from lofarantpos.db import LofarAntennaDatabase
@@ -978,34 +1347,43 @@ def reimage_nearfield(h5: h5py.File, obsnum: str, db: lofarantpos.db.LofarAntenn
     freq = h5[obsnum].attrs['frequency']
     marked_bodies_lmn = dict(zip(h5[obsnum].attrs["source_names"], h5[obsnum].attrs["source_lmn"]))
     visibilities = h5[obsnum]['calibrated_data'][:]
-    visibilities_xx = visibilities[0::2, 0::2]
-    visibilities_yy = visibilities[1::2, 1::2]
-    # Stokes I
-    visibilities_stokes_i = visibilities_xx + visibilities_yy
+    stokes = "".join(stokes)
+    visibilities_stokes = stokes_visibilities(visibilities, stokes)
+    if subtract is not None and stokes != "I":
+        print(f"Warning: sources are only subtracted from Stokes I, not from Stokes {stokes.replace('I', '')}")
+        if "I" not in stokes:
+            subtract = None
 
     if subtract is not None:
         station_xyz, _ = get_station_xyz(station_name, rcu_mode, db)
         baselines = station_xyz[:, np.newaxis, :] - station_xyz[np.newaxis, :, :]
-        visibilities_stokes_i = subtract_sources(visibilities_stokes_i, baselines, freq, marked_bodies_lmn, subtract)
-
-    baseline_indices = np.tril_indices(visibilities_stokes_i.shape[0])
-    visibilities_selection = visibilities_stokes_i[baseline_indices]
+        stokes_i = stokes.index("I")
+        visibilities_stokes[stokes_i] = subtract_sources(visibilities_stokes[stokes_i], baselines, freq,
+                                                         marked_bodies_lmn, subtract)
 
     extent_lonlat = get_extent_lonlat(extent, get_full_station_name(station_name, h5[obsnum].attrs['rcu_mode']), db)
 
     background_map = get_map(*extent_lonlat, 14)
 
-    ground_img = nearfield_imager(visibilities_selection.flatten()[:, np.newaxis],
-                                  np.array(baseline_indices).T, [freq],
-                                  600, 600, extent,
-                                  get_station_pqr(h5[obsnum].attrs["station_name"], h5[obsnum].attrs["rcu_mode"], db))
-    ground_img = np.real(2 * ground_img)
+    def compute_ground_imgs():
+        station_pqr = get_station_pqr(h5[obsnum].attrs["station_name"], h5[obsnum].attrs["rcu_mode"], db)
+        return nearfield_imager_batch(visibilities_stokes, freq, 600, 600, extent, station_pqr, height=height)
+
+    # Imaged in PQR coordinates, unlike make_xst_plots which images in XYZ (Q-axis rotated to local north)
+    ground_imgs = _cached_image(cache, compute_ground_imgs, kind="ground_imgs", coordinates="pqr",
+                                extent=list(extent), npix=(600, 600), height=float(height), engine="exact",
+                                **_image_key(visibilities, station_name, rcu_mode, subband, subtract, obstime, stokes))
 
-    fig, folium_overlay = make_ground_plot(ground_img, background_map, extent, draw_contours=False, opacity=0.3,
-                                           title=f"Near field image for {station_name}",
-                                           subtitle=f"SB {subband} ({freq / 1e6:.1f} MHz), {str(obstime)[:16]}",)
+    figs, leaflet_maps = {}, {}
+    for parameter, ground_img in zip(stokes, ground_imgs):
+        title_suffix = "" if parameter == "I" else f", Stokes {parameter}"
+        figs[parameter], folium_overlay = make_ground_plot(
+            ground_img, background_map, extent, draw_contours=False, opacity=0.3,
+            title=f"Near field image for {station_name}{title_suffix}",
+            subtitle=f"SB {subband} ({freq / 1e6:.1f} MHz), {str(obstime)[:16]}",)
 
-    leaflet_map = make_leaflet_map(folium_overlay, *(extent_lonlat[1:3]),
-                                   extent_lonlat[0], extent_lonlat[2], extent_lonlat[1], extent_lonlat[3])
+        leaflet_maps[parameter] = make_leaflet_map(folium_overlay, *(extent_lonlat[1:3]),
+                                                   extent_lonlat[0], extent_lonlat[2], extent_lonlat[1],
+                                                   extent_lonlat[3])
 
-    return fig, leaflet_map
+    return _per_stokes(figs), _per_stokes(leaflet_maps)
@@ -1,19 +1,128 @@
 import requests
 import configparser
 import os
-from skyfield.api import EarthSatellite
+import datetime
+from typing import Dict, List, Union
+
+import numpy as np
+from skyfield.api import EarthSatellite, load
 
 # from https://www.space-track.org/documentation#howto-api_python
 
-def get_starlink_data(start_date, end_date):
-    # See https://www.space-track.org/documentation for details on REST queries
+# Downloaded TLEs are cached per hour of epoch. For every window, the 3LE text as received from
+# space-track.org and the parsed, binary version (npz) are stored. Windows that are already in the
+# cache are never downloaded again.
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CACHE_DIR = os.path.join(BASE_DIR, "starlink_data", "tle_cache")
+CACHE_WINDOW = np.timedelta64(1, "h")
 
-    uriBase                = "https://www.space-track.org"
-    requestLogin           = "/ajaxauth/login"
-    requestCmdAction       = "/basicspacedata/query" 
-    requestFindStarlinks   = "/class/gp_history/EPOCH/{START_DATE}--{END_DATE}/OBJECT_NAME/STARLINK~~/format/3le/orderby/LAUNCH_DATE%20asc"
+DateLike = Union[str, datetime.datetime]
+
+
+def _to_datetime64(date: DateLike) -> np.datetime64:
+    """Convert a date string like '2023-01-11 07:20:42' or a datetime to datetime64[us] (UTC)"""
+    if isinstance(date, datetime.datetime) and date.tzinfo is not None:
+        date = date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    if isinstance(date, str):
+        date = date.strip().replace(" ", "T")
+    return np.datetime64(date, "us")
+
+
+def _window_name(window: np.datetime64) -> str:
+    """Base filename of the cache window starting at `window`, e.g. starlink_20230111T07"""
+    return "starlink_" + str(window.astype("datetime64[h]")).replace("-", "")
+
+
+def _tle_epoch(line1: str) -> np.datetime64:
+    """Epoch of a TLE from columns 19-32 of the first line"""
+    year = int(line1[18:20])
+    year += 1900 if year >= 57 else 2000
+    day_of_year = float(line1[20:32])
+    epoch_us = int(round((day_of_year - 1) * 86400e6))
+    return np.datetime64(f"{year}-01-01", "us") + np.timedelta64(epoch_us, "us")
+
+
+def parse_3le(text: str) -> Dict[str, np.ndarray]:
+    """
+    Parse 3LE text (name line and two TLE lines per satellite) into arrays
+
+    Args:
+        text: 3LE text, e.g. as downloaded from space-track.org
+
+    Returns:
+        Dict[str, np.ndarray]: arrays name, line1, line2, satnum and epoch (datetime64[us]), one entry per TLE
+
+    Example:
+        >>> tles = parse_3le('''0 STARLINK-1007
+        ... 1 44713U 19074A   23010.50000000  .00001103  00000-0  92581-4 0  9991
+        ... 2 44713  53.0543 189.3296 0001346  85.2148 274.9007 15.06393191173437''')
+        >>> tles["satnum"], tles["epoch"]
+        (array(['44713'], dtype='<U5'), array(['2023-01-10T12:00:00.000000'], dtype='datetime64[us]'))
+    """
+    lines = text.strip().splitlines()
+    names, lines1, lines2, epochs = [], [], [], []
 
+    # TLE has 3 lines/satellite
+    for i in range(0, len(lines) - 2, 3):
+        name = lines[i].strip()
+        l1 = lines[i + 1].rstrip()
+        l2 = lines[i + 2].rstrip()
+        if not (l1.startswith("1 ") and l2.startswith("2 ")):
+            continue
+        try:
+            epoch = _tle_epoch(l1)
+        except ValueError:
+            continue
+        names.append(name)
+        lines1.append(l1)
+        lines2.append(l2)
+        epochs.append(epoch)
 
+    return {"name": np.array(names, dtype=str),
+            "line1": np.array(lines1, dtype=str),
+            "line2": np.array(lines2, dtype=str),
+            "satnum": np.array([l1[2:7].strip() for l1 in lines1], dtype="<U5"),
+            "epoch": np.array(epochs, dtype="datetime64[us]")}
+
+
+def _concatenate_tles(tle_list: List[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+    """Concatenate parsed TLE arrays"""
+    if len(tle_list) == 0:
+        return parse_3le("")
+    return {key: np.concatenate([tles[key] for tles in tle_list]) for key in tle_list[0]}
+
+
+def select_latest_tles(tles: Dict[str, np.ndarray], end_date: DateLike = None) -> Dict[str, np.ndarray]:
+    """
+    Keep one TLE per satellite: the newest one with an epoch not after end_date. Satellites
+    with only later TLEs keep their earliest one.
+
+    Args:
+        tles: parsed TLEs, see parse_3le
+        end_date: date for which the TLEs will be used. Defaults to None (newest TLE)
+
+    Returns:
+        Dict[str, np.ndarray]: parsed TLEs, one per satellite
+    """
+    if len(tles["epoch"]) == 0:
+        return tles
+    epoch = tles["epoch"]
+    if end_date is None:
+        after_end = np.zeros(len(epoch), dtype=bool)
+    else:
+        after_end = epoch > _to_datetime64(end_date)
+    # Rank TLEs per satellite: not after end_date first, then newest first (or earliest first after end_date)
+    epoch_int = epoch.astype(np.int64)
+    order = np.lexsort((np.where(after_end, epoch_int, -epoch_int), after_end, tles["satnum"]))
+    sorted_satnum = tles["satnum"][order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = sorted_satnum[1:] != sorted_satnum[:-1]
+    selection = np.sort(order[first])
+    return {key: value[selection] for key, value in tles.items()}
+
+
+def _read_credentials():
+    """Read space-track.org credentials, returns None if they are not available"""
     # ACTION REQUIRED FOR YOU:
     #=========================
     # Provide a config file in the same directory as this file, called SLTrack.ini, with this format (without the # signs)
@@ -27,18 +136,40 @@ def get_starlink_data(start_date, end_date):
 
     # Use configparser package to pull in the ini file (pip install configparser)
     config = configparser.ConfigParser()
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    ini_path = os.path.join(base_dir, "starlink_data", "SLTrack.ini")
+    ini_path = os.path.join(BASE_DIR, "starlink_data", "SLTrack.ini")
     file_read = config.read(ini_path)
     if not file_read:
         print("ERROR: SLTrack.ini not found.")
+        return None
     elif not config.has_section("configuration"):
         print("ERROR: Header [configuration] not found in file.")
-    else:
-        configUsr = config.get("configuration","username")
-        configPwd = config.get("configuration","password")
-    siteCred = {'identity': configUsr, 'password': configPwd}
+        return None
+    configUsr = config.get("configuration","username")
+    configPwd = config.get("configuration","password")
+    return {'identity': configUsr, 'password': configPwd}
+
+
+def download_3le(start_date: str, end_date: str) -> Union[str, None]:
+    """
+    Download the 3LE history of all Starlink satellites with an epoch between start_date and end_date
 
+    Args:
+        start_date: start of epoch range, e.g. '2023-01-10 07:00:00'
+        end_date: end of epoch range
+
+    Returns:
+        str: 3LE text, or None if the download failed
+    """
+    # See https://www.space-track.org/documentation for details on REST queries
+
+    uriBase                = "https://www.space-track.org"
+    requestLogin           = "/ajaxauth/login"
+    requestCmdAction       = "/basicspacedata/query"
+    requestFindStarlinks   = "/class/gp_history/EPOCH/{START_DATE}--{END_DATE}/OBJECT_NAME/STARLINK~~/format/3le/orderby/LAUNCH_DATE%20asc"
+
+    siteCred = _read_credentials()
+    if siteCred is None:
+        return None
 
     # use requests package to drive the RESTful session with space-track.org
     with requests.Session() as session:
@@ -48,32 +179,163 @@ def get_starlink_data(start_date, end_date):
         resp = session.post(uriBase + requestLogin, data = siteCred)
         if resp.status_code != 200:
             print(f"Error {resp.status_code}. POST fail on login.")
-            return ""
+            return None
 
-        # this query picks up all Starlink satellites from the catalog. Note - a 401 failure shows you have bad credentials 
+        # this query picks up all Starlink satellites from the catalog. Note - a 401 failure shows you have bad credentials
         requestFindStarlinks = requestFindStarlinks.replace('{START_DATE}', start_date.replace(' ','%20'))
         requestFindStarlinks = requestFindStarlinks.replace('{END_DATE}', end_date.replace(' ','%20'))
-                                                            
+
         resp = session.get(uriBase + requestCmdAction + requestFindStarlinks)
         if resp.status_code != 200:
             print(resp)
             print(f"Error {resp.status_code}. GET fail on request for Starlink satellites.")
-            return ""
+            return None
+        return resp.text
+
+
+def load_3le_file(tle_file: str) -> Dict[str, np.ndarray]:
+    """
+    Load a local 3LE file. The parsed TLEs are cached next to it in tle_file + '.npz'
+
+    Args:
+        tle_file: 3LE file, e.g. downloaded from space-track.org or celestrak.org
+
+    Returns:
+        Dict[str, np.ndarray]: parsed TLEs, see parse_3le
+    """
+    npz_file = tle_file + ".npz"
+    if os.path.exists(npz_file) and os.path.getmtime(npz_file) >= os.path.getmtime(tle_file):
+        with np.load(npz_file) as npz:
+            return {key: npz[key] for key in npz.files}
+
+    with open(tle_file, "r") as f:
+        tles = parse_3le(f.read())
+    try:
+        np.savez(npz_file, **tles)
+    except OSError:
+        # Read-only location, parse again next time
+        pass
+    return tles
+
+
+def _load_window(cache_dir: str, window: np.datetime64) -> Union[Dict[str, np.ndarray], None]:
+    """Load the parsed TLEs of one cache window, returns None if the window is not in the cache"""
+    basename = os.path.join(cache_dir, _window_name(window))
+    if os.path.exists(basename + ".npz"):
+        with np.load(basename + ".npz") as npz:
+            return {key: npz[key] for key in npz.files}
+    if os.path.exists(basename + ".3le"):
+        return load_3le_file(basename + ".3le")
+    return None
+
+
+def _store_windows(cache_dir: str, text: str, windows: np.ndarray):
+    """Split downloaded 3LE text per window and store the 3LE and parsed TLEs of each window"""
+    os.makedirs(cache_dir, exist_ok=True)
+    tles = parse_3le(text)
+    tle_windows = tles["epoch"].astype("datetime64[h]")
+    lines = np.char.add(np.char.add(np.char.add(tles["name"], "\n"), np.char.add(tles["line1"], "\n")),
+                        tles["line2"])
+    for window in windows:
+        in_window = tle_windows == window
+        basename = os.path.join(cache_dir, _window_name(window))
+        # Write to temporary files first, so that an interrupted download does not leave a partial window
+        with open(basename + ".3le.tmp", "w") as f:
+            f.write("\n".join(lines[in_window].tolist()))
+        with open(basename + ".tmp.npz", "wb") as f:
+            np.savez(f, **{key: value[in_window] for key, value in tles.items()})
+        os.replace(basename + ".tmp.npz", basename + ".npz")
+        os.replace(basename + ".3le.tmp", basename + ".3le")
+
+
+def _contiguous_ranges(windows: np.ndarray) -> List[np.ndarray]:
+    """Split a sorted array of windows into runs of consecutive windows"""
+    if len(windows) == 0:
+        return []
+    breaks = np.nonzero(np.diff(windows) != CACHE_WINDOW)[0] + 1
+    return np.split(windows, breaks)
+
+
+def get_starlink_tles(start_date: DateLike, end_date: DateLike, cache_dir: str = None, offline: bool = False,
+                      tle_file: str = None) -> Dict[str, np.ndarray]:
+    """
+    Get the TLEs of all Starlink satellites with an epoch between start_date and end_date, one per satellite
+
+    Only the hourly windows that are not in the cache yet are downloaded from space-track.org.
+
+    Args:
+        start_date: start of epoch range, e.g. '2023-01-10 07:20:42' or a datetime (UTC)
+        end_date: end of epoch range
+        cache_dir: directory for cached TLEs. Defaults to starlink_data/tle_cache next to this file
+        offline: never use the network, only the cache or tle_file. Defaults to False
+        tle_file: local 3LE file to use instead of space-track.org. Defaults to None
+
+    Returns:
+        Dict[str, np.ndarray]: parsed TLEs (name, line1, line2, satnum, epoch), newest per satellite
+    """
+    start = _to_datetime64(start_date)
+    end = _to_datetime64(end_date)
+
+    if tle_file is not None:
+        return select_latest_tles(load_3le_file(tle_file), end)
+
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+
+    windows = np.arange(start.astype("datetime64[h]"), end.astype("datetime64[h]") + CACHE_WINDOW, CACHE_WINDOW)
+    tle_list = []
+    missing = []
+    for window in windows:
+        tles = _load_window(cache_dir, window)
+        if tles is None:
+            missing.append(window)
         else:
-            print("Data downloaded, converting to Skyfield objects...")
-            lines = resp.text.strip().splitlines()
-            sats = {}
-            
-            # TLE has 3 lines/satellite
-            for i in range(0, len(lines) - 2, 3):
-                try:
-                    name = lines[i].strip()
-                    l1 = lines[i+1]
-                    l2 = lines[i+2]
-                    sat = EarthSatellite(l1, l2, name)
-                    # save satellite and if ID already exists, overwrite with newest one.
-                    sats[sat.model.satnum] = sat
-                except Exception:
-                    continue 
-            satellites = list(sats.values())
-            return satellites
\ No newline at end of file
+            tle_list.append(tles)
+
+    if len(missing) > 0 and offline:
+        print(f"Warning: {len(missing)} of {len(windows)} hours between {start} and {end} are not in the TLE cache")
+    elif len(missing) > 0:
+        now = np.datetime64(datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None), "us")
+        for run in _contiguous_ranges(np.array(missing, dtype="datetime64[h]")):
+            run_start = run[0].astype("datetime64[s]")
+            run_end = (run[-1] + CACHE_WINDOW).astype("datetime64[s]")
+            print(f"Downloading TLEs from {run_start} to {run_end}...")
+            text = download_3le(str(run_start).replace("T", " "), str(run_end).replace("T", " "))
+            if text is None:
+                continue
+            # Windows that are not over yet can still get new TLEs, they are not cached
+            complete = run[(run + CACHE_WINDOW).astype("datetime64[us]") <= now]
+            _store_windows(cache_dir, text, complete)
+            tle_list.append(parse_3le(text))
+
+    tles = _concatenate_tles(tle_list)
+    in_range = (tles["epoch"] >= start) & (tles["epoch"] <= end)
+    tles = {key: value[in_range] for key, value in tles.items()}
+    return select_latest_tles(tles, end)
+
+
+def get_starlink_data(start_date: DateLike, end_date: DateLike, cache_dir: str = None, offline: bool = False,
+                      tle_file: str = None) -> List[EarthSatellite]:
+    """
+    Get all Starlink satellites as Skyfield objects, using the newest TLE between start_date and end_date
+
+    Args:
+        start_date: start of epoch range, e.g. '2023-01-10 07:20:42' or a datetime (UTC)
+        end_date: end of epoch range
+        cache_dir: directory for cached TLEs. Defaults to starlink_data/tle_cache next to this file
+        offline: never use the network, only the cache or tle_file. Defaults to False
+        tle_file: local 3LE file to use instead of space-track.org. Defaults to None
+
+    Returns:
+        List[EarthSatellite]: one per satellite
+    """
+    tles = get_starlink_tles(start_date, end_date, cache_dir=cache_dir, offline=offline, tle_file=tle_file)
+    print("Converting to Skyfield objects...")
+    ts = load.timescale()
+    satellites = []
+    for name, l1, l2 in zip(tles["name"].tolist(), tles["line1"].tolist(), tles["line2"].tolist()):
+        try:
+            satellites.append(EarthSatellite(l1, l2, name, ts))
+        except Exception:
+            continue
+    return satellites
@@ -0,0 +1,456 @@
+"""Bounded store for near-field peak detections
+
+Every call to make_xst_plots records the location and power of the maximum of the
+ground image. These detections are kept in a PeakTrackStore: a fixed-capacity
+ring buffer with one numpy array per column. When the buffer is full, the oldest
+detections are overwritten. Optionally, detections are spilled to an HDF5 file or
+a directory of Parquet files before they are overwritten, so that a long realtime
+session can be analysed afterwards.
+
+Queries take a snapshot of the buffer under the lock and select rows outside of it.
+Indexing (store[-1], store[10:]) works like on the list of detections in insertion
+order, and only converts the selected rows.
+
+Columns:
+ * timestamp       Observation time (UTC), as datetime64[us]
+ * lat, lon        Location of the maximum (w.r.t. WGS84 ellipsoid)
+ * x_m, y_m        Location of the maximum in metres east and north of the station center
+ * power_db        Power of the maximum in dB
+ * subband         Subband
+"""
+
+import os
+import datetime
+import threading
+from typing import Dict, List, Tuple, Union, Iterable
+
+import numpy as np
+import h5py
+
+__all__ = ["PeakTrackStore", "TRACK_COLUMNS"]
+
+__version__ = "1.5.0"
+
+TRACK_COLUMNS = {"timestamp": "datetime64[us]",
+                 "lat": np.float64,
+                 "lon": np.float64,
+                 "x_m": np.float64,
+                 "y_m": np.float64,
+                 "power_db": np.float64,
+                 "subband": np.int32}
+
+TimeLike = Union[datetime.datetime, np.datetime64, str]
+
+
+def _to_datetime64(time: TimeLike) -> np.datetime64:
+    """Convert a datetime, string or datetime64 to datetime64[us]. Timezone-aware datetimes are converted to UTC."""
+    if isinstance(time, datetime.datetime) and time.tzinfo is not None:
+        time = time.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return np.datetime64(time, "us")
+
+
+class PeakTrackStore:
+    """
+    Fixed-capacity columnar ring buffer of peak detections
+
+    Example:
+        >>> store = PeakTrackStore(capacity=2)
+        >>> store.append(datetime.datetime(2023, 1, 11, 7, 20, 42), 56.99, 21.85, 10., -20., -3.5, 284)
+        >>> store.append(datetime.datetime(2023, 1, 11, 7, 20, 52), 56.99, 21.85, 12., -18., -3.1, 284)
+        >>> store.append(datetime.datetime(2023, 1, 11, 7, 21, 2), 56.99, 21.85, 50., 40., -6.0, 300)
+        >>> len(store)
+        2
+        >>> store[0]["timestamp"]
+        '2023-01-11T07:20:52'
+        >>> store.query(subbands=[300])["x_m"]
+        array([50.])
+    """
+    def __init__(self, capacity: int = 100000, spill_path: str = None, spill_every: int = None,
+                 lock: threading.Lock = None):
+        """
+        Create an empty store
+
+        Args:
+            capacity: Maximum number of detections kept in memory. Defaults to 100000
+            spill_path: File to spill detections to before they are overwritten. A filename ending in
+                        .parquet is used as a directory of Parquet files (requires pyarrow), any other
+                        filename as an HDF5 file. Defaults to None (no spilling)
+            spill_every: Number of new detections after which they are spilled. Defaults to capacity // 4
+            lock: Lock that guards the buffer. Defaults to a new threading.RLock
+        """
+        if capacity < 1:
+            raise ValueError("capacity should be at least 1")
+        self.capacity = int(capacity)
+        self.spill_path = spill_path
+        self.spill_every = min(int(spill_every or max(self.capacity // 4, 1)), self.capacity)
+        self._lock = lock if lock is not None else threading.RLock()
+        self._spill_lock = threading.Lock()
+        self._columns = {name: np.zeros(self.capacity, dtype=dtype) for name, dtype in TRACK_COLUMNS.items()}
+        self._next = 0            # Position where the next detection is written
+        self._size = 0            # Number of valid rows
+        self._total = 0           # Number of detections ever appended
+        self._pending = 0         # Number of detections not yet spilled
+        self._sorted = True       # Whether rows were appended in chronological order
+        self._last_time = None
+        self._spill_failed = False
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __getitem__(self, item: Union[int, slice]) -> Union[Dict, List[Dict]]:
+        """Detections in insertion order, like a list. Only the selected rows are converted."""
+        with self._lock:
+            if isinstance(item, slice):
+                indices = range(self._size)[item]
+            else:
+                index = item + self._size if item < 0 else item
+                if not 0 <= index < self._size:
+                    raise IndexError("PeakTrackStore index out of range")
+                indices = [index]
+            # Index i in insertion order is stored at slot (oldest slot + i)
+            slots = (np.asarray(indices, dtype=np.int64) + self._next - self._size) % self.capacity
+            columns = {name: col[slots] for name, col in self._columns.items()}
+        records = _to_records(columns)
+        return records if isinstance(item, slice) else records[0]
+
+    @property
+    def total(self) -> int:
+        """Number of detections ever appended, e.g. to pass to since later"""
+        return self._total
+
+    def since(self, total: int) -> List[Dict]:
+        """
+        Detections appended after the store had `total` appended detections, in insertion order
+
+        Args:
+            total: value of the total attribute at the earlier time
+
+        Returns:
+            List[Dict]: the detections that are still in memory, see to_records
+        """
+        with self._lock:
+            count = min(max(self._total - total, 0), self._size)
+            columns = self._copy_rows(count)
+        return _to_records(columns)
+
+    def tail(self, n: int) -> List[Dict]:
+        """
+        The last n appended detections, in insertion order
+
+        Args:
+            n: number of detections
+
+        Returns:
+            List[Dict]: see to_records
+        """
+        with self._lock:
+            columns = self._copy_rows(min(max(n, 0), self._size))
+        return _to_records(columns)
+
+    def __repr__(self) -> str:
+        return f"PeakTrackStore({self._size} of {self.capacity} detections, {self._total} appended)"
+
+    def append(self, timestamp: TimeLike, lat: float, lon: float, x_m: float, y_m: float, power_db: float,
+               subband: int):
+        """
+        Add a detection, overwriting the oldest one if the store is full
+
+        Args:
+            timestamp: Observation time (UTC)
+            lat: Latitude of the maximum
+            lon: Longitude of the maximum
+            x_m: Metres east of the station center
+            y_m: Metres north of the station center
+            power_db: Power of the maximum in dB
+            subband: Subband
+        """
+        timestamp = _to_datetime64(timestamp)
+        spill = None
+        with self._lock:
+            pos = self._next
+            cols = self._columns
+            cols["timestamp"][pos] = timestamp
+            cols["lat"][pos] = lat
+            cols["lon"][pos] = lon
+            cols["x_m"][pos] = x_m
+            cols["y_m"][pos] = y_m
+            cols["power_db"][pos] = power_db
+            cols["subband"][pos] = subband
+
+            if self._last_time is not None and timestamp < self._last_time:
+                self._sorted = False
+            self._last_time = timestamp
+            self._next = (pos + 1) % self.capacity
+            self._size = min(self._size + 1, self.capacity)
+            self._total += 1
+
+            if self.spill_path is not None:
+                self._pending += 1
+                if self._pending >= self.spill_every:
+                    spill = self._take_pending()
+
+        if spill is not None:
+            # A failing spill should not fail the imaging that records the detection, the rows are retried
+            try:
+                self._write_spill(spill)
+            except Exception as e:
+                self._requeue(spill)
+                if not self._spill_failed:
+                    print(f"Warning: could not spill peak detections to {self.spill_path}, will retry: {e}")
+                self._spill_failed = True
+            else:
+                self._spill_failed = False
+
+    def append_record(self, record: Dict):
+        """
+        Add a detection given as a dict, like the entries returned by to_records
+
+        Args:
+            record: dict with the keys of TRACK_COLUMNS
+        """
+        self.append(**{name: record[name] for name in TRACK_COLUMNS})
+
+    def clear(self):
+        """
+        Remove all detections from memory. Detections that were not spilled yet are spilled first; if that fails,
+        the exception is raised and nothing is removed.
+        """
+        with self._lock:
+            if self.spill_path is not None:
+                spill = self._take_pending()
+                try:
+                    self._write_spill(spill)
+                except Exception:
+                    self._requeue(spill)
+                    raise
+            self._next = 0
+            self._size = 0
+            self._pending = 0
+            self._sorted = True
+            self._last_time = None
+
+    def _ordered_slices(self, count: int) -> List[slice]:
+        """Slices of the buffer with the last `count` rows in insertion order. Call with the lock held."""
+        start = (self._next - count) % self.capacity
+        if count == 0:
+            return []
+        if start + count <= self.capacity:
+            return [slice(start, start + count)]
+        return [slice(start, self.capacity), slice(0, self._next)]
+
+    def _copy_rows(self, count: int) -> Dict[str, np.ndarray]:
+        """Copy the last `count` rows in insertion order. Call with the lock held."""
+        slices = self._ordered_slices(count)
+        return {name: np.concatenate([col[s] for s in slices]) if slices else col[:0].copy()
+                for name, col in self._columns.items()}
+
+    def _take_pending(self) -> Dict[str, np.ndarray]:
+        """
+        Copy the detections that have not been spilled yet. Call with the lock held. If writing them fails,
+        call _requeue so that they are spilled with the next ones.
+        """
+        spill = self._copy_rows(min(self._pending, self._size))
+        self._pending = 0
+        return spill
+
+    def _requeue(self, spill: Dict[str, np.ndarray]):
+        """Mark the rows of a failed spill as pending again, unless they were overwritten in the meantime"""
+        with self._lock:
+            self._pending = min(self._pending + len(spill["timestamp"]), self._size)
+
+    def snapshot(self) -> Dict[str, np.ndarray]:
+        """
+        Copy of all detections in memory, oldest first
+
+        Returns:
+            Dict[str, np.ndarray]: one array per column
+        """
+        with self._lock:
+            columns = self._copy_rows(self._size)
+            is_sorted = self._sorted
+        if not is_sorted:
+            order = np.argsort(columns["timestamp"], kind="stable")
+            columns = {name: col[order] for name, col in columns.items()}
+        return columns
+
+    def query(self, start: TimeLike = None, end: TimeLike = None, subbands: Iterable[int] = None,
+              lonlat_box: Tuple[float, float, float, float] = None,
+              xy_box: Tuple[float, float, float, float] = None, min_power_db: float = None,
+              last: int = None) -> Dict[str, np.ndarray]:
+        """
+        Select detections, sorted by time
+
+        Args:
+            start: Only detections at or after this time. Defaults to None
+            end: Only detections before this time. Defaults to None
+            subbands: Only detections in these subbands. Defaults to None
+            lonlat_box: Only detections inside (lon_min, lon_max, lat_min, lat_max). Defaults to None
+            xy_box: Only detections inside (x_min, x_max, y_min, y_max), in metres. Defaults to None
+            min_power_db: Only detections with at least this power. Defaults to None
+            last: Only the last n of the selected detections. Defaults to None
+
+        Returns:
+            Dict[str, np.ndarray]: one array per column
+        """
+        columns = self.snapshot()
+        return _select(columns, start=start, end=end, subbands=subbands, lonlat_box=lonlat_box, xy_box=xy_box,
+                       min_power_db=min_power_db, last=last)
+
+    def to_records(self, **query_kwargs) -> List[Dict]:
+        """
+        Detections as a list of dicts, e.g. for a JSON response. Arguments are passed to query
+
+        Returns:
+            List[Dict]: dicts with timestamp (ISO format), lat, lon, x_m, y_m, power_db, subband
+        """
+        return _to_records(self.query(**query_kwargs))
+
+    def flush(self):
+        """Spill all detections that have not been spilled yet. If that fails, they stay pending."""
+        if self.spill_path is None:
+            return
+        with self._lock:
+            spill = self._take_pending()
+        try:
+            self._write_spill(spill)
+        except Exception:
+            self._requeue(spill)
+            raise
+        self._spill_failed = False
+
+    def _write_spill(self, columns: Dict[str, np.ndarray]):
+        """Append rows to the spill file"""
+        if len(columns["timestamp"]) == 0:
+            return
+        with self._spill_lock:
+            if self.spill_path.endswith(".parquet"):
+                _append_parquet(self.spill_path, columns)
+            else:
+                _append_hdf5(self.spill_path, columns)
+
+    @classmethod
+    def from_file(cls, filename: str, capacity: int = None) -> "PeakTrackStore":
+        """
+        Load spilled detections, e.g. for offline analysis
+
+        Args:
+            filename: HDF5 file or Parquet directory written by a PeakTrackStore
+            capacity: Capacity of the new store. Defaults to the number of detections in the file
+
+        Returns:
+            PeakTrackStore: store with the (last `capacity`) detections from the file
+        """
+        if filename.endswith(".parquet"):
+            columns = _read_parquet(filename)
+        else:
+            columns = _read_hdf5(filename)
+
+        nrows = len(columns["timestamp"])
+        store = cls(capacity=capacity or max(nrows, 1))
+        keep = min(nrows, store.capacity)
+        for name in TRACK_COLUMNS:
+            store._columns[name][:keep] = columns[name][nrows - keep:]
+        store._size = keep
+        store._next = keep % store.capacity
+        store._total = keep
+        times = store._columns["timestamp"][:keep]
+        store._sorted = bool(np.all(times[1:] >= times[:-1]))
+        store._last_time = times[-1] if keep > 0 else None
+        return store
+
+
+def _select(columns: Dict[str, np.ndarray], start: TimeLike = None, end: TimeLike = None,
+            subbands: Iterable[int] = None, lonlat_box: Tuple[float, float, float, float] = None,
+            xy_box: Tuple[float, float, float, float] = None, min_power_db: float = None,
+            last: int = None) -> Dict[str, np.ndarray]:
+    """Select rows from time-sorted columns, see PeakTrackStore.query"""
+    times = columns["timestamp"]
+    lo = 0 if start is None else np.searchsorted(times, _to_datetime64(start), side="left")
+    hi = len(times) if end is None else np.searchsorted(times, _to_datetime64(end), side="left")
+    columns = {name: col[lo:hi] for name, col in columns.items()}
+
+    mask = np.ones(hi - lo if hi > lo else 0, dtype=bool)
+    if subbands is not None:
+        mask &= np.isin(columns["subband"], np.asarray(list(subbands), dtype=np.int32))
+    if lonlat_box is not None:
+        lon_min, lon_max, lat_min, lat_max = lonlat_box
+        mask &= (columns["lon"] >= lon_min) & (columns["lon"] <= lon_max)
+        mask &= (columns["lat"] >= lat_min) & (columns["lat"] <= lat_max)
+    if xy_box is not None:
+        x_min, x_max, y_min, y_max = xy_box
+        mask &= (columns["x_m"] >= x_min) & (columns["x_m"] <= x_max)
+        mask &= (columns["y_m"] >= y_min) & (columns["y_m"] <= y_max)
+    if min_power_db is not None:
+        mask &= columns["power_db"] >= min_power_db
+
+    if not mask.all():
+        columns = {name: col[mask] for name, col in columns.items()}
+    if last is not None:
+        columns = {name: col[len(col) - min(last, len(col)):] for name, col in columns.items()}
+    return columns
+
+
+def _to_records(columns: Dict[str, np.ndarray]) -> List[Dict]:
+    """Convert columns to a list of dicts with python types"""
+    timestamps = columns["timestamp"].astype(datetime.datetime)
+    floats = {name: columns[name].tolist() for name in ("lat", "lon", "x_m", "y_m", "power_db")}
+    subbands = columns["subband"].tolist()
+    return [{"timestamp": timestamps[i].isoformat(),
+             "lat": floats["lat"][i],
+             "lon": floats["lon"][i],
+             "x_m": floats["x_m"][i],
+             "y_m": floats["y_m"][i],
+             "power_db": floats["power_db"][i],
+             "subband": subbands[i]} for i in range(len(subbands))]
+
+
+def _append_hdf5(filename: str, columns: Dict[str, np.ndarray]):
+    """Append rows to resizable datasets in the group peak_tracks of an HDF5 file"""
+    nrows = len(columns["timestamp"])
+    with h5py.File(filename, "a") as h5file:
+        group = h5file.require_group("peak_tracks")
+        for name, col in columns.items():
+            # Timestamps are stored as microseconds since 1970
+            data = col.astype(np.int64) if name == "timestamp" else col
+            if name not in group:
+                group.create_dataset(name, data=data, maxshape=(None,), chunks=(max(min(nrows, 4096), 1),))
+                if name == "timestamp":
+                    group[name].attrs["units"] = "microseconds since 1970-01-01T00:00:00 UTC"
+            else:
+                dataset = group[name]
+                dataset.resize((dataset.shape[0] + nrows,))
+                dataset[-nrows:] = data
+
+
+def _read_hdf5(filename: str) -> Dict[str, np.ndarray]:
+    """Read spilled detections from an HDF5 file"""
+    with h5py.File(filename, "r") as h5file:
+        group = h5file["peak_tracks"]
+        columns = {name: group[name][:] for name in TRACK_COLUMNS}
+    columns["timestamp"] = columns["timestamp"].astype("datetime64[us]")
+    return columns
+
+
+def _append_parquet(dirname: str, columns: Dict[str, np.ndarray]):
+    """Write rows as a new part file in a Parquet dataset directory"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    os.makedirs(dirname, exist_ok=True)
+    table = pa.table({name: pa.array(col) for name, col in columns.items()})
+    part_number = len([name for name in os.listdir(dirname) if name.endswith(".parquet")])
+    first_time = str(columns["timestamp"][0].astype("datetime64[s]")).replace(":", "")
+    pq.write_table(table, os.path.join(dirname, f"part-{part_number:06d}-{first_time}.parquet"))
+
+
+def _read_parquet(dirname: str) -> Dict[str, np.ndarray]:
+    """Read spilled detections from a Parquet dataset directory"""
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(dirname)
+    columns = {name: table.column(name).to_numpy().astype(dtype) for name, dtype in TRACK_COLUMNS.items()}
+    order = np.argsort(columns["timestamp"], kind="stable")
+    return {name: col[order] for name, col in columns.items()}